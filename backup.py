@@ -0,0 +1,217 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+from itertools import islice
+from os import environ
+from typing import IO, Iterator
+
+import bson
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+from bot import ColourFormatter
+
+# Collections backed up by default
+COLLECTIONS: list[str] = ["users", "userItems", "items", "itemTypes"]
+
+# File formats
+NDJSON = "ndjson"
+BSON = "bson"
+
+# Error code MongoDB gives when a document with the same _id already exists
+DUPLICATE_KEY_ERROR: int = 11000
+
+# Seconds between progress reports
+REPORT_INTERVAL: float = 5.0
+
+# Name of the file in the backup directory recording how much of each collection has been imported
+CHECKPOINT_FILE = ".import_checkpoint.json"
+
+
+def get_logger() -> logging.Logger:
+    logger = logging.getLogger("alis_unnamed_bot.backup")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(ColourFormatter())
+        logger.addHandler(stream_handler)
+    return logger
+
+
+def get_path(directory: str, collection: str, file_format: str, compress: bool) -> str:
+    return os.path.join(directory, f"{collection}.{file_format}" + (".gz" if compress else ""))
+
+
+def open_file(path: str, mode: str) -> IO[bytes]:
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+# Yields the documents in a backup file one at a time, so only one document is held in memory
+def read_documents(file: IO[bytes], file_format: str) -> Iterator[dict]:
+    if file_format == BSON:
+        yield from bson.decode_file_iter(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json_util.loads(line)
+
+
+# Logs how many documents have been processed, and how quickly, at most once every REPORT_INTERVAL seconds
+class Progress:
+    def __init__(self, logger: logging.Logger, action: str, collection: str, total: int = None):
+        self.logger = logger
+        self.action = action
+        self.collection = collection
+        self.total = total
+        self.count = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, count: int):
+        self.count += count
+        if time.perf_counter() - self.last_report >= REPORT_INTERVAL:
+            self.report()
+
+    def report(self, finished: bool = False):
+        self.last_report = time.perf_counter()
+        elapsed = self.last_report - self.start
+        rate = self.count / elapsed if elapsed else 0.0
+        total = f"/{self.total}" if self.total is not None else ""
+        state = "Finished" if finished else "Progress"
+        self.logger.info(f"{state}: {self.action} {self.count}{total} '{self.collection}' documents "
+                         f"in {elapsed:.1f}s ({rate:.0f} docs/s)")
+
+
+# Streams each collection to a file in directory, with a cursor fetching batch_size documents at a time
+def export_collections(db: Database, collections: list[str], directory: str, file_format: str, compress: bool,
+                       batch_size: int, logger: logging.Logger):
+    os.makedirs(directory, exist_ok=True)
+    for collection in collections:
+        path = get_path(directory, collection, file_format, compress)
+        progress = Progress(logger, "exported", collection, db[collection].estimated_document_count())
+        # Write to a temporary file, so an interrupted export never leaves a partial file that looks complete
+        temp_path = path + ".tmp"
+        with open_file(temp_path, "wb") as file:
+            cursor = db[collection].find({}, batch_size=batch_size).sort("_id", 1)
+            for document in cursor:
+                if file_format == BSON:
+                    file.write(bson.encode(document))
+                else:
+                    file.write((json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n")
+                               .encode("utf-8"))
+                progress.update(1)
+        os.replace(temp_path, path)
+        progress.report(finished=True)
+
+
+def load_checkpoint(directory: str) -> dict[str, int]:
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_checkpoint(directory: str, checkpoint: dict[str, int]):
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file)
+    os.replace(path + ".tmp", path)
+
+
+# Inserts documents in order, skipping any that already exist, such as ones inserted before an import was interrupted
+# Returns the number of documents that were skipped
+def insert_chunk(db: Database, collection: str, documents: list[dict]) -> int:
+    skipped = 0
+    while documents:
+        try:
+            db[collection].insert_many(documents, ordered=True)
+            return skipped
+        except BulkWriteError as error:
+            write_error = error.details["writeErrors"][0]
+            if write_error.get("code") != DUPLICATE_KEY_ERROR:
+                raise
+            # An ordered insert stops at the first error, so carry on from the document after it
+            skipped += 1
+            documents = documents[write_error["index"] + 1:]
+    return skipped
+
+
+# Streams each collection's file from directory into the database, chunk_size documents at a time
+# After each chunk, the number of documents imported is saved to a checkpoint, so an interrupted import can be run
+# again to carry on from where it stopped
+def import_collections(db: Database, collections: list[str], directory: str, file_format: str, compress: bool,
+                       chunk_size: int, drop: bool, logger: logging.Logger):
+    checkpoint = load_checkpoint(directory)
+    for collection in collections:
+        path = get_path(directory, collection, file_format, compress)
+        if not os.path.isfile(path):
+            logger.warning(f"Skipping '{collection}', since '{path}' doesn't exist")
+            continue
+        done = checkpoint.get(collection, 0)
+        if drop and not done:
+            db[collection].drop()
+        elif done:
+            logger.info(f"Resuming '{collection}' after {done} documents")
+
+        progress = Progress(logger, "imported", collection)
+        skipped = 0
+        with open_file(path, "rb") as file:
+            documents = read_documents(file, file_format)
+            # Documents before the checkpoint have already been imported, so pass over them without inserting
+            for _ in islice(documents, done):
+                pass
+            while True:
+                chunk = list(islice(documents, chunk_size))
+                if not chunk:
+                    break
+                skipped += insert_chunk(db, collection, chunk)
+                done += len(chunk)
+                checkpoint[collection] = done
+                save_checkpoint(directory, checkpoint)
+                progress.update(len(chunk))
+        progress.report(finished=True)
+        if skipped:
+            logger.info(f"Skipped {skipped} '{collection}' documents that already existed")
+
+    # Every collection was imported, so a later import should start from the beginning
+    if os.path.isfile(os.path.join(directory, CHECKPOINT_FILE)):
+        os.remove(os.path.join(directory, CHECKPOINT_FILE))
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Export or import AlisUnnamedBot's database collections.")
+    parser.add_argument("action", choices=["export", "import"], help="Whether to export or import.")
+    parser.add_argument("directory", help="Directory to export to, or import from.")
+    parser.add_argument("--collections", nargs="+", default=COLLECTIONS, help="Collections to export or import.")
+    parser.add_argument("--format", choices=[NDJSON, BSON], default=NDJSON, dest="file_format",
+                        help="File format: newline delimited extended JSON, or BSON.")
+    parser.add_argument("--no-compress", action="store_false", dest="compress",
+                        help="Don't gzip the files.")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Documents fetched per cursor batch when exporting, and inserted per chunk when "
+                             "importing.")
+    parser.add_argument("--drop", action="store_true",
+                        help="Drop each collection before importing into it, unless resuming an import.")
+    args = parser.parse_args()
+
+    client = MongoClient(environ["DB_HOST"], int(environ["DB_PORT"]))
+    database = client[environ["DB_DATABASE"]]
+    backup_logger = get_logger()
+    try:
+        if args.action == "export":
+            export_collections(database, args.collections, args.directory, args.file_format, args.compress,
+                               args.batch_size, backup_logger)
+        else:
+            import_collections(database, args.collections, args.directory, args.file_format, args.compress,
+                               args.batch_size, args.drop, backup_logger)
+    finally:
+        client.close()
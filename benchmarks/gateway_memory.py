@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import os
+import resource
+from datetime import datetime, timezone
+
+from nextcord import Client, Intents
+
+from bot import build_client_options
+
+# Snowflakes are generated from this, so every id in the benchmark is unique
+BASE_ID: int = 1000000000000000000
+
+
+# Returns the resident memory of this process in bytes
+def get_rss() -> int:
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Not on Linux, so fall back to the peak resident memory (kilobytes on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def user_payload(user_id: int) -> dict:
+    return {
+        "id": str(user_id),
+        "username": f"user{user_id % 100000}",
+        "discriminator": "0",
+        "avatar": None,
+        "bot": False
+    }
+
+
+# Returns a GUILD_CREATE payload, containing only what Discord sends for the given intents
+def guild_payload(guild_id: int, intents: Intents, channels: int, members: int, bot_id: int) -> dict:
+    timestamp = datetime.now(timezone.utc).isoformat()
+    # Without the members intent, Discord only sends the bot's own member
+    member_ids = [bot_id] + ([guild_id + 1000 + i for i in range(members)] if intents.members else [])
+    return {
+        "id": str(guild_id),
+        "name": f"Guild {guild_id}",
+        "owner_id": str(bot_id),
+        "member_count": members + 1,
+        "large": members >= 250,
+        "unavailable": False,
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "threads": [],
+        "presences": [],
+        "voice_states": [],
+        "roles": [
+            {
+                "id": str(guild_id),
+                "name": "@everyone",
+                "permissions": "0",
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False
+            }
+        ],
+        "channels": [
+            {
+                "id": str(guild_id + 1 + i),
+                "type": 0,
+                "name": f"channel-{i}",
+                "position": i,
+                "permission_overwrites": []
+            }
+            for i in range(channels)
+        ],
+        "members": [
+            {
+                "user": user_payload(member_id),
+                "roles": [],
+                "joined_at": timestamp,
+                "deaf": False,
+                "mute": False
+            }
+            for member_id in member_ids
+        ]
+    }
+
+
+def message_payload(message_id: int, guild_id: int, channel_id: int, author_id: int) -> dict:
+    timestamp = datetime.now(timezone.utc).isoformat()
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": user_payload(author_id),
+        "member": {
+            "roles": [],
+            "joined_at": timestamp,
+            "deaf": False,
+            "mute": False
+        },
+        "content": "Hello world! " * 5,
+        "timestamp": timestamp,
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0
+    }
+
+
+# Runs in a fresh process, so each mode is measured from the same starting point
+# Feeds the client's connection state the gateway events a bot in guilds guilds would receive, and returns the
+# increase in resident memory
+def measure(lean: bool, guilds: int, channels: int, members: int, messages: int) -> int:
+    async def run() -> int:
+        client = Client(**build_client_options(lean))
+        state = client._connection
+        intents = state._intents
+        bot_id = BASE_ID - 1
+
+        gc.collect()
+        before = get_rss()
+        for i in range(guilds):
+            guild_id = BASE_ID + i * 100000
+            state.parse_guild_create(guild_payload(guild_id, intents, channels, members, bot_id))
+            # Discord only sends messages with the guild messages intent
+            if intents.guild_messages:
+                for j in range(messages):
+                    channel_id = guild_id + 1 + j % channels
+                    author_id = guild_id + 1000 + j % max(members, 1)
+                    state.parse_message_create(message_payload(guild_id + 50000 + j, guild_id, channel_id, author_id))
+        gc.collect()
+        after = get_rss()
+        await client.close()
+        return after - before
+
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the gateway cache memory of the default and lean modes.")
+    parser.add_argument("--guilds", type=int, default=1000, help="Number of guilds to simulate.")
+    parser.add_argument("--channels", type=int, default=20, help="Text channels per guild.")
+    parser.add_argument("--members", type=int, default=100, help="Members per guild, besides the bot.")
+    parser.add_argument("--messages", type=int, default=20, help="Messages received per guild.")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{args.guilds} guilds, {args.channels} channels, {args.members} members, {args.messages} messages per guild")
+    print(f"{'Mode':<10}{'RSS increase (MiB)':>22}{'MiB per 1k guilds':>22}")
+    for mode, lean in (("default", False), ("lean", True)):
+        with context.Pool(1) as pool:
+            increase = pool.apply(measure, (lean, args.guilds, args.channels, args.members, args.messages))
+        mib = increase / 1024 / 1024
+        print(f"{mode:<10}{mib:>22.2f}{mib / args.guilds * 1000:>22.2f}")
@@ -0,0 +1,60 @@
+import argparse
+import random
+import sys
+import time
+from statistics import NormalDist
+
+from extensions.core.loot import AliasTable
+
+
+# Returns the value a chi-squared statistic with degrees_of_freedom degrees of freedom exceeds with probability
+# alpha, using the Wilson-Hilferty approximation, which is accurate to well under 1% for the sizes used here
+def chi_squared_critical_value(degrees_of_freedom: int, alpha: float) -> float:
+    z = NormalDist().inv_cdf(1 - alpha)
+    k = degrees_of_freedom
+    return k * (1 - 2 / (9 * k) + z * (2 / (9 * k)) ** 0.5) ** 3
+
+
+# Draws draws keys from an alias table built from weights, and returns the chi-squared statistic comparing how often
+# each key was drawn to how often it should have been, and how many seconds the draws took
+def check_distribution(weights: dict, draws: int, rng: random.Random) -> tuple[float, float]:
+    table = AliasTable(weights)
+    start = time.perf_counter()
+    counts = table.draw_many(draws, rng)
+    elapsed = time.perf_counter() - start
+    total = sum(weights.values())
+    statistic = 0.0
+    for key, weight in weights.items():
+        expected = draws * weight / total
+        statistic += (counts.get(key, 0) - expected) ** 2 / expected
+    return statistic, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that loot tables draw items in proportion to their weights, "
+                                                 "and measure how quickly they draw.")
+    parser.add_argument("--tables", type=int, default=20, help="Number of random loot tables to check.")
+    parser.add_argument("--items", type=int, default=100, help="Items per loot table.")
+    parser.add_argument("--draws", type=int, default=1000000, help="Draws per loot table.")
+    parser.add_argument("--alpha", type=float, default=0.001,
+                        help="Significance level: each table fails if its draws are this unlikely.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed the random draws, to repeat a run.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    critical_value = chi_squared_critical_value(args.items - 1, args.alpha)
+    print(f"{args.tables} tables of {args.items} items, {args.draws} draws each, "
+          f"failing above chi-squared {critical_value:.1f}")
+    print(f"{'Table':<8}{'Chi-squared':>14}{'Draws/s':>14}{'Result':>10}")
+    failures = 0
+    for i in range(args.tables):
+        # Mix common and rare items, as real loot tables do
+        weights = {f"item{j}": rng.choice([rng.uniform(1, 100), rng.uniform(0.1, 1)]) for j in range(args.items)}
+        statistic, elapsed = check_distribution(weights, args.draws, rng)
+        passed = statistic <= critical_value
+        failures += not passed
+        print(f"{i:<8}{statistic:>14.1f}{args.draws / elapsed:>14,.0f}{'pass' if passed else 'FAIL':>10}")
+
+    # With alpha = 0.001, a correct table fails very rarely, so more than one failure points to a real problem
+    print(f"{failures} of {args.tables} tables failed")
+    sys.exit(1 if failures > max(1, args.tables * args.alpha * 10) else 0)
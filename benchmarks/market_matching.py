@@ -0,0 +1,71 @@
+import argparse
+import random
+import sys
+import time
+from decimal import Decimal
+
+from extensions.core.order_book import OrderBooks, Order, BUY, SELL
+
+
+# Returns count random orders spread over items, with prices scattered around a mid price that drifts over time,
+# so that most orders rest in the book for a while before being matched
+def generate_orders(count: int, items: int, users: int, rng: random.Random) -> list[Order]:
+    orders = []
+    mid = {item: rng.randint(500, 5000) for item in range(items)}  # In hundredths
+    for order_id in range(count):
+        item = rng.randrange(items)
+        mid[item] = max(100, mid[item] + rng.randint(-5, 5))
+        side = rng.choice((BUY, SELL))
+        offset = rng.randint(-50, 50)
+        price = Decimal(mid[item] + (offset if side == BUY else -offset)) / 100
+        orders.append(Order(order_id, rng.randrange(users), item, side, price, rng.randint(1, 20)))
+    return orders
+
+
+# Adds every order to the books, and checks that no book is ever left crossed, that every fill is at an acceptable
+# price for both orders, and that no order is filled for more than its quantity
+# Returns the number of fills, and how many seconds adding the orders took (not including the checks)
+def run(orders: list[Order], check: bool) -> tuple[int, float]:
+    books = OrderBooks()
+    fills = 0
+    elapsed = 0.0
+    filled = {}
+    for order in orders:
+        book = books.get(order.item_id)
+        start = time.perf_counter()
+        order_fills = book.add(order)
+        elapsed += time.perf_counter() - start
+        fills += len(order_fills)
+        if not check:
+            continue
+        for fill in order_fills:
+            assert fill.sell_order.price <= fill.price <= fill.buy_order.price, "Fill outside the orders' prices"
+            for filled_order in (fill.buy_order, fill.sell_order):
+                filled[filled_order.order_id] = filled.get(filled_order.order_id, 0) + fill.quantity
+                assert filled[filled_order.order_id] <= filled_order.quantity, "Order overfilled"
+        best_bid, best_ask = book.best_bid, book.best_ask
+        assert best_bid is None or best_ask is None or best_bid.price < best_ask.price, "Book left crossed"
+    return fills, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure how quickly market order books match orders, and check "
+                                                 "that they match them correctly.")
+    parser.add_argument("--orders", type=int, default=200000, help="Number of random orders to add.")
+    parser.add_argument("--items", type=int, default=50, help="Number of items the orders are spread over.")
+    parser.add_argument("--users", type=int, default=1000, help="Number of users placing the orders.")
+    parser.add_argument("--no-check", action="store_false", dest="check",
+                        help="Don't check the fills, only measure the speed.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed the random orders, to repeat a run.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    random_orders = generate_orders(args.orders, args.items, args.users, rng)
+    print(f"{args.orders} orders for {args.items} items from {args.users} users")
+    try:
+        total_fills, seconds = run(random_orders, args.check)
+    except AssertionError as error:
+        print(f"FAIL: {error}")
+        sys.exit(1)
+    print(f"{total_fills} matches in {seconds:.2f}s: {args.orders / seconds:,.0f} orders/s, "
+          f"{total_fills / seconds:,.0f} matches/s")
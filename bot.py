@@ -1,14 +1,19 @@
+import ast
+import hashlib
 import json
 import logging
 import os
 from os import environ
+from typing import Optional
 
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
-from nextcord import Intents, Interaction
-from nextcord.ext.commands import Bot
+from nextcord import Intents, Interaction, MemberCacheFlags
+from nextcord.ext.commands import Bot, AutoShardedBot
 from nextcord.ext.commands.errors import ExtensionError
 
+from scheduler import Scheduler
+
 
 # Formatter used by the bot logger
 class ColourFormatter(logging.Formatter):
@@ -31,14 +36,93 @@ class ColourFormatter(logging.Formatter):
         return formatter.format(record)
 
 
+# Summary of a series of timings, such as how long a database write takes
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+# Counters, gauges and timings recorded by extensions
+# Owned by the bot, rather than an extension, so that metrics aren't reset when extensions are reloaded
+class Metrics:
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+        self.gauges: dict[str, float] = {}
+        self.timings: dict[str, Timing] = {}
+
+    def increment(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        timing.observe(seconds)
+
+
+# Returns the intents and cache options the bot should connect to the gateway with
+# In lean mode, only the guilds intent is enabled, and members and messages aren't cached, since
+# application commands are sent the invoking user, and any users chosen in options, with the interaction
+# Lean mode also stops the bot receiving messages, which turns off exp and messagesSent from messages
+def build_client_options(lean: bool) -> dict:
+    if not lean:
+        return {"intents": Intents.default()}
+    intents = Intents.none()
+    intents.guilds = True
+    return {
+        "intents": intents,
+        "member_cache_flags": MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False,
+        "max_messages": None
+    }
+
+
+# Returns the client options for the mode chosen by "lean_gateway" in the bot config
+# These options are only read when the bot is created, so changing them requires a restart rather than a reload
+def get_client_options(config_path: str) -> dict:
+    with open(config_path, "r", encoding="utf-8") as file:
+        config = json.load(file)
+    return build_client_options(config.get("lean_gateway", False))
+
+
 # The main Bot class for AlisUnnamedBot
 class AlisUnnamedBot(Bot):
-    def __init__(self, config_path: str, **kwargs):
-        super().__init__(**kwargs)
+    # The nextcord bot class whose __init__ sets up the client
+    # Bot.__init__ initialises Client directly rather than calling super(), so subclasses that mix in another
+    # client, such as ShardedAlisUnnamedBot, must replace it
+    client_class = Bot
+
+    def __init__(self, config_path: str, log_file_path: str = None, **kwargs):
+        self.client_class.__init__(self, **kwargs)
         self.config_path = config_path
+        self.log_file_path = log_file_path  # Overrides "log_file_path" in the bot config, if specified
         self.config = {}
         self.load_config()
         self.logger = self.create_logger()
+        if self.config.get("lean_gateway", False):
+            # Without the guild messages intent, messages are never received, so nothing counts them
+            self.logger.warning("Lean gateway mode is on, so messages won't award exp or count towards messagesSent")
+        self.extension_hashes: dict[str, str] = {}  # Maps extension names to the hash of their source
+        self.metrics = Metrics()
+        scheduler_config = self.config.get("scheduler", {})
+        self.scheduler = Scheduler(self.logger, self.metrics, scheduler_config.get("tick_seconds", 5),
+                                   scheduler_config.get("lease_seconds", 60))
 
     def load_config(self) -> bool:
         if not os.path.isfile(self.config_path) and self.config_path.endswith(".json"):
@@ -57,7 +141,8 @@ class AlisUnnamedBot(Bot):
         stream_handler.setFormatter(ColourFormatter())
         nextcord.addHandler(stream_handler)
 
-        file_handler = logging.FileHandler(filename=self.config.get("log_file_path"), encoding='utf-8', mode='w')
+        log_file_path = self.log_file_path or self.config.get("log_file_path")
+        file_handler = logging.FileHandler(filename=log_file_path, encoding='utf-8', mode='w')
         file_handler.setFormatter(logging.Formatter(ColourFormatter.FORMAT))
         nextcord.addHandler(file_handler)
 
@@ -66,7 +151,63 @@ class AlisUnnamedBot(Bot):
         logger.setLevel(logging.DEBUG)
         return logger
 
-    async def reload_extensions(self) -> list[str]:
+    # Returns a dictionary mapping extension names to the paths of their python files
+    @staticmethod
+    def find_extensions(extensions_root: str) -> dict[str, str]:
+        extensions = {}
+        for dir_path, _, files in os.walk(extensions_root):
+            if dir_path.endswith("__pycache__"):
+                continue
+            for python_file in list(filter(lambda s: (s.endswith(".py")), files)):
+                path = os.path.normpath(dir_path).replace(os.sep, ".").replace("\\", ".")
+                name = python_file.replace(".py", "")
+                extensions[f"{path}.{name}"] = os.path.join(dir_path, python_file)
+        return extensions
+
+    # Returns a hash of the contents of the file at path
+    @staticmethod
+    def hash_file(path: str) -> str:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    # Returns the names of the extensions that the file at path imports
+    @staticmethod
+    def get_extension_imports(path: str, extensions: set[str]) -> set[str]:
+        with open(path, "r", encoding="utf-8") as file:
+            tree = ast.parse(file.read(), filename=path)
+        imports = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                imports.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                imports.add(node.module)
+                # Catches imports such as "from extensions.core import utils"
+                imports.update(f"{node.module}.{alias.name}" for alias in node.names)
+        return imports & extensions
+
+    # Returns the extensions ordered so that each extension comes after the extensions it imports
+    @staticmethod
+    def sort_extensions(extensions: set[str], dependencies: dict[str, set[str]]) -> list[str]:
+        ordered = []
+        visited = set()
+
+        def visit(extension: str):
+            if extension in visited:
+                return
+            visited.add(extension)
+            for dependency in sorted(dependencies.get(extension, set())):
+                if dependency in extensions:
+                    visit(dependency)
+            ordered.append(extension)
+
+        for name in sorted(extensions):
+            visit(name)
+        return ordered
+
+    # Reloads extensions whose source has changed since they were last loaded, along with any extensions that
+    # import them. Unchanged extensions are left loaded, so their cogs keep their state.
+    # If full is True, every extension is reloaded.
+    async def reload_extensions(self, full: bool = False) -> list[str]:
         extensions_root = self.config.get("extensions_root")
 
         # Confirm extensions_root is valid
@@ -77,47 +218,149 @@ class AlisUnnamedBot(Bot):
             self.logger.error("'extensions_root' is not a directory")
             return []
 
-        # Close MongoDB client, before unloading the old database cog
+        # Hash every extension and work out which extensions import which
+        extensions = self.find_extensions(extensions_root)
+        hashes = {}
+        dependencies = {}
+        for extension, path in extensions.items():
+            hashes[extension] = self.hash_file(path)
+            try:
+                dependencies[extension] = self.get_extension_imports(path, set(extensions))
+            except SyntaxError as error:
+                self.logger.error(error)
+                dependencies[extension] = set()
+
+        # Extensions that are new, have changed, or are no longer loaded
+        changed = set()
+        for extension, digest in hashes.items():
+            if full or extension not in self.extensions or self.extension_hashes.get(extension) != digest:
+                changed.add(extension)
+        removed = set(self.extensions) - set(extensions)
+
+        # Extensions that import a changed extension must be reloaded too, so they don't hold onto old classes
+        dependents = {}
+        for extension, imports in dependencies.items():
+            for dependency in imports:
+                dependents.setdefault(dependency, set()).add(extension)
+        to_reload = set()
+        stack = list(changed | removed)
+        while stack:
+            extension = stack.pop()
+            if extension in to_reload:
+                continue
+            to_reload.add(extension)
+            stack.extend(dependents.get(extension, set()))
+
+        # Flush buffered writes and close MongoDB client, before unloading the old database cog
         old_database = self.get_cog("DatabaseCog")
-        if old_database and hasattr(old_database, "close_connection"):
-            old_database.close_connection()
+        database_module = getattr(old_database, "__module__", None)
+        if old_database and database_module in to_reload:
+            await self.close_database(old_database)
 
-        # Unload currently loaded extensions
-        for extension in list(self.extensions):
-            self.unload_extension(extension)
+        # Unload changed extensions, dependents first
+        for extension in reversed(self.sort_extensions(to_reload, dependencies)):
+            if extension in self.extensions:
+                self.unload_extension(extension)
+            self.extension_hashes.pop(extension, None)
 
-        # Load all extensions and create a list of failed extensions
+        # Load changed extensions and create a list of failed extensions
         failed_extensions = []
-        for dir_path, _, files in os.walk(extensions_root):
-            if dir_path.endswith("__pycache__"):
-                continue
-            for python_file in list(filter(lambda s: (s.endswith(".py")), files)):
-                path = dir_path.replace("\\", ".")
-                name = python_file.replace(".py", "")
-                extension = f"{path}.{name}"
-                try:
-                    self.load_extension(extension)
-                except ExtensionError as error:
-                    self.logger.error(error)
-                    failed_extensions.append(extension)
+        for extension in self.sort_extensions(to_reload & set(extensions), dependencies):
+            try:
+                self.load_extension(extension)
+                self.extension_hashes[extension] = hashes[extension]
+            except ExtensionError as error:
+                self.logger.error(error)
+                failed_extensions.append(extension)
+
+        self.logger.info(f"Reloaded {len(to_reload)} of {len(extensions)} extensions")
 
         utils = self.get_cog("UtilsCog")
         database = self.get_cog("DatabaseCog")
+        cooldowns = self.get_cog("CooldownsCog")
 
-        # Add UtilitiesCog and DatabaseCog as attributes to other cogs
+        # Add UtilitiesCog, DatabaseCog and CooldownsCog as attributes to other cogs
         for cog_name in self.cogs:
             cog = self.get_cog(cog_name)
             if hasattr(cog, "utils") and cog_name != "UtilsCog":
                 cog.utils = utils
             if hasattr(cog, "database") and cog_name != "DatabaseCog":
                 cog.database = database
+            if hasattr(cog, "cooldowns") and cog_name != "CooldownsCog":
+                cog.cooldowns = cooldowns
+
+        # Keep scheduled jobs in the database, so each run only happens in one process
+        self.scheduler.set_store(database.db.jobs if database and hasattr(database, "db") else None)
+
+        if database and hasattr(database, "ensure_collections"):
+            await database.ensure_collections()
 
-        # Set choices for any ItemSlashOptions that appear in application commands
-        if database and hasattr(database, "setup_item_slash_option_choices"):
-            await database.setup_item_slash_option_choices()
+        # Update the item index used to autocomplete ItemSlashOptions
+        if database and hasattr(database, "refresh_item_index"):
+            await database.refresh_item_index()
+
+        # Rebuild the market's order books from the open orders in the database
+        if database and hasattr(database, "load_order_books"):
+            await database.load_order_books()
 
         return failed_extensions
 
+    # Returns a stable hash of the payloads of every application command, including any option choices
+    def get_application_commands_hash(self) -> str:
+        payloads = []
+        for command in self.get_all_application_commands():
+            guild_ids = sorted(command.guild_ids) if command.guild_ids else [None]
+            for guild_id in guild_ids:
+                payloads.append(command.get_payload(guild_id))
+        payloads.sort(key=lambda payload: json.dumps(payload, sort_keys=True, default=str))
+        serialized = json.dumps(payloads, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    # Returns the application commands hash from the last successful sync, if there is one
+    def load_application_commands_hash(self) -> Optional[str]:
+        hash_path = self.config.get("commands_hash_path")
+        if not hash_path or not os.path.isfile(hash_path):
+            return None
+        with open(hash_path, "r", encoding="utf-8") as file:
+            return file.read().strip()
+
+    def save_application_commands_hash(self, commands_hash: str):
+        hash_path = self.config.get("commands_hash_path")
+        if not hash_path:
+            return
+        hash_dir = os.path.dirname(hash_path)
+        if hash_dir:
+            os.makedirs(hash_dir, exist_ok=True)
+        with open(hash_path, "w", encoding="utf-8") as file:
+            file.write(commands_hash)
+
+    # Whether this process matches market orders
+    # Order books are kept in memory, so only one process may match orders, and the others queue theirs for it
+    @property
+    def owns_market(self) -> bool:
+        return True
+
+    # Syncs application commands with Discord, unless they are unchanged since the last sync
+    # Returns whether a sync took place. If force is True, commands are always synced.
+    async def sync_application_commands_if_changed(self, force: bool = False) -> bool:
+        commands_hash = self.get_application_commands_hash()
+        if not force and commands_hash == self.load_application_commands_hash():
+            self.logger.info("Application commands are unchanged, skipping sync")
+            # Reloaded commands still need the ids Discord gave them, for autocomplete and mentions, so fetch the
+            # registered commands without changing any of them
+            await self.sync_application_commands(associate_known=True, delete_unknown=False, update_known=False,
+                                                 register_new=False)
+            return False
+        await self.sync_application_commands()
+        self.save_application_commands_hash(commands_hash)
+        return True
+
+    # Syncs application commands when first connecting, as nextcord does by default, then saves their hash,
+    # so the next reload knows whether they have changed since
+    async def on_connect(self) -> None:
+        await super().on_connect()
+        self.save_application_commands_hash(self.get_application_commands_hash())
+
     # Override default application command error handler
     # This prevents handled errors being raised in the console, unless bot_events.py says it should
     async def on_application_command_error(self, inter: Interaction, error):
@@ -125,15 +368,54 @@ class AlisUnnamedBot(Bot):
 
     async def start(self, token: str, *, reconnect: bool = True) -> None:
         await self.reload_extensions()  # Loads extensions for the first time
+        self.scheduler.start()
         await super().start(token, reconnect=reconnect)
 
+    async def close(self) -> None:
+        self.scheduler.stop()
+        database = self.get_cog("DatabaseCog")
+        if database:
+            await self.close_database(database)
+        await super().close()
+
+    # Writes the database cog's buffered writes, then closes its MongoDB client
+    async def close_database(self, database):
+        if hasattr(database, "flush_writes"):
+            await database.flush_writes()
+        if hasattr(database, "close_connection"):
+            database.close_connection()
+
+
+# Variant of AlisUnnamedBot that runs a range of shards, so guilds can be spread over several processes
+# Started by launcher.py, which runs one of these in each worker process
+class ShardedAlisUnnamedBot(AlisUnnamedBot, AutoShardedBot):
+    client_class = AutoShardedBot
+
+    # When the launcher splits shards between processes, the process running shard 0 matches market orders
+    @property
+    def owns_market(self) -> bool:
+        return self.shard_ids is None or 0 in self.shard_ids
+
+    # Returns a dictionary mapping each of this bot's shard ids to the shard's latency and guild count
+    def get_shard_stats(self) -> dict[int, dict]:
+        guild_counts = {}
+        for guild in self.guilds:
+            guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+        stats = {}
+        for shard_id, latency in self.latencies:
+            stats[shard_id] = {
+                "latency": latency,
+                "guilds": guild_counts.get(shard_id, 0)
+            }
+        return stats
+
 
 if __name__ == '__main__':
     load_dotenv()
 
     # Create client
-    intents = Intents.default()
-    alis_unnamed_bot = AlisUnnamedBot(config_path=environ["CONFIG_PATH"], intents=intents)
+    config_path = environ["CONFIG_PATH"]
+    alis_unnamed_bot = AlisUnnamedBot(config_path=config_path, **get_client_options(config_path))
 
     # Run client
     alis_unnamed_bot.run(environ["TOKEN"])
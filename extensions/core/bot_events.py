@@ -3,7 +3,7 @@ from nextcord.ext.application_checks import ApplicationNotOwner
 from nextcord.ext.commands import Cog
 
 from bot import AlisUnnamedBot
-from extensions.core.utils import EmbedError, HiddenEmbedError
+from extensions.core.utils import EmbedError, HiddenEmbedError, send_response, awaiting_first_response
 from extensions.core.emojis import CROSS
 
 
@@ -15,19 +15,22 @@ class BotEventsCog(Cog):
     @Cog.listener()
     async def on_application_command_error(self, inter: Interaction, error):
         error_embed = Embed()
-        if isinstance(error, ApplicationInvokeError):
-            if isinstance(error.original, EmbedError):
-                error_embed.title = error.original.embed_title
-                error_embed.colour = error.original.embed_colour
-                error_embed.description = f"{CROSS} {error.original.embed_desc}"
-                ephemeral = isinstance(error.original, HiddenEmbedError)
-                await inter.send(embed=error_embed, ephemeral=ephemeral)
+        # Errors raised by a command are wrapped in ApplicationInvokeError,
+        # but errors raised by checks and hooks, such as cooldowns, are not
+        original = error.original if isinstance(error, ApplicationInvokeError) else error
+        if isinstance(original, EmbedError):
+            error_embed.title = original.embed_title
+            error_embed.colour = original.embed_colour
+            error_embed.description = f"{CROSS} {original.embed_desc}"
+            ephemeral = isinstance(original, HiddenEmbedError)
+            await send_response(inter, embed=error_embed, ephemeral=ephemeral)
         elif isinstance(error, ApplicationNotOwner):
             error_embed.title = "**Missing Permissions**"
             error_embed.colour = Colour.red()
             error_embed.description = f"{CROSS} You must be the owner of the bot to use this command!"
             await inter.send(embed=error_embed)
-        if not inter.response.is_done():
+        # Auto deferred commands have a response, but still need to be told something went wrong
+        if await awaiting_first_response(inter):
             try:
                 error_embed.title = "**Application Command Error**"
                 error_embed.colour = Colour.red()
@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Any
+
+from bot import AlisUnnamedBot
+
+# Sentinel returned by caches when a key is not cached, since None may be a cached value
+MISSING = object()
+
+
+# Cache where each entry expires ttl seconds after it was set
+class TTLCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries: dict[Hashable, tuple[float, Any]] = {}  # Maps keys to (expiry time, value)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return MISSING
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        # Occasionally drop expired entries, so keys that are never read again don't build up
+        if len(self.entries) % 1024 == 0:
+            self.evict_expired()
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def evict_expired(self):
+        now = time.monotonic()
+        for key, (expires, _) in list(self.entries.items()):
+            if expires < now:
+                del self.entries[key]
+
+
+# Cache holding at most max_size entries, where the least recently used entry is dropped to make space
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any:
+        if key not in self.entries:
+            return MISSING
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Cache extension...")
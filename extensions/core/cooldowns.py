@@ -0,0 +1,101 @@
+import time
+from typing import Optional, Hashable
+
+from nextcord import Interaction
+from nextcord.ext import tasks
+from nextcord.ext.commands import Cog
+
+from bot import AlisUnnamedBot
+
+# Bucket types, which decide who shares a cooldown
+USER_BUCKET = "user"
+GUILD_BUCKET = "guild"
+GLOBAL_BUCKET = "global"
+
+
+# Bucket holding up to capacity tokens, refilled at rate tokens per second
+# Each use of a command takes one token, and a command can't be used while its bucket is empty
+class TokenBucket:
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Returns how many seconds until a token is available, or 0 if there is one now
+    def retry_after(self) -> float:
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # Returns whether the bucket is full at time now, in which case it's no different to a new bucket
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+# Cog that rate limits application commands, using the "cooldowns" section of the bot config
+# Maps command names (or "default") to a list of rules, such as {"bucket": "user", "rate": 3, "per": 10},
+# which allows each user to use the command 3 times every 10 seconds. "burst" optionally sets the bucket capacity.
+class CooldownsCog(Cog):
+    def __init__(self, bot: AlisUnnamedBot):
+        self.bot = bot
+        self.buckets: dict[tuple[str, int, Hashable], TokenBucket] = {}
+        self.evict_idle_buckets.start()
+
+    def cog_unload(self):
+        self.evict_idle_buckets.cancel()
+
+    def get_rules(self, command_name: str) -> list[dict]:
+        cooldowns = self.bot.config.get("cooldowns", {})
+        rules = cooldowns.get(command_name, cooldowns.get("default", []))
+        return rules if isinstance(rules, list) else [rules]
+
+    @staticmethod
+    def get_bucket_key(inter: Interaction, bucket_type: str) -> Hashable:
+        if bucket_type == GLOBAL_BUCKET:
+            return None
+        elif bucket_type == GUILD_BUCKET and inter.guild_id:
+            return inter.guild_id
+        return inter.user.id  # Commands used in DMs share a bucket per user, rather than per guild
+
+    # Takes a token from each of the command's buckets, and returns None
+    # If any bucket is empty, no tokens are taken, and returns how many seconds until the command can be used
+    def try_use(self, inter: Interaction) -> Optional[float]:
+        command_name = inter.application_command.name
+        now = time.monotonic()
+        buckets = []
+        for i, rule in enumerate(self.get_rules(command_name)):
+            bucket_type = rule.get("bucket", USER_BUCKET)
+            key = (command_name, i, self.get_bucket_key(inter, bucket_type))
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                rate = rule.get("rate", 1) / rule.get("per", 1)
+                bucket = self.buckets[key] = TokenBucket(rule.get("burst", rule.get("rate", 1)), rate)
+            bucket.refill(now)
+            buckets.append(bucket)
+
+        retry_after = max((bucket.retry_after() for bucket in buckets), default=0)
+        if retry_after > 0:
+            self.bot.metrics.increment(f"cooldowns.rejected.{command_name}")
+            return retry_after
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    # Full buckets behave the same as new buckets, so they can be dropped to save memory
+    @tasks.loop(seconds=60)
+    async def evict_idle_buckets(self):
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            if bucket.is_full(now):
+                del self.buckets[key]
+        self.bot.metrics.set_gauge("cooldowns.buckets", len(self.buckets))
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Cooldowns extension...")
+    bot.add_cog(CooldownsCog(bot))
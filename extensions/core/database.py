@@ -1,32 +1,203 @@
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
 from decimal import Decimal, ROUND_HALF_UP
 from os import environ
-from typing import Set, Optional
+from typing import Callable, Optional
 
 from bson import ObjectId, Decimal128
 from motor.motor_asyncio import AsyncIOMotorClient
-from nextcord import BaseApplicationCommand
+from pymongo import ReturnDocument, ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
 from nextcord.ext.commands import Cog
 from nextcord.user import User
 
 from bot import AlisUnnamedBot
+from extensions.core.cache import TTLCache, MISSING
+from extensions.core.invalidation import InvalidationBus
+from extensions.core.loot import LootTables, AliasTable
+from extensions.core.order_book import OrderBooks, OrderBook, Order, Fill, BUY, SELL
+from extensions.core.search import PrefixIndex, MAX_AUTOCOMPLETE_CHOICES
+from extensions.core.write_buffer import WriteBehindBuffer, InsertBuffer, CallbackBuffer
 
 
 # Inventory locations
 HOME: int = 0
 BAG: int = 1
 
+# Types of ledger entries
+PAYMENT: str = "payment"
+DEPOSIT: str = "deposit"
+WITHDRAWAL: str = "withdrawal"
+TRADE: str = "trade"
+MARKET: str = "market"
+
+# States of market orders
+OPEN: str = "open"
+FILLED: str = "filled"
+CANCELLED: str = "cancelled"
+
+# Monotonic time by which the application command currently being handled should be finished, if there is one
+# Set by AlisUnnamedBotCog before each command is invoked, and used to limit how long queries may run
+command_deadline: ContextVar[Optional[float]] = ContextVar("command_deadline", default=None)
+
+# Queries are always allowed at least this long, so a command that is nearly out of time can still finish
+MIN_QUERY_TIME_MS: int = 50
+
+
+# Raised when a user's balance keeps being changed by something else while trying to update it
+class BalanceUpdateConflictError(Exception):
+    def __init__(self, user_id: int):
+        super().__init__(f"Gave up updating the balance of user {user_id} after too many conflicting updates")
+        self.user_id = user_id
+
+
+# Raised when a trade can't be made because something changed since it was offered, aborting the trade's transaction
+# reason is what changed: WALLET if the user no longer has the currency they offered, ITEMS if they no longer have the
+# items they offered, or MAX_UNIQUE_ITEMS if the user would end up with too many of a unique item
+class TradeConflictError(Exception):
+    WALLET = "wallet"
+    ITEMS = "items"
+    MAX_UNIQUE_ITEMS = "max_unique_items"
+
+    def __init__(self, user_id: int, reason: str):
+        super().__init__(f"Trade aborted, since user {user_id} failed the '{reason}' check")
+        self.user_id = user_id
+        self.reason = reason
+
+
+# What one user gives in a trade: money from their wallet, and amount of an item from their home inventory
+# For unique items, user_item_ids are the specific items given, which are chosen when the trade is offered
+class TradeSide:
+    def __init__(self, user_id: int, money: Decimal = Decimal("0"), item_id: Optional[ObjectId] = None,
+                 amount: int = 0, user_item_ids: Optional[list[ObjectId]] = None):
+        self.user_id = user_id
+        self.money = money
+        self.item_id = item_id
+        self.amount = amount
+        self.user_item_ids = user_item_ids
+
+    def is_empty(self) -> bool:
+        return self.money <= 0 and (self.item_id is None or self.amount < 1)
+
+
+# Raised when a user doesn't have the currency (WALLET) or items (ITEMS) a market order needs to be held in escrow
+class OrderEscrowError(Exception):
+    WALLET = "wallet"
+    ITEMS = "items"
+
+    def __init__(self, user_id: int, reason: str):
+        super().__init__(f"Market order of user {user_id} failed the '{reason}' check")
+        self.user_id = user_id
+        self.reason = reason
+
+
+# Raised when the orders in the database don't match the order books, such as when another process has changed them
+class OrderBookConflictError(Exception):
+    def __init__(self, order_ids: list[ObjectId]):
+        super().__init__(f"Orders {', '.join(str(order_id) for order_id in order_ids)} don't match the order books")
+        self.order_ids = order_ids
+
 
 # Cog to handle database services
 class DatabaseCog(Cog):
     def __init__(self, bot: AlisUnnamedBot, client: AsyncIOMotorClient):
         self.bot = bot
         self.client = client
+        self.transactions_supported: Optional[bool] = None  # Found out when first needed
         self.db = client[environ["DB_DATABASE"]]
+        self.item_index = PrefixIndex()  # Index of item names, used to autocomplete ItemSlashOptions
+        # Maps user ids to the items they own at each location, used to autocomplete items a user owns
+        self.owned_items_cache = TTLCache(bot.config.get("owned_items_cache_ttl", 60))
+        self.loot_tables = LootTables()  # Built from the items catalog when first needed
+        self.loot_tables_version = 0  # Incremented whenever the catalog changes
+        self.loot_tables_built_version: Optional[int] = None  # The catalog version the loot tables were built from
+        self.loot_tables_lock = asyncio.Lock()
+
+        # Invalidates the caches above when another bot process changes the documents they are derived from
+        self.invalidation_bus = InvalidationBus(bot, self.db)
+        self.invalidation_bus.register("users", "owned_items_cache", self.owned_items_cache.invalidate)
+        self.invalidation_bus.register("items", "item_index", self.refresh_indexed_item)
+        self.invalidation_bus.register("items", "loot_tables", self.invalidate_loot_tables)
+        self.invalidation_bus.register("itemTypes", "loot_tables", self.invalidate_loot_tables)
+        self.invalidation_bus.start()
+
+        # Buffers $inc deltas to eventually consistent users fields, such as activity counters
+        write_buffer = bot.config.get("write_buffer", {})
+        self.users_write_buffer = WriteBehindBuffer(bot, self.db.users, "users",
+                                                    write_buffer.get("flush_interval_ms", 1000),
+                                                    write_buffer.get("max_pending_users", 500))
+        self.users_write_buffer.start()
+        # Buffers ledger entries, so recording them doesn't slow down commands
+        self.ledger_buffer = InsertBuffer(bot, self.db.ledger, "ledger",
+                                          write_buffer.get("flush_interval_ms", 1000),
+                                          write_buffer.get("max_pending_ledger_entries", 500))
+        self.ledger_buffer.start()
+
+        # Market orders are matched in memory, in an order book per item, rebuilt from open orders by
+        # load_order_books(). Fills are buffered and written in batches, each in a single transaction.
+        self.order_books = OrderBooks()
+        self.order_books_stale = True
+        self.market_lock = asyncio.Lock()
+        self.fills_buffer = CallbackBuffer(bot, "fills", self.write_fills, self.invalidate_order_books,
+                                           write_buffer.get("flush_interval_ms", 1000),
+                                           write_buffer.get("max_pending_fills", 500))
+        self.fills_buffer.start()
+        # Only one process matches orders. The others write theirs, and any cancels, to the orders collection for it
+        # to pick up, and tell it over the invalidation bus. It also checks for them every so often, in case it missed
+        # being told, such as while the bus was reconnecting.
+        self.owns_market = bot.owns_market
+        self.market_requests = asyncio.Event()
+        self.market_task: Optional[asyncio.Task] = None
+        if self.owns_market:
+            self.invalidation_bus.register("orders", "market_requests", self.notify_market_requests)
+            self.market_task = asyncio.create_task(
+                self.run_market_requests(bot.config.get("market", {}).get("request_check_seconds", 30)))
+
+    # Creates collections that need options or indexes, if they don't exist yet
+    async def ensure_collections(self):
+        # The ledger is an ordinary collection, not a time series one, since time series collections have no unique
+        # _id index, and the ledger buffer relies on it so that a retried insert can't record an entry twice
+        if await self.db.list_collection_names(filter={"name": "ledger", "type": "timeseries"}):
+            self.bot.logger.warning("The ledger is a time series collection, so retried inserts may record entries "
+                                    "twice. Copy it into an ordinary collection to fix this.")
+        await self.db.ledger.create_index([("userId", ASCENDING), ("ts", DESCENDING)])
+        await self.db.orders.create_index([("status", ASCENDING), ("_id", ASCENDING)])
+        await self.db.orders.create_index([("userId", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)])
+        await self.db.orders.create_index([("itemId", ASCENDING), ("status", ASCENDING)])
+        # Few orders are waiting on the process that owns the market, so these indexes are sparse
+        await self.db.orders.create_index([("queued", ASCENDING)], sparse=True)
+        await self.db.orders.create_index([("cancelRequested", ASCENDING)], sparse=True)
+
+    # Writes any buffered writes, must be awaited before close_connection() so they aren't lost
+    async def flush_writes(self):
+        if self.market_task:
+            # Matching queued orders adds fills, so stop first, waiting for any requests being handled to finish
+            async with self.market_lock:
+                self.market_task.cancel()
+                self.market_task = None
+        # Fills record ledger entries, so they are written first
+        await self.fills_buffer.stop()
+        await self.users_write_buffer.stop()
+        await self.ledger_buffer.stop()
 
     def close_connection(self):
+        self.invalidation_bus.stop()
         self.bot.logger.info("Closing MongoDB client...")
         self.client.close()
 
+    # Returns keyword arguments that limit how long a query may run, based on the current command's deadline
+    # key should be "max_time_ms" for find() and find_one(), or "maxTimeMS" for aggregate()
+    @staticmethod
+    def time_limit(key: str = "max_time_ms") -> dict:
+        deadline = command_deadline.get()
+        if deadline is None:
+            return {}
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        return {key: max(remaining_ms, MIN_QUERY_TIME_MS)}
+
     @staticmethod
     def convert_decimal128_fields_to_decimal(obj):
         if obj is None: return
@@ -44,34 +215,49 @@ class DatabaseCog(Cog):
 
         return obj
 
-    # Returns a dictionary mapping item names to item ids
-    async def get_item_choices(self) -> dict:
+    # Updates the item index with any changes made to the items catalog
+    # Only items that were added, renamed or removed since the last refresh change the index
+    async def refresh_item_index(self):
         cursor = self.db.items.find(
             {},
             {
                 "_id": 1,
-                "single": 1  # Use the singular name, not the plural name
-            }
+                "single": 1,
+                "plural": 1
+            },
+            **self.time_limit()
         )
-        choices = {}
+        item_ids = set()
         async for item in cursor:
             item_id = item.get("_id")
-            item_name = item.get("single")
-            if item_name and item_id:
-                # ObjectId is not json serializable, so convert it to a string
-                choices[item_name] = str(item_id)
+            # Use the singular name as the label, but allow searching by either name
+            self.item_index.set(item_id, [item.get("single"), item.get("plural")])
+            item_ids.add(item_id)
+        for item_id in set(self.item_index.keys) - item_ids:
+            self.item_index.remove(item_id)
+
+    # Updates a single item in the item index, such as after another process changes it
+    async def refresh_indexed_item(self, item_id: ObjectId):
+        item = await self.db.items.find_one({"_id": item_id}, {"_id": 1, "single": 1, "plural": 1})
+        if item:
+            self.item_index.set(item_id, [item.get("single"), item.get("plural")])
+        else:
+            self.item_index.remove(item_id)
+
+    # Returns a dictionary mapping the names of items starting with prefix to item ids, for use in autocomplete
+    def search_items(self, prefix: str) -> dict[str, str]:
+        choices = {}
+        for item_id in self.item_index.search(prefix):
+            # ObjectId is not json serializable, so convert it to a string
+            choices[self.item_index.labels[item_id]] = str(item_id)
         return choices
 
-    # Sets the choices for any ItemSlashOptions that appear in application commands
-    async def setup_item_slash_option_choices(self):
-        commands: Set[BaseApplicationCommand] = self.bot.get_all_application_commands()
-        for command in commands:
-            for name, option in command.options.items():
-                if name == "item":
-                    option.choices = await self.get_item_choices()
+    # Returns the id of the item with a singular or plural name matching name, if there is one
+    def find_item(self, name: str) -> Optional[ObjectId]:
+        return self.item_index.find(name)
 
     async def user_exists(self, user: User) -> bool:
-        return await self.db.users.find_one({"_id": user.id}) is not None
+        return await self.db.users.find_one({"_id": user.id}, **self.time_limit()) is not None
 
     async def add_user(self, user: User) -> [int, int]:
         wallet = self.bot.config.get("new_user_wallet", 0)
@@ -84,10 +270,48 @@ class DatabaseCog(Cog):
                 "wallet": Decimal128(Decimal(str(wallet)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)),
                 "bank": Decimal128("0.00"),
                 "bankCap": Decimal128(Decimal(str(bank_capacity)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)),
+                "commandsUsed": 0,
+                "messagesSent": 0,
+                "version": 0,  # Incremented whenever the user document changes
+                "inventoryVersion": 0  # Incremented whenever the user's items change
             }
         )
         return wallet, bank_capacity
 
+    # Returns the user's document and inventory versions, or None if the user does not exist
+    # These can be used as part of a cache key for anything derived from the user's data
+    async def get_user_versions(self, user: User) -> Optional[dict]:
+        result = await self.db.users.find_one(
+            {
+                "_id": user.id
+            },
+            {
+                "_id": 0,
+                "version": 1,
+                "inventoryVersion": 1
+            },
+            **self.time_limit()
+        )
+        if result is None:
+            return None
+        return {
+            "version": result.get("version", 0),
+            "inventoryVersion": result.get("inventoryVersion", 0)
+        }
+
+    # Must be called whenever a user's items change, so anything cached for the old inventory isn't used
+    async def bump_user_inventory_version(self, user_id: int):
+        await self.db.users.update_one(
+            {
+                "_id": user_id
+            },
+            {
+                "$inc": {
+                    "inventoryVersion": 1
+                }
+            }
+        )
+
     async def get_user_profile(self, user: User) -> dict:
         result = await self.db.users.find_one(
             {
@@ -98,7 +322,8 @@ class DatabaseCog(Cog):
                 "level": 1,
                 "wallet": 1,
                 "bank": 1
-            }
+            },
+            **self.time_limit()
         )
         return self.convert_decimal128_fields_to_decimal(result)
 
@@ -111,6 +336,48 @@ class DatabaseCog(Cog):
                 "_id": 0,
                 "level": 1,
                 "exp": 1
+            },
+            **self.time_limit()
+        )
+
+    # Adds amount to the user's exp, and returns the user's level and new exp, or None if the user doesn't exist
+    async def add_user_exp(self, user: User, amount: int) -> Optional[dict]:
+        return await self.db.users.find_one_and_update(
+            {
+                "_id": user.id
+            },
+            {
+                "$inc": {
+                    "exp": amount
+                }
+            },
+            projection={
+                "_id": 0,
+                "level": 1,
+                "exp": 1
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+    # Adds deltas, such as {"messagesSent": 1}, to the user's fields eventually, rather than writing them now
+    # Only for fields that don't need to be read back straight away, since writes are buffered for a while
+    def increment_user_counters(self, user_id: int, deltas: dict[str, int]):
+        self.users_write_buffer.increment(user_id, deltas)
+
+    # Raises the user's level to level, but never lowers it, so concurrent level ups can't undo each other
+    async def raise_user_level(self, user: User, level: int):
+        return await self.db.users.update_one(
+            {
+                "_id": user.id,
+                "level": {"$lt": level}
+            },
+            {
+                "$set": {
+                    "level": level
+                },
+                "$inc": {
+                    "version": 1
+                }
             }
         )
 
@@ -123,11 +390,168 @@ class DatabaseCog(Cog):
                 "_id": 0,
                 "wallet": 1,
                 "bank": 1,
-                "bankCap": 1
-            }
+                "bankCap": 1,
+                "version": 1
+            },
+            **self.time_limit()
         )
         return self.convert_decimal128_fields_to_decimal(result)
 
+    # Updates the user's wallet and bank using compare-and-swap on the user's version, so concurrent updates
+    # can't overwrite each other. update is given the current balance and must return the new wallet and bank,
+    # or raise an error to abort. If the user's version changes before the update is written, the balance is
+    # read again and update is retried, up to "balance_update_retries" times.
+    # Returns the balance before and after the update.
+    async def update_user_balance(self, user: User,
+                                  update: Callable[[dict], tuple[Decimal, Decimal]]) -> tuple[dict, dict]:
+        max_retries = self.bot.config.get("balance_update_retries", 5)
+        for attempt in range(max_retries + 1):
+            balance = await self.get_user_balance(user)
+            new_wallet, new_bank = update(balance)
+            version = balance.get("version")
+            result = await self.db.users.update_one(
+                {
+                    "_id": user.id,
+                    # Users created before versions were added don't have a version yet
+                    "version": version if version is not None else {"$exists": False}
+                },
+                {
+                    "$set": {
+                        "wallet": Decimal128(new_wallet),
+                        "bank": Decimal128(new_bank)
+                    },
+                    "$inc": {
+                        "version": 1
+                    }
+                }
+            )
+            if result.modified_count:
+                new_balance = balance.copy()
+                new_balance.update(wallet=new_wallet, bank=new_bank, version=(version or 0) + 1)
+                return balance, new_balance
+            self.bot.metrics.increment("balance_update.retries")
+            # Back off a little, so conflicting updates are less likely to collide again
+            await asyncio.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+        self.bot.metrics.increment("balance_update.aborts")
+        raise BalanceUpdateConflictError(user.id)
+
+    # Adds amount to the user's wallet, and returns the new wallet
+    # This doesn't depend on the current balance, so it is applied atomically without compare-and-swap
+    async def add_to_user_wallet(self, user: User, amount: Decimal) -> Decimal:
+        result = await self.db.users.find_one_and_update(
+            {
+                "_id": user.id
+            },
+            {
+                "$inc": {
+                    "wallet": Decimal128(amount),
+                    "version": 1
+                }
+            },
+            projection={
+                "_id": 0,
+                "wallet": 1
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        return self.convert_decimal128_fields_to_decimal(result).get("wallet")
+
+    # Returns whether the server supports transactions, which need MongoDB to be running as a replica set (or behind
+    # mongos), rather than as a standalone server
+    async def supports_transactions(self) -> bool:
+        if self.transactions_supported is None:
+            hello = await self.client.admin.command("hello")
+            self.transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+            if not self.transactions_supported:
+                self.bot.logger.warning("MongoDB isn't running as a replica set, so payments are made without "
+                                        "transactions, and trades and the market won't work")
+        return self.transactions_supported
+
+    # Moves amount from the sender's wallet to the recipient's wallet in a single transaction, so the money can't be
+    # taken from the sender without reaching the recipient. The sender's wallet is guarded, rather than compared and
+    # swapped, so the transfer only fails if the sender no longer has amount.
+    # Without transactions, the sender is debited then the recipient credited, and if the credit fails the sender is
+    # credited back instead.
+    # Returns the sender's and recipient's new wallets, or None if the sender doesn't have amount
+    async def transfer_between_wallets(self, sender: User, recipient: User,
+                                       amount: Decimal) -> Optional[tuple[Decimal, Decimal]]:
+        async def debit(session=None) -> Optional[dict]:
+            return await self.db.users.find_one_and_update(
+                {
+                    "_id": sender.id,
+                    "wallet": {"$gte": Decimal128(amount)}
+                },
+                {
+                    "$inc": {
+                        "wallet": Decimal128(-amount),
+                        "version": 1
+                    }
+                },
+                projection={
+                    "_id": 0,
+                    "wallet": 1
+                },
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+
+        async def credit(session=None) -> Optional[dict]:
+            return await self.db.users.find_one_and_update(
+                {
+                    "_id": recipient.id
+                },
+                {
+                    "$inc": {
+                        "wallet": Decimal128(amount),
+                        "version": 1
+                    }
+                },
+                projection={
+                    "_id": 0,
+                    "wallet": 1
+                },
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+
+        async def transfer(session) -> Optional[tuple[Decimal, Decimal]]:
+            sender_result = await debit(session)
+            if sender_result is None:
+                return None
+            recipient_result = await credit(session)
+            if recipient_result is None:
+                # Abort, so the sender's money isn't taken without anyone receiving it
+                raise BalanceUpdateConflictError(recipient.id)
+            return sender_result.get("wallet").to_decimal(), recipient_result.get("wallet").to_decimal()
+
+        async def transfer_without_transaction() -> Optional[tuple[Decimal, Decimal]]:
+            sender_result = await debit()
+            if sender_result is None:
+                return None
+            try:
+                recipient_result = await credit()
+            except PyMongoError:
+                await self.add_to_user_wallet(sender, amount)
+                raise
+            if recipient_result is None:
+                await self.add_to_user_wallet(sender, amount)
+                raise BalanceUpdateConflictError(recipient.id)
+            return sender_result.get("wallet").to_decimal(), recipient_result.get("wallet").to_decimal()
+
+        start = time.perf_counter()
+        balances = None
+        try:
+            if await self.supports_transactions():
+                async with await self.client.start_session() as session:
+                    balances = await session.with_transaction(transfer)
+            else:
+                balances = await transfer_without_transaction()
+        finally:
+            # Transfers that don't commit are timed separately, so they don't skew how long commits take
+            timer = "wallet_transfer.commit" if balances is not None else "wallet_transfer.abort"
+            self.bot.metrics.observe(timer, time.perf_counter() - start)
+        return balances
+
     async def set_user_wallet(self, user: User, new_wallet: Decimal):
         return await self.db.users.update_one(
             {
@@ -136,6 +560,9 @@ class DatabaseCog(Cog):
             {
                 "$set": {
                     "wallet": Decimal128(new_wallet)
+                },
+                "$inc": {
+                    "version": 1
                 }
             }
         )
@@ -148,20 +575,767 @@ class DatabaseCog(Cog):
             {
                 "$set": {
                     "bank": Decimal128(new_bank)
+                },
+                "$inc": {
+                    "version": 1
                 }
             }
         )
 
+    # ===========
+    # Bank Interest
+    # ===========
+
+    # Returns the _id of the last of the next size users after after_id, or None if there are fewer than size left
+    # Used to split the users collection into _id ranges, so each range can be updated by a separate update_many
+    async def get_users_chunk_end(self, after_id: Optional[int], size: int) -> Optional[int]:
+        cursor = self.db.users.find(
+            {"_id": {"$gt": after_id}} if after_id is not None else {},
+            {"_id": 1}
+        ).sort("_id", 1).skip(size - 1).limit(1)
+        result = await cursor.to_list(length=1)
+        return result[0].get("_id") if result else None
+
+    # Multiplies the bank of every user with an _id after after_id, up to and including until_id, by 1 + rate,
+    # without going over their bank capacity. Returns the number of users that were paid interest.
+    # Users are marked with run_id, so running the same chunk of the same run again won't pay interest twice.
+    async def apply_bank_interest(self, run_id: ObjectId, rate: Decimal,
+                                  after_id: Optional[int], until_id: Optional[int]) -> int:
+        id_range = {}
+        if after_id is not None:
+            id_range["$gt"] = after_id
+        if until_id is not None:
+            id_range["$lte"] = until_id
+        query = {
+            "interestRunId": {"$ne": run_id},
+            "$expr": {
+                "$and": [
+                    {"$gt": ["$bank", 0]},
+                    {"$lt": ["$bank", "$bankCap"]}
+                ]
+            }
+        }
+        if id_range:
+            query["_id"] = id_range
+        result = await self.db.users.update_many(
+            query,
+            [
+                {
+                    "$set": {
+                        "bank": {
+                            "$min": [
+                                {"$round": [{"$multiply": ["$bank", Decimal128(1 + rate)]}, 2]},
+                                "$bankCap"
+                            ]
+                        },
+                        "interestRunId": run_id,
+                        # Users created before versions were added don't have a version yet
+                        "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+                    }
+                }
+            ]
+        )
+        return result.modified_count
+
+    # ===========
+    # Job Runs
+    # ===========
+
+    # Returns the progress recorded for the job's current or last run, if there is one
+    async def get_job_run(self, job_name: str) -> Optional[dict]:
+        return await self.db.jobRuns.find_one({"_id": job_name})
+
+    # Records progress of the job's current run, so it can be resumed if the bot stops part way through
+    async def save_job_run(self, job_name: str, progress: dict):
+        await self.db.jobRuns.update_one(
+            {
+                "_id": job_name
+            },
+            {
+                "$set": progress
+            },
+            upsert=True
+        )
+
+    # ===========
+    # Ledger
+    # ===========
+
+    # Records that amount moved to or from the user, such as a DEPOSIT from their wallet to their bank
+    # Entries are buffered and inserted in batches, so they may take a moment to appear in the user's history
+    def record_transaction(self, user_id: int, transaction_type: str, amount: Decimal,
+                           counterparty_id: Optional[int] = None):
+        entry = {
+            "_id": ObjectId(),
+            "ts": datetime.now(timezone.utc),
+            "userId": user_id,
+            "type": transaction_type,
+            "amount": Decimal128(amount)
+        }
+        if counterparty_id is not None:
+            entry["counterpartyId"] = counterparty_id
+        self.ledger_buffer.insert(entry)
+
+    # Returns a page of the user's ledger entries, newest first, starting after the entry at after (its ts and _id),
+    # and whether there is a next page
+    async def get_user_transactions_page(self, user: User, after: Optional[tuple[datetime, ObjectId]] = None,
+                                         page_size: int = 15) -> tuple[list[dict], bool]:
+        query = {
+            "userId": user.id
+        }
+        if after is not None:
+            after_ts, after_id = after
+            query["$or"] = [
+                {"ts": {"$lt": after_ts}},
+                {"ts": after_ts, "_id": {"$lt": after_id}}
+            ]
+        # Fetch one extra entry to find out whether there is another page
+        cursor = self.db.ledger.find(query, {"userId": 0}, **self.time_limit()) \
+            .sort([("ts", DESCENDING), ("_id", DESCENDING)]).limit(page_size + 1)
+        entries = [self.convert_decimal128_fields_to_decimal(entry) async for entry in cursor]
+        return entries[:page_size], len(entries) > page_size
+
+    # ===========
+    # Trades
+    # ===========
+
+    # Moves what each side of a trade gives to the other user, in a single transaction, so either all of it moves or
+    # none of it does. Every write is guarded by a filter on what was offered, so if a user no longer has what they
+    # offered, the transaction is aborted and a TradeConflictError is raised, rather than anything being overdrawn.
+    # Transactions need MongoDB to be running as a replica set.
+    async def execute_trade(self, first: TradeSide, second: TradeSide):
+        attempts = 0
+
+        async def transfer(session):
+            nonlocal attempts
+            attempts += 1
+            await self.transfer_trade_side(first, second.user_id, session)
+            await self.transfer_trade_side(second, first.user_id, session)
+
+        start = time.perf_counter()
+        try:
+            async with await self.client.start_session() as session:
+                # Retries the whole transaction if it conflicts with another write to the same documents
+                await session.with_transaction(transfer)
+        except TradeConflictError:
+            # Aborted transactions are timed separately, so they don't skew how long commits take
+            self.bot.metrics.observe("trade.abort", time.perf_counter() - start)
+            self.bot.metrics.increment("trade.aborts")
+            raise
+        finally:
+            if attempts > 1:
+                self.bot.metrics.increment("trade.retries", attempts - 1)
+        self.bot.metrics.observe("trade.commit", time.perf_counter() - start)
+        self.bot.metrics.increment("trade.commits")
+
+        for side, receiver_id in ((first, second.user_id), (second, first.user_id)):
+            if side.money > 0:
+                self.record_transaction(side.user_id, TRADE, -side.money, receiver_id)
+                self.record_transaction(receiver_id, TRADE, side.money, side.user_id)
+        if first.item_id is not None or second.item_id is not None:
+            await self.invalidate_user_items(first.user_id)
+            await self.invalidate_user_items(second.user_id)
+
+    # Moves what side gives to the user with receiver_id, as part of a trade's transaction
+    async def transfer_trade_side(self, side: TradeSide, receiver_id: int, session):
+        if side.money > 0:
+            result = await self.db.users.update_one(
+                {
+                    "_id": side.user_id,
+                    "wallet": {"$gte": Decimal128(side.money)}
+                },
+                {
+                    "$inc": {
+                        "wallet": Decimal128(-side.money),
+                        "version": 1
+                    }
+                },
+                session=session
+            )
+            if not result.modified_count:
+                raise TradeConflictError(side.user_id, TradeConflictError.WALLET)
+            await self.db.users.update_one(
+                {
+                    "_id": receiver_id
+                },
+                {
+                    "$inc": {
+                        "wallet": Decimal128(side.money),
+                        "version": 1
+                    }
+                },
+                session=session
+            )
+
+        if side.item_id is None or side.amount < 1:
+            return
+        if side.user_item_ids is not None:
+            # Unique items change owner, but only if every one of them is still in the giver's home inventory
+            result = await self.db.userItems.update_many(
+                {
+                    "_id": {"$in": side.user_item_ids},
+                    "userId": side.user_id,
+                    "itemId": side.item_id,
+                    "location": HOME
+                },
+                {
+                    "$set": {
+                        "userId": receiver_id
+                    }
+                },
+                session=session
+            )
+            if result.modified_count != len(side.user_item_ids):
+                raise TradeConflictError(side.user_id, TradeConflictError.ITEMS)
+            owned = await self.db.userItems.count_documents({"userId": receiver_id, "itemId": side.item_id},
+                                                            session=session)
+            if owned > self.bot.config.get("max_unique_items"):
+                raise TradeConflictError(receiver_id, TradeConflictError.MAX_UNIQUE_ITEMS)
+        else:
+            result = await self.db.userItems.update_one(
+                {
+                    "userId": side.user_id,
+                    "itemId": side.item_id,
+                    "location": HOME,
+                    "quantity": {"$gte": side.amount}
+                },
+                {
+                    "$inc": {
+                        "quantity": -side.amount
+                    }
+                },
+                session=session
+            )
+            if not result.modified_count:
+                raise TradeConflictError(side.user_id, TradeConflictError.ITEMS)
+            # Don't leave an empty stack behind, just as set_user_item_quantity doesn't
+            await self.db.userItems.delete_one(
+                {
+                    "userId": side.user_id,
+                    "itemId": side.item_id,
+                    "location": HOME,
+                    "quantity": {"$lte": 0}
+                },
+                session=session
+            )
+            await self.db.userItems.update_one(
+                {
+                    "userId": receiver_id,
+                    "itemId": side.item_id,
+                    "location": HOME
+                },
+                {
+                    "$inc": {
+                        "quantity": side.amount
+                    }
+                },
+                upsert=True,
+                session=session
+            )
+
+    # ===========
+    # Market
+    # ===========
+
+    # Marks the order books as out of date, such as after a batch of fills failed to be written, so they are rebuilt
+    # from the orders collection before they are next used
+    def invalidate_order_books(self, _=None):
+        self.order_books_stale = True
+
+    # Rebuilds the order books from the open orders in the orders collection
+    async def load_order_books(self):
+        if not self.owns_market:
+            return  # Only the process that owns the market uses its order books
+        async with self.market_lock:
+            await self.reload_order_books()
+        # Handle anything other processes queued while this one wasn't running
+        self.notify_market_requests()
+
+    # Must be called with market_lock held
+    async def reload_order_books(self):
+        # Orders in the database must include every fill matched so far, or those fills would be matched again
+        await self.fills_buffer.flush()
+        order_books = OrderBooks()
+        fills = []
+        # Orders with a cancel requested are left out, so they can't be matched before the cancel is handled
+        cursor = self.db.orders.find({"status": OPEN, "cancelRequested": {"$exists": False}}).sort("_id", ASCENDING)
+        # Adding the orders in the order they were placed gives the same time priority they had before
+        async for document in cursor:
+            order = self.order_from_document(document)
+            # Orders only cross here if their fills were lost, such as when a batch of fills failed to be written
+            fills.extend(order_books.get(order.item_id).add(order))
+        self.order_books = order_books
+        self.order_books_stale = False
+        for fill in fills:
+            self.fills_buffer.add(fill)
+        self.bot.logger.info(f"Loaded {sum(len(book) for book in order_books.books.values())} open market orders")
+
+    def order_from_document(self, document: dict) -> Order:
+        document = self.convert_decimal128_fields_to_decimal(document)
+        return Order(document.get("_id"), document.get("userId"), document.get("itemId"), document.get("side"),
+                     document.get("price"), document.get("quantity"), document.get("remaining"))
+
+    # Returns the item's order book, rebuilding the order books first if they are out of date
+    # Other processes don't keep order books, so they read the item's open orders into one instead
+    async def get_order_book(self, item_id: ObjectId) -> OrderBook:
+        if not self.owns_market:
+            book = OrderBook()
+            cursor = self.db.orders.find({"itemId": item_id, "status": OPEN}, **self.time_limit()) \
+                .sort("_id", ASCENDING)
+            async for document in cursor:
+                book.rest(self.order_from_document(document))
+            return book
+        if self.order_books_stale:
+            await self.load_order_books()
+        return self.order_books.get(item_id)
+
+    # Places an order for the user to buy or sell quantity of a non-unique item at price each
+    # What the order could spend is held in escrow until it is filled or cancelled: price * quantity from the buyer's
+    # wallet, or quantity of the item from the seller's home inventory. The escrow and the order are written in one
+    # transaction, then the order is matched against the item's order book. In processes that don't own the market,
+    # the order is queued for the process that does to match instead, so it has no fills yet.
+    # Returns the order and its fills, or raises an OrderEscrowError if the user doesn't have what the order needs
+    async def place_order(self, user: User, item_id: ObjectId, side: str, price: Decimal,
+                          quantity: int) -> tuple[Order, list[Fill]]:
+        order = Order(ObjectId(), user.id, item_id, side, price, quantity)
+
+        async def escrow(session):
+            if side == BUY:
+                cost = Decimal128(price * quantity)
+                result = await self.db.users.update_one(
+                    {
+                        "_id": user.id,
+                        "wallet": {"$gte": cost}
+                    },
+                    {
+                        "$inc": {
+                            "wallet": Decimal128(-price * quantity),
+                            "version": 1
+                        }
+                    },
+                    session=session
+                )
+                if not result.modified_count:
+                    raise OrderEscrowError(user.id, OrderEscrowError.WALLET)
+            else:
+                result = await self.db.userItems.update_one(
+                    {
+                        "userId": user.id,
+                        "itemId": item_id,
+                        "location": HOME,
+                        "quantity": {"$gte": quantity}
+                    },
+                    {
+                        "$inc": {
+                            "quantity": -quantity
+                        }
+                    },
+                    session=session
+                )
+                if not result.modified_count:
+                    raise OrderEscrowError(user.id, OrderEscrowError.ITEMS)
+                await self.db.userItems.delete_one(
+                    {
+                        "userId": user.id,
+                        "itemId": item_id,
+                        "location": HOME,
+                        "quantity": {"$lte": 0}
+                    },
+                    session=session
+                )
+            document = {
+                "_id": order.order_id,
+                "userId": user.id,
+                "itemId": item_id,
+                "side": side,
+                "price": Decimal128(price),
+                "quantity": quantity,
+                "remaining": quantity,
+                "status": OPEN,
+                "createdAt": datetime.now(timezone.utc)
+            }
+            if not self.owns_market:
+                document["queued"] = True
+            await self.db.orders.insert_one(document, session=session)
+
+        if not self.owns_market:
+            async with await self.client.start_session() as session:
+                await session.with_transaction(escrow)
+            if side == SELL:
+                await self.invalidate_user_items(user.id)
+            self.invalidation_bus.publish("orders", order.order_id)
+            self.bot.metrics.increment("market.orders")
+            self.bot.metrics.increment("market.queued")
+            return order, []
+
+        # Held while the order is written, so the books can't be rebuilt without it, and orders are matched in the
+        # same order they were placed
+        async with self.market_lock:
+            if self.order_books_stale:
+                await self.reload_order_books()
+            async with await self.client.start_session() as session:
+                await session.with_transaction(escrow)
+            if side == SELL:
+                await self.invalidate_user_items(user.id)
+            fills = self.order_books.get(item_id).add(order)
+        for fill in fills:
+            self.fills_buffer.add(fill)
+        self.bot.metrics.increment("market.orders")
+        self.bot.metrics.increment("market.fills", len(fills))
+        return order, fills
+
+    # Cancels the user's open order, returning what is left of its escrow to them
+    # In processes that don't own the market, the cancel is requested from the process that does instead, so it takes
+    # a moment, and any fills matched in the meantime still happen
+    # Returns the order, or None if the user has no open order with order_id
+    # Raises an OrderBookConflictError if the order has changed in the database, after which the books are rebuilt
+    async def cancel_order(self, user: User, order_id: ObjectId) -> Optional[Order]:
+        document = await self.db.orders.find_one({"_id": order_id, "userId": user.id, "status": OPEN},
+                                                 **self.time_limit())
+        if document is None:
+            return None
+
+        if not self.owns_market:
+            result = await self.db.orders.update_one(
+                {
+                    "_id": order_id,
+                    "userId": user.id,
+                    "status": OPEN
+                },
+                {
+                    "$set": {
+                        "cancelRequested": True
+                    }
+                }
+            )
+            if not result.matched_count:
+                return None  # Filled since it was looked up
+            self.invalidation_bus.publish("orders", order_id)
+            return self.order_from_document(document)
+
+        async with self.market_lock:
+            # Write pending fills first, so the order's remaining quantity in the database is up to date
+            await self.fills_buffer.flush()
+            if self.order_books_stale:
+                await self.reload_order_books()
+            order = self.order_books.get(document.get("itemId")).orders.get(order_id)
+            if order is None:
+                return None  # Filled since it was looked up
+            await self.cancel_open_order(order)
+            return order
+
+    # Cancels the open order, in the database and the order books, returning what is left of its escrow to its user
+    # Must be called with market_lock held, after writing pending fills, so order.remaining matches the database
+    async def cancel_open_order(self, order: Order):
+        order_id = order.order_id
+        user_id = order.user_id
+
+        async def refund(session):
+            result = await self.db.orders.update_one(
+                {
+                    "_id": order_id,
+                    "status": OPEN,
+                    "remaining": order.remaining
+                },
+                {
+                    "$set": {
+                        "status": CANCELLED
+                    },
+                    "$unset": {
+                        "queued": "",
+                        "cancelRequested": ""
+                    }
+                },
+                session=session
+            )
+            if not result.modified_count:
+                raise OrderBookConflictError([order_id])
+            if order.side == BUY:
+                await self.db.users.update_one(
+                    {
+                        "_id": user_id
+                    },
+                    {
+                        "$inc": {
+                            "wallet": Decimal128(order.price * order.remaining),
+                            "version": 1
+                        }
+                    },
+                    session=session
+                )
+            else:
+                await self.db.userItems.update_one(
+                    {
+                        "userId": user_id,
+                        "itemId": order.item_id,
+                        "location": HOME
+                    },
+                    {
+                        "$inc": {
+                            "quantity": order.remaining
+                        }
+                    },
+                    upsert=True,
+                    session=session
+                )
+
+        try:
+            async with await self.client.start_session() as session:
+                await session.with_transaction(refund)
+        except OrderBookConflictError:
+            # The database doesn't match the book, so the book can't be trusted
+            self.invalidate_order_books()
+            raise
+        self.order_books.get(order.item_id).cancel(order_id)
+        if order.side == SELL:
+            await self.invalidate_user_items(user_id)
+        self.bot.metrics.increment("market.cancels")
+
+    # Called by the invalidation bus when an order changes, which may be another process queueing an order or
+    # requesting a cancel
+    def notify_market_requests(self, _=None):
+        self.market_requests.set()
+
+    async def run_market_requests(self, check_seconds: float):
+        while True:
+            try:
+                await asyncio.wait_for(self.market_requests.wait(), check_seconds)
+            except asyncio.TimeoutError:
+                pass
+            # Cleared before handling, so requests made while handling are handled next time round
+            self.market_requests.clear()
+            try:
+                await self.handle_market_requests()
+            except PyMongoError as error:
+                self.bot.logger.error(f"Failed to handle queued market orders: {error}")
+
+    # Cancels the orders other processes have requested to cancel, then matches the orders they have queued
+    async def handle_market_requests(self):
+        async with self.market_lock:
+            if self.order_books_stale:
+                await self.reload_order_books()
+            # An order matched in memory is still open in the database until its fills are written, so write them
+            # first, or an order that has already been filled could be found below and matched again
+            await self.fills_buffer.flush()
+            if self.order_books_stale:
+                return  # Writing the fills failed, so try again once the books have been rebuilt
+
+            # Cancels are handled first, so an order that was queued, then cancelled, is never matched
+            cursor = self.db.orders.find({"status": OPEN, "cancelRequested": True})
+            async for document in cursor:
+                # Orders that are still queued aren't in the books yet
+                order = self.order_books.get(document.get("itemId")).orders.get(document.get("_id")) or \
+                    self.order_from_document(document)
+                try:
+                    await self.cancel_open_order(order)
+                except OrderBookConflictError:
+                    return  # The cancel stays requested, so it is tried again once the books have been rebuilt
+
+            cursor = self.db.orders.find({"status": OPEN, "queued": True}).sort("_id", ASCENDING)
+            orders = [self.order_from_document(document) async for document in cursor]
+            if not orders:
+                return
+            # Unqueued before they are matched, so if this process stops before writing their fills, they are
+            # matched again when the books are next rebuilt, rather than by a later call adding them twice
+            await self.db.orders.update_many({"_id": {"$in": [order.order_id for order in orders]}},
+                                             {"$unset": {"queued": ""}})
+            fills = []
+            for order in orders:
+                book = self.order_books.get(order.item_id)
+                # The order is already in the books if they were rebuilt after it was queued
+                if order.order_id not in book.orders:
+                    fills.extend(book.add(order))
+            for fill in fills:
+                self.fills_buffer.add(fill)
+        self.bot.metrics.increment("market.fills", len(fills))
+
+    # Returns a page of the user's open orders, oldest first, starting after the order with _id after
+    # Remaining quantities may not include the most recent fills, which are written in batches
+    async def get_user_open_orders_page(self, user: User, after: ObjectId = None,
+                                        page_size: int = 15) -> tuple[list[dict], bool]:
+        query = {
+            "userId": user.id,
+            "status": OPEN
+        }
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        cursor = self.db.orders.find(query, **self.time_limit()).sort("_id", ASCENDING).limit(page_size + 1)
+        orders = [self.convert_decimal128_fields_to_decimal(order) async for order in cursor]
+        return orders[:page_size], len(orders) > page_size
+
+    # Returns a dictionary mapping descriptions of the user's open orders, starting with prefix, to their ids,
+    # for use in autocomplete
+    async def search_user_open_orders(self, user: User, prefix: str) -> dict[str, str]:
+        cursor = self.db.orders.find({"userId": user.id, "status": OPEN}, **self.time_limit()).sort("_id", ASCENDING)
+        choices = {}
+        async for order in cursor:
+            order = self.convert_decimal128_fields_to_decimal(order)
+            name = await self.get_item_name(order.get("itemId"), order.get("remaining"))
+            label = f"{order.get('side').title()} {order.get('remaining')} {name} at {order.get('price')}"
+            if label.lower().startswith(prefix.lower()):
+                choices[label] = str(order.get("_id"))
+            if len(choices) >= MAX_AUTOCOMPLETE_CHOICES:
+                break
+        return choices
+
+    # Writes a batch of fills in a single transaction: the orders' remaining quantities, currency to each seller,
+    # items to each buyer, and a refund to buyers who were filled below their price. Writes to the same document are
+    # combined, so each document is written once per batch. Every order's remaining quantity is guarded, so if the
+    # database doesn't match the books, the whole batch is aborted and the books are rebuilt.
+    async def write_fills(self, fills: list[Fill]):
+        filled: dict[ObjectId, int] = {}  # Maps order ids to the quantity filled
+        wallets: dict[int, Decimal] = {}  # Maps user ids to the currency they receive
+        items: dict[tuple[int, ObjectId], int] = {}  # Maps user ids and item ids to the quantity they receive
+        for fill in fills:
+            buy_order, sell_order = fill.buy_order, fill.sell_order
+            filled[buy_order.order_id] = filled.get(buy_order.order_id, 0) + fill.quantity
+            filled[sell_order.order_id] = filled.get(sell_order.order_id, 0) + fill.quantity
+            wallets[sell_order.user_id] = wallets.get(sell_order.user_id, Decimal("0")) + fill.price * fill.quantity
+            refund = (buy_order.price - fill.price) * fill.quantity
+            if refund > 0:
+                wallets[buy_order.user_id] = wallets.get(buy_order.user_id, Decimal("0")) + refund
+            key = (buy_order.user_id, buy_order.item_id)
+            items[key] = items.get(key, 0) + fill.quantity
+
+        order_writes = [UpdateOne({"_id": order_id, "status": OPEN, "remaining": {"$gte": quantity}}, [
+            {"$set": {"remaining": {"$subtract": ["$remaining", quantity]}}},
+            {"$set": {"status": {"$cond": [{"$gt": ["$remaining", 0]}, OPEN, FILLED]}}}
+        ]) for order_id, quantity in filled.items()]
+        user_writes = [UpdateOne({"_id": user_id}, {"$inc": {"wallet": Decimal128(amount), "version": 1}})
+                       for user_id, amount in wallets.items()]
+        item_writes = [UpdateOne({"userId": user_id, "itemId": item_id, "location": HOME},
+                                 {"$inc": {"quantity": quantity}}, upsert=True)
+                       for (user_id, item_id), quantity in items.items()]
+
+        async def write(session):
+            result = await self.db.orders.bulk_write(order_writes, ordered=False, session=session)
+            if result.modified_count != len(order_writes):
+                raise OrderBookConflictError(list(filled))
+            if user_writes:
+                await self.db.users.bulk_write(user_writes, ordered=False, session=session)
+            await self.db.userItems.bulk_write(item_writes, ordered=False, session=session)
+
+        start = time.perf_counter()
+        try:
+            async with await self.client.start_session() as session:
+                await session.with_transaction(write)
+        finally:
+            self.bot.metrics.observe("market.fills.commit", time.perf_counter() - start)
+
+        for fill in fills:
+            amount = fill.price * fill.quantity
+            self.record_transaction(fill.buy_order.user_id, MARKET, -amount, fill.sell_order.user_id)
+            self.record_transaction(fill.sell_order.user_id, MARKET, amount, fill.buy_order.user_id)
+        for user_id in {user_id for user_id, _ in items}:
+            await self.invalidate_user_items(user_id)
+
+    # ===========
+    # Economy Rollups
+    # ===========
+
+    # Returns the total of every user's wallet and bank, the number of users, and the total wealth (wallet + bank)
+    # of a user at each of percentiles (such as 0.5 for the median), in a single pass over users where possible
+    async def get_wealth_stats(self, percentiles: list[float]) -> dict:
+        total = {"$add": ["$wallet", "$bank"]}
+        group = {
+            "_id": None,
+            "wallet": {"$sum": "$wallet"},
+            "bank": {"$sum": "$bank"},
+            "users": {"$sum": 1}
+        }
+        try:
+            cursor = self.db.users.aggregate([
+                {
+                    "$group": {
+                        **group,
+                        "percentiles": {"$percentile": {"input": total, "p": percentiles, "method": "approximate"}}
+                    }
+                }
+            ])
+            result = await cursor.to_list(length=1)
+            stats = result[0] if result else {"wallet": Decimal128("0"), "bank": Decimal128("0"), "users": 0,
+                                              "percentiles": [0] * len(percentiles)}
+            # $percentile returns doubles, so round them back to currency values
+            stats["percentiles"] = [Decimal(str(value)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+                                    for value in stats.get("percentiles")]
+        except OperationFailure:
+            # $percentile needs MongoDB 7.0, otherwise find each percentile by sorting users by wealth
+            result = await self.db.users.aggregate([{"$group": group}]).to_list(length=1)
+            stats = result[0] if result else {"wallet": Decimal128("0"), "bank": Decimal128("0"), "users": 0}
+            stats["percentiles"] = []
+            for percentile in percentiles:
+                index = min(int(percentile * stats.get("users")), max(stats.get("users") - 1, 0))
+                cursor = self.db.users.aggregate([
+                    {"$project": {"total": total}},
+                    {"$sort": {"total": 1}},
+                    {"$skip": index},
+                    {"$limit": 1}
+                ], allowDiskUse=True)
+                user = await cursor.to_list(length=1)
+                stats["percentiles"].append(user[0].get("total") if user else Decimal128("0"))
+        stats.pop("_id", None)
+        return self.convert_decimal128_fields_to_decimal(stats)
+
+    # Returns totals of the ledger entries from start until end: the volume and number of payments, the volume of
+    # deposits and withdrawals, and the number of users with at least one entry
+    async def get_ledger_summary(self, start: datetime, end: datetime) -> dict:
+        cursor = self.db.ledger.aggregate([
+            {
+                "$match": {
+                    "ts": {"$gte": start, "$lt": end}
+                }
+            },
+            {
+                "$facet": {
+                    "volumes": [
+                        {
+                            "$group": {
+                                "_id": "$type",
+                                # Payments have an entry for each side, so only count what was received
+                                "volume": {"$sum": {"$cond": [{"$gt": ["$amount", 0]}, "$amount", 0]}},
+                                "count": {"$sum": {"$cond": [{"$gt": ["$amount", 0]}, 1, 0]}}
+                            }
+                        }
+                    ],
+                    "activeUsers": [
+                        {"$group": {"_id": "$userId"}},
+                        {"$count": "count"}
+                    ]
+                }
+            }
+        ], allowDiskUse=True)
+        result = await cursor.to_list(length=1)
+        volumes = {volume.get("_id"): volume for volume in result[0].get("volumes")} if result else {}
+        active_users = result[0].get("activeUsers") if result else []
+        summary = {
+            "transferVolume": volumes.get(PAYMENT, {}).get("volume", Decimal128("0")),
+            "transfers": volumes.get(PAYMENT, {}).get("count", 0),
+            "depositVolume": volumes.get(DEPOSIT, {}).get("volume", Decimal128("0")),
+            "withdrawalVolume": volumes.get(WITHDRAWAL, {}).get("volume", Decimal128("0")),
+            "activeUsers": active_users[0].get("count") if active_users else 0
+        }
+        return self.convert_decimal128_fields_to_decimal(summary)
+
+    # Saves the rollup for the day starting at day, replacing any rollup already saved for it
+    async def save_economy_rollup(self, day: datetime, rollup: dict):
+        await self.db.economyRollups.replace_one({"_id": day}, rollup, upsert=True)
+
+    # Returns the most recent daily rollups, newest first
+    async def get_economy_rollups(self, limit: int) -> list[dict]:
+        cursor = self.db.economyRollups.find({}, **self.time_limit()).sort("_id", DESCENDING).limit(limit)
+        return [self.convert_decimal128_fields_to_decimal(rollup) async for rollup in cursor]
+
     # ===========
     # Item Types
     # ===========
 
     async def get_item_type_name(self, item_type_id: ObjectId) -> Optional[str]:
-        result = await self.db.itemTypes.find_one({"_id": item_type_id}, {"_id": 0, "name": 1})
+        result = await self.db.itemTypes.find_one({"_id": item_type_id}, {"_id": 0, "name": 1}, **self.time_limit())
         return result.get("name") if result else None
 
     async def get_item_type_properties(self, item_type_id: ObjectId) -> Optional[dict]:
-        result = await self.db.itemTypes.find_one({"_id": item_type_id}, {"_id": 0, "properties": 1})
+        result = await self.db.itemTypes.find_one({"_id": item_type_id}, {"_id": 0, "properties": 1},
+                                                  **self.time_limit())
         return result.get("properties") if result else None
 
     # ===========
@@ -170,29 +1344,29 @@ class DatabaseCog(Cog):
 
     # This is really just useful for debugging more than anything
     async def get_item_id(self, item_name: str) -> Optional[ObjectId]:
-        result = await self.db.items.find_one({"single": item_name}, {"_id": 1})
+        result = await self.db.items.find_one({"single": item_name}, {"_id": 1}, **self.time_limit())
         return result.get("_id") if result else None
 
     async def item_exists(self, item_id: ObjectId) -> bool:
-        return await self.db.items.find_one({"_id": item_id}) is not None
+        return await self.db.items.find_one({"_id": item_id}, **self.time_limit()) is not None
 
     async def get_item_single_name(self, item_id: ObjectId) -> Optional[str]:
-        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "single": 1})
+        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "single": 1}, **self.time_limit())
         return result.get("single") if result else None
 
     async def get_item_plural_name(self, item_id: ObjectId) -> Optional[str]:
-        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "plural": 1})
+        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "plural": 1}, **self.time_limit())
         return result.get("plural") if result else None
 
     async def get_item_name(self, item_id: ObjectId, amount: int = 1):
         return await self.get_item_single_name(item_id) if amount == 1 else await self.get_item_plural_name(item_id)
 
     async def get_item_type_id(self, item_id: ObjectId) -> Optional[ObjectId]:
-        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "itemTypeId": 1})
+        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "itemTypeId": 1}, **self.time_limit())
         return result.get("itemTypeId") if result else None
 
     async def item_is_unique(self, item_id: ObjectId) -> bool:
-        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "isUnique": 1})
+        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "isUnique": 1}, **self.time_limit())
         return result.get("isUnique") if result else False
 
     # Merges new_props onto old_props
@@ -218,19 +1392,109 @@ class DatabaseCog(Cog):
     async def get_item_properties(self, item_id: ObjectId) -> Optional[dict]:
         item_type_id = await self.get_item_type_id(item_id)
         item_type_properties = await self.get_item_type_properties(item_type_id)
-        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "properties": 1})
+        result = await self.db.items.find_one({"_id": item_id}, {"_id": 0, "properties": 1}, **self.time_limit())
         item_properties = result.get("properties") if result else None
         if item_type_properties and item_properties:
             return self.merge_properties(item_type_properties, item_properties)
         else:
             return item_properties if item_properties else item_type_properties
 
+    # ===========
+    # Loot Tables
+    # ===========
+
+    # Marks the loot tables as out of date, so they are rebuilt from the catalog the next time they are used
+    def invalidate_loot_tables(self, _=None):
+        self.loot_tables_version += 1
+
+    # Returns a dictionary mapping loot table names to item ids to weights, from the "loot" property of each item,
+    # merged onto the "loot" property of its item type
+    async def get_loot_weights(self) -> dict[str, dict[ObjectId, float]]:
+        cursor = self.db.items.aggregate([
+            {
+                "$lookup": {
+                    "from": "itemTypes",
+                    "localField": "itemTypeId",
+                    "foreignField": "_id",
+                    "as": "itemType"
+                }
+            },
+            {
+                "$project": {
+                    "itemLoot": "$properties.loot",
+                    "typeLoot": {"$arrayElemAt": ["$itemType.properties.loot", 0]}
+                }
+            },
+            {
+                "$match": {
+                    "$or": [{"itemLoot": {"$type": "object"}}, {"typeLoot": {"$type": "object"}}]
+                }
+            }
+        ])
+        weights = {}
+        async for item in cursor:
+            loot = self.merge_properties(item.get("typeLoot") or {}, item.get("itemLoot") or {})
+            for table_name, weight in loot.items():
+                if isinstance(weight, (int, float)):
+                    weights.setdefault(table_name, {})[item.get("_id")] = weight
+        return weights
+
+    # Returns the loot table called name, rebuilding the loot tables first if the catalog has changed
+    async def get_loot_table(self, name: str) -> Optional[AliasTable]:
+        if self.loot_tables_built_version != self.loot_tables_version:
+            async with self.loot_tables_lock:
+                # Callers waiting for the lock use the tables built while they waited, rather than rebuilding them
+                if self.loot_tables_built_version != self.loot_tables_version:
+                    version = self.loot_tables_version
+                    self.loot_tables.build(await self.get_loot_weights())
+                    # Only recorded once the build succeeds, and if the catalog changed while building, the tables
+                    # are still behind it, so the next caller builds them again
+                    self.loot_tables_built_version = version
+        return self.loot_tables.get(name)
+
+    # Gives the user amounts of items (mapping item ids to amounts) at location, with a single bulk write
+    # Users can't be given more of a unique item than "max_unique_items", so they may be given fewer than asked
+    # Returns a dictionary mapping item ids to the amounts given
+    async def grant_user_items(self, user: User, amounts: dict[ObjectId, int],
+                               location: int = HOME) -> dict[ObjectId, int]:
+        item_ids = [item_id for item_id, amount in amounts.items() if amount > 0]
+        unique_ids = {item.get("_id") async for item in self.db.items.find(
+            {"_id": {"$in": item_ids}, "isUnique": True}, {"_id": 1}, **self.time_limit())}
+
+        # Count how many of each unique item the user already owns, all in one query
+        owned = {}
+        if unique_ids:
+            cursor = self.db.userItems.aggregate([
+                {"$match": {"userId": user.id, "itemId": {"$in": list(unique_ids)}}},
+                {"$group": {"_id": "$itemId", "count": {"$sum": 1}}}
+            ], **self.time_limit("maxTimeMS"))
+            owned = {result.get("_id"): result.get("count") async for result in cursor}
+
+        max_unique_items = self.bot.config.get("max_unique_items")
+        granted = {}
+        writes = []
+        for item_id in item_ids:
+            amount = amounts[item_id]
+            if item_id in unique_ids:
+                amount = min(amount, max(max_unique_items - owned.get(item_id, 0), 0))
+                writes.extend(InsertOne({"userId": user.id, "itemId": item_id, "location": location})
+                              for _ in range(amount))
+            else:
+                writes.append(UpdateOne({"userId": user.id, "itemId": item_id, "location": location},
+                                        {"$inc": {"quantity": amount}}, upsert=True))
+            if amount > 0:
+                granted[item_id] = amount
+        if writes:
+            await self.db.userItems.bulk_write(writes, ordered=False)
+            await self.invalidate_user_items(user.id)
+        return granted
+
     # ===========
     # User Items
     # ===========
 
     async def get_user_item_item_id(self, user_item_id: ObjectId) -> Optional[ObjectId]:
-        result = await self.db.userItems.find_one({"_id": user_item_id}, {"itemId": 1})
+        result = await self.db.userItems.find_one({"_id": user_item_id}, {"itemId": 1}, **self.time_limit())
         return result.get("itemId") if result else None
 
     async def get_user_item_type_id(self, user_item_id: ObjectId) -> Optional[ObjectId]:
@@ -247,7 +1511,8 @@ class DatabaseCog(Cog):
                 {
                     "_id": 0,
                     "name": 1
-                }
+                },
+                **self.time_limit()
             )
             if result:
                 return result.get("name")
@@ -264,7 +1529,8 @@ class DatabaseCog(Cog):
                         "userId": user.id,
                         "itemId": item_id,
                         "location": HOME
-                    }
+                    },
+                    **self.time_limit()
                 )
                 async for _ in home:
                     quantity += 1
@@ -274,7 +1540,8 @@ class DatabaseCog(Cog):
                         "userId": user.id,
                         "itemId": item_id,
                         "location": BAG
-                    }
+                    },
+                    **self.time_limit()
                 )
                 async for _ in bag:
                     quantity += 1
@@ -291,7 +1558,8 @@ class DatabaseCog(Cog):
                     {
                         "_id": 0,
                         "quantity": 1
-                    }
+                    },
+                    **self.time_limit()
                 )
                 if home:
                     quantity += home.get("quantity")
@@ -305,7 +1573,8 @@ class DatabaseCog(Cog):
                     {
                         "_id": 0,
                         "quantity": 1
-                    }
+                    },
+                    **self.time_limit()
                 )
                 if bag:
                     quantity += bag.get("quantity")
@@ -314,13 +1583,59 @@ class DatabaseCog(Cog):
     async def get_user_item_properties(self, user_item_id: ObjectId) -> dict:
         item_id = await self.get_user_item_item_id(user_item_id)
         item_properties = await self.get_item_properties(item_id)
-        result = await self.db.userItems.find_one({"_id": user_item_id}, {"_id": 0, "properties": 1})
+        result = await self.db.userItems.find_one({"_id": user_item_id}, {"_id": 0, "properties": 1},
+                                                  **self.time_limit())
         user_item_properties = result.get("properties") if result else None
         if item_properties and user_item_properties:
             return self.merge_properties(item_properties, user_item_properties)
         else:
             return user_item_properties if user_item_properties else item_properties
 
+    # Returns a dictionary mapping each of the user item ids to the user item's name and resolved properties
+    # Loads everything with one query per collection, rather than several queries per user item
+    async def get_user_items_details(self, user_item_ids: list[ObjectId]) -> dict[ObjectId, dict]:
+        user_items = {}
+        async for user_item in self.db.userItems.find({"_id": {"$in": user_item_ids}}, {"userId": 0},
+                                                      **self.time_limit()):
+            user_items[user_item.get("_id")] = user_item
+
+        item_ids = list(set(user_item.get("itemId") for user_item in user_items.values()))
+        items = {}
+        async for item in self.db.items.find({"_id": {"$in": item_ids}}, **self.time_limit()):
+            items[item.get("_id")] = item
+
+        item_type_ids = list(set(item.get("itemTypeId") for item in items.values() if item.get("itemTypeId")))
+        item_types = {}
+        async for item_type in self.db.itemTypes.find({"_id": {"$in": item_type_ids}}, {"properties": 1},
+                                                      **self.time_limit()):
+            item_types[item_type.get("_id")] = item_type
+
+        details = {}
+        for user_item_id in user_item_ids:
+            user_item = user_items.get(user_item_id)
+            if not user_item:
+                continue
+            item = items.get(user_item.get("itemId"), {})
+            item_type = item_types.get(item.get("itemTypeId"), {})
+
+            if item.get("isUnique"):
+                name = user_item.get("name") or f"{item.get('single')} ({user_item_id})"
+            else:
+                name = item.get("single")
+
+            properties = None
+            for props in (item_type.get("properties"), item.get("properties"), user_item.get("properties")):
+                if properties and props:
+                    properties = self.merge_properties(properties, props)
+                elif props:
+                    properties = props
+
+            details[user_item_id] = {
+                "name": name,
+                "properties": properties or {}
+            }
+        return details
+
     async def user_has_item(self, user: User, item_id: ObjectId, location: int = None) -> bool:
         return await self.get_user_item_quantity(user, item_id, location) > 0
 
@@ -332,7 +1647,8 @@ class DatabaseCog(Cog):
                 },
                 {
                     "userId": 0
-                }
+                },
+                **self.time_limit()
             )
         else:
             cursor = self.db.userItems.find(
@@ -342,10 +1658,27 @@ class DatabaseCog(Cog):
                 },
                 {
                     "userId": 0
-                }
+                },
+                **self.time_limit()
             )
         return [item async for item in cursor]
 
+    # Returns up to page_size of the user's items at location (or at any location if location is None), with an _id
+    # greater than after, ordered by _id. Also returns whether there are more items after the returned items.
+    async def get_user_inventory_page(self, user: User, location: int = None, after: ObjectId = None,
+                                      page_size: int = 15) -> tuple[list[dict], bool]:
+        query = {
+            "userId": user.id
+        }
+        if location is not None:
+            query["location"] = location
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        # Fetch one extra item to find out whether there is another page
+        cursor = self.db.userItems.find(query, {"userId": 0}, **self.time_limit()).sort("_id", 1).limit(page_size + 1)
+        user_items = [item async for item in cursor]
+        return user_items[:page_size], len(user_items) > page_size
+
     async def get_user_bag(self, user: User) -> list[dict]:
         return await self.get_user_inventory(user, BAG)
 
@@ -358,7 +1691,8 @@ class DatabaseCog(Cog):
                 },
                 {
                     "_id": 1
-                }
+                },
+                **self.time_limit()
             )
         else:
             cursor = self.db.userItems.find(
@@ -369,10 +1703,71 @@ class DatabaseCog(Cog):
                 },
                 {
                     "_id": 1
-                }
+                },
+                **self.time_limit()
             )
         return [item.get("_id") async for item in cursor]
 
+    # Returns a dictionary mapping the ids of items the user owns at location to the quantity they own
+    # Results are cached per user, until the user's items change or the cache entry expires
+    async def get_user_owned_items(self, user: User, location: int) -> dict[ObjectId, int]:
+        owned = self.owned_items_cache.get(user.id)
+        if owned is MISSING:
+            owned = {HOME: {}, BAG: {}}
+            cursor = self.db.userItems.aggregate(
+                [
+                    {
+                        "$match": {
+                            "userId": user.id
+                        }
+                    },
+                    {
+                        "$group": {
+                            "_id": {
+                                "itemId": "$itemId",
+                                "location": "$location"
+                            },
+                            # Unique items don't have a quantity, each one counts as 1
+                            "quantity": {
+                                "$sum": {
+                                    "$ifNull": ["$quantity", 1]
+                                }
+                            }
+                        }
+                    }
+                ],
+                **self.time_limit("maxTimeMS")
+            )
+            async for result in cursor:
+                item_location = result["_id"].get("location", HOME)
+                quantity = result.get("quantity", 0)
+                if quantity > 0:
+                    owned.setdefault(item_location, {})[result["_id"].get("itemId")] = quantity
+            self.owned_items_cache.set(user.id, owned)
+        return owned.get(location, {})
+
+    # Returns a dictionary mapping the names and quantities of items the user owns at location, which start with
+    # prefix, to item ids, for use in autocomplete
+    async def search_user_items(self, user: User, prefix: str, location: int) -> dict[str, str]:
+        prefix = prefix.lower()
+        owned = await self.get_user_owned_items(user, location)
+        matches = []
+        for item_id, quantity in owned.items():
+            names = self.item_index.keys.get(item_id)
+            if names and any(name.startswith(prefix) for name in names):
+                matches.append((self.item_index.labels[item_id], quantity, item_id))
+        matches.sort(key=lambda match: match[0].lower())
+        choices = {}
+        for label, quantity, item_id in matches[:MAX_AUTOCOMPLETE_CHOICES]:
+            choices[f"{label} (x{quantity})"] = str(item_id)
+        return choices
+
+    # Must be called whenever a user's items are changed, so cached items aren't out of date
+    async def invalidate_user_items(self, user_id: int):
+        self.owned_items_cache.invalidate(user_id)
+        await self.bump_user_inventory_version(user_id)
+        self.invalidation_bus.publish("users", user_id)
+
     async def set_user_item_quantity(self, user: User, item_id: ObjectId, amount: int, location: int):
         if await self.item_is_unique(item_id):
             return
@@ -406,6 +1801,7 @@ class DatabaseCog(Cog):
                     "quantity": amount
                 }
             )
+        await self.invalidate_user_items(user.id)
 
     async def add_unique_user_item(self, user: User, item_id: ObjectId, location: int, amount: int = 1):
         if not await self.item_is_unique(item_id):
@@ -424,17 +1820,22 @@ class DatabaseCog(Cog):
             "location": location
         }
         items = [item.copy() for _ in range(amount)]
-        return await self.db.userItems.insert_many(items)
+        result = await self.db.userItems.insert_many(items)
+        await self.invalidate_user_items(user.id)
+        return result
 
     async def remove_unique_user_item(self, user_item_id: ObjectId):
-        item_id = await self.get_user_item_item_id(user_item_id)
-        if not await self.item_is_unique(item_id):
+        user_item = await self.db.userItems.find_one({"_id": user_item_id}, {"itemId": 1, "userId": 1},
+                                                     **self.time_limit())
+        if not user_item or not await self.item_is_unique(user_item.get("itemId")):
             return
         await self.db.userItems.delete_one({"_id": user_item_id})
+        await self.invalidate_user_items(user_item.get("userId"))
 
     async def set_unique_user_item_location(self, user_item_id: ObjectId, location: int):
-        item_id = await self.get_user_item_item_id(user_item_id)
-        if not await self.item_is_unique(item_id):
+        user_item = await self.db.userItems.find_one({"_id": user_item_id}, {"itemId": 1, "userId": 1},
+                                                     **self.time_limit())
+        if not user_item or not await self.item_is_unique(user_item.get("itemId")):
             return
         await self.db.userItems.update_one(
             {
@@ -446,6 +1847,7 @@ class DatabaseCog(Cog):
                 }
             }
         )
+        await self.invalidate_user_items(user_item.get("userId"))
 
 
 def setup(bot: AlisUnnamedBot):
@@ -0,0 +1,222 @@
+import asyncio
+import inspect
+import os
+import sys
+from typing import Callable, Any, IO, Optional
+
+from bson import json_util
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+from bot import AlisUnnamedBot
+
+# Transports the invalidation bus can use
+CHANGE_STREAMS = "change_streams"
+UNIX_SOCKET = "unix_socket"
+
+# Collections that caches are derived from, and orders, which the process that owns the market watches for orders
+# queued by other processes
+WATCHED_COLLECTIONS = ["users", "items", "itemTypes", "userItems", "orders"]
+
+# Unix sockets, and the file locks that decide which process hosts one, aren't available on Windows
+UNIX_SOCKETS_SUPPORTED: bool = sys.platform != "win32" and hasattr(asyncio, "start_unix_server")
+
+# Seconds to wait before reconnecting after the transport fails
+RECONNECT_DELAY: float = 1.0
+
+
+# Tells every bot process when a document changes, so in-memory state derived from it can be invalidated
+# Cache owners register handlers by collection, which are called with the _id of each changed document
+#
+# With change streams (the default), MongoDB reports every write, whichever process made it. Change streams need a
+# replica set, so if they aren't available the bus falls back to a unix socket. One process hosts the socket and
+# relays messages between the others, and changes must be announced with publish().
+class InvalidationBus:
+    def __init__(self, bot: AlisUnnamedBot, db: AsyncIOMotorDatabase):
+        self.bot = bot
+        self.db = db
+        self.handlers: dict[str, dict[str, Callable]] = {}  # Maps collections to handler names to handlers
+        self.transport: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.resume_token = None
+
+        config = bot.config.get("invalidation_bus", {})
+        self.preferred_transport = config.get("transport", CHANGE_STREAMS)
+        self.socket_path = config.get("socket_path", "/tmp/alis_unnamed_bot.sock")
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.peers: set[asyncio.StreamWriter] = set()  # Connections to other processes, if this process is the hub
+        self.hub: Optional[asyncio.StreamWriter] = None  # Connection to the hub, if another process is the hub
+        self.hub_lock: Optional[IO] = None  # Lock file held while this process is the hub
+
+    # Registers handler to be called with the _id of each changed document in collection
+    # Registering another handler with the same name replaces it, so handlers aren't duplicated on reload
+    def register(self, collection: str, name: str, handler: Callable[[Any], Any]):
+        self.handlers.setdefault(collection, {})[name] = handler
+
+    def start(self):
+        if self.preferred_transport == CHANGE_STREAMS:
+            self.task = asyncio.create_task(self.watch_change_streams())
+        elif self.preferred_transport == UNIX_SOCKET:
+            self.task = asyncio.create_task(self.run_unix_socket())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+        for peer in list(self.peers):
+            peer.close()
+        if self.hub:
+            self.hub.close()
+        if self.server:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        self.release_hub_lock()
+
+    async def dispatch(self, collection: str, key: Any):
+        self.bot.metrics.increment(f"invalidation.received.{collection}")
+        for name, handler in list(self.handlers.get(collection, {}).items()):
+            try:
+                result = handler(key)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as error:
+                self.bot.logger.error(f"Invalidation handler '{name}' failed: {error}")
+
+    # Announces that a document changed, to the other processes
+    # Only needed for the unix socket transport, since change streams see every write anyway
+    def publish(self, collection: str, key: Any):
+        if self.transport != UNIX_SOCKET:
+            return
+        message = self.encode(collection, key)
+        for writer in ([self.hub] if self.hub else list(self.peers)):
+            writer.write(message)
+
+    @staticmethod
+    def encode(collection: str, key: Any) -> bytes:
+        # json_util keeps ObjectIds as ObjectIds
+        return (json_util.dumps({"collection": collection, "key": key}) + "\n").encode("utf-8")
+
+    # ===========
+    # Change Streams
+    # ===========
+
+    async def watch_change_streams(self):
+        pipeline = [
+            {
+                "$match": {
+                    "ns.coll": {"$in": WATCHED_COLLECTIONS},
+                    "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+                }
+            }
+        ]
+        while True:
+            try:
+                async with self.db.watch(pipeline, resume_after=self.resume_token) as stream:
+                    if self.transport != CHANGE_STREAMS:
+                        self.transport = CHANGE_STREAMS
+                        self.bot.logger.info("Invalidation bus is using change streams")
+                    async for change in stream:
+                        self.resume_token = stream.resume_token
+                        await self.dispatch(change["ns"]["coll"], change["documentKey"]["_id"])
+            except OperationFailure as error:
+                if self.transport is None:
+                    # Change streams aren't supported, such as on a standalone server
+                    self.bot.logger.warning(f"Change streams are unavailable, falling back to a unix socket: {error}")
+                    return await self.run_unix_socket()
+                self.bot.logger.error(f"Invalidation bus change stream failed: {error}")
+                self.resume_token = None  # The resume token may be what failed
+            except PyMongoError as error:
+                self.bot.logger.error(f"Invalidation bus change stream failed: {error}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # ===========
+    # Unix Socket
+    # ===========
+
+    async def run_unix_socket(self):
+        if not UNIX_SOCKETS_SUPPORTED:
+            self.bot.logger.warning("Unix sockets aren't supported on this platform, so the invalidation bus is off, "
+                                    "and caches in other bot processes won't notice changes made by this one")
+            return
+        self.transport = UNIX_SOCKET
+        self.bot.logger.info(f"Invalidation bus is using the unix socket '{self.socket_path}'")
+        while True:
+            try:
+                reader, self.hub = await asyncio.open_unix_connection(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # No process is hosting the socket, so host it here
+                await self.host_unix_socket()
+            else:
+                try:
+                    async for line in reader:
+                        message = json_util.loads(line)
+                        await self.dispatch(message.get("collection"), message.get("key"))
+                except ConnectionError:
+                    pass  # The hub went away, so reconnect, or become the hub
+                finally:
+                    self.hub.close()
+                    self.hub = None
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # Takes an exclusive lock on a file next to the socket, which is held for as long as this process is the hub
+    # The lock is released by the OS if the process dies, so a crashed hub never blocks a new one
+    # Returns whether the lock was taken
+    def acquire_hub_lock(self) -> bool:
+        import fcntl  # Only available on Unix, like the socket itself
+        if self.hub_lock:
+            return True
+        lock_file = open(self.socket_path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.hub_lock = lock_file
+        return True
+
+    def release_hub_lock(self):
+        if self.hub_lock:
+            import fcntl
+            fcntl.flock(self.hub_lock, fcntl.LOCK_UN)
+            self.hub_lock.close()
+            self.hub_lock = None
+
+    async def host_unix_socket(self):
+        # Only one process may decide to be the hub, otherwise processes starting together could each unlink the
+        # socket the other just bound. If another process holds the lock, it is the hub, or is about to be.
+        if not self.acquire_hub_lock():
+            return
+        # Only the hub unlinks the socket, so a socket file here was left behind by a hub that crashed
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle_peer, self.socket_path)
+        except OSError as error:
+            self.bot.logger.error(f"Failed to host invalidation bus socket: {error}")
+            self.release_hub_lock()
+            return
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.release_hub_lock()
+
+    # Dispatches messages from another process here, and relays them to every other process
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers.add(writer)
+        try:
+            async for line in reader:
+                for peer in list(self.peers):
+                    if peer is not writer:
+                        peer.write(line)
+                message = json_util.loads(line)
+                await self.dispatch(message.get("collection"), message.get("key"))
+        except ConnectionError:
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Invalidation extension...")
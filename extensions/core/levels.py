@@ -0,0 +1,30 @@
+from bisect import bisect_right
+
+from bot import AlisUnnamedBot
+
+
+# Table of the total exp needed to reach each level, precomputed so a level can be found with a binary search
+# Going from level L to level L + 1 takes int(base * L ** exponent) exp
+class LevelTable:
+    def __init__(self, base: float = 100, exponent: float = 1.5, max_level: int = 1000):
+        self.thresholds: list[int] = [0]  # thresholds[i] is the total exp needed to reach level i + 1
+        total = 0
+        for level in range(1, max_level):
+            total += int(base * level ** exponent)
+            self.thresholds.append(total)
+
+    @property
+    def max_level(self) -> int:
+        return len(self.thresholds)
+
+    # Returns the level reached with exp total exp
+    def get_level(self, exp: int) -> int:
+        return max(bisect_right(self.thresholds, exp), 1)
+
+    # Returns the total exp needed to reach level
+    def get_level_exp(self, level: int) -> int:
+        return self.thresholds[min(max(level, 1), self.max_level) - 1]
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Levels extension...")
@@ -0,0 +1,87 @@
+import random
+from collections import Counter
+from typing import Hashable, Optional
+
+from bot import AlisUnnamedBot
+
+
+# Table for drawing keys at random in proportion to their weights, in constant time per draw, using Vose's alias method
+# Each of the n columns holds a key, and the alias of another key to draw instead with probability 1 - prob[column]
+class AliasTable:
+    def __init__(self, weights: dict[Hashable, float]):
+        weights = {key: weight for key, weight in weights.items() if weight > 0}
+        if not weights:
+            raise ValueError("Alias table needs at least one positive weight")
+        self.keys = list(weights)
+        n = len(self.keys)
+        total = sum(weights.values())
+        # Scale the weights so the average column holds exactly 1
+        scaled = [weights[key] * n / total for key in self.keys]
+        self.prob = [0.0] * n
+        self.alias = list(range(n))
+
+        small = [i for i, value in enumerate(scaled) if value < 1]
+        large = [i for i, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            # The large key fills the rest of the small key's column
+            scaled[more] = scaled[more] + scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever is left is 1, give or take rounding errors
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Returns the key chosen by the uniform random number u in [0, 1)
+    # The whole part of u * n picks the column, and the fractional part decides between its key and alias
+    def pick(self, u: float) -> Hashable:
+        x = u * len(self.keys)
+        column = int(x)
+        return self.keys[column] if x - column < self.prob[column] else self.keys[self.alias[column]]
+
+    def draw(self, rng: random.Random = random) -> Hashable:
+        return self.pick(rng.random())
+
+    # Draws count keys, and returns how many times each key was drawn
+    def draw_many(self, count: int, rng: random.Random = random) -> Counter:
+        keys = self.keys
+        prob = self.prob
+        alias = self.alias
+        n = len(keys)
+        draws = Counter()
+        # Only one random number is needed per draw, and the loop avoids method calls, since count may be large
+        for x in (rng.random() * n for _ in range(count)):
+            column = int(x)
+            draws[column if x - column < prob[column] else alias[column]] += 1
+        return Counter({keys[column]: amount for column, amount in draws.items()})
+
+
+# Loot tables compiled from the items catalog, where each item's (or its item type's) "loot" property maps table
+# names to the item's weight in that table, such as {"crate": 10, "daily": 2}
+class LootTables:
+    def __init__(self):
+        self.tables: dict[str, AliasTable] = {}
+
+    # weights maps table names to item ids to weights
+    def build(self, weights: dict[str, dict[Hashable, float]]):
+        tables = {}
+        for name, table_weights in weights.items():
+            if any(weight > 0 for weight in table_weights.values()):
+                tables[name] = AliasTable(table_weights)
+        self.tables = tables
+
+    def get(self, name: str) -> Optional[AliasTable]:
+        return self.tables.get(name)
+
+    @property
+    def names(self) -> list[str]:
+        return sorted(self.tables)
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Loot extension...")
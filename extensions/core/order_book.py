@@ -0,0 +1,132 @@
+import heapq
+from decimal import Decimal
+from itertools import count
+from typing import Hashable, Optional
+
+from bot import AlisUnnamedBot
+
+# Sides of an order
+BUY: str = "buy"
+SELL: str = "sell"
+
+
+# An order to buy or sell quantity of an item, at price each or better
+class Order:
+    __slots__ = ("order_id", "user_id", "item_id", "side", "price", "quantity", "remaining", "sequence")
+
+    def __init__(self, order_id: Hashable, user_id: int, item_id: Hashable, side: str, price: Decimal, quantity: int,
+                 remaining: int = None):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.item_id = item_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.remaining = quantity if remaining is None else remaining
+        self.sequence = 0  # Set when the order is added to a book, orders with lower sequences arrived first
+
+
+# quantity of an item changing hands at price each, between a buy order and a sell order
+# The price is always the price of whichever order was already resting in the book
+class Fill:
+    __slots__ = ("buy_order", "sell_order", "price", "quantity")
+
+    def __init__(self, buy_order: Order, sell_order: Order, price: Decimal, quantity: int):
+        self.buy_order = buy_order
+        self.sell_order = sell_order
+        self.price = price
+        self.quantity = quantity
+
+
+# Price-time priority order book for a single item
+# Bids and asks are heaps of (price key, sequence, order), so the best priced order that arrived first is always at
+# the top. Bids are keyed by their negated price, so the highest bid comes first. Cancelled orders are only removed
+# from the heaps once they reach the top, so cancelling doesn't need to search the heap.
+class OrderBook:
+    def __init__(self):
+        self.bids: list[tuple[Decimal, int, Order]] = []
+        self.asks: list[tuple[Decimal, int, Order]] = []
+        self.orders: dict[Hashable, Order] = {}  # Maps the ids of open orders to the orders
+        self.sequence = count()
+
+    def __len__(self):
+        return len(self.orders)
+
+    # Returns the order at the top of heap, removing any cancelled or filled orders above it
+    def peek(self, heap: list[tuple[Decimal, int, Order]]) -> Optional[Order]:
+        while heap:
+            order = heap[0][2]
+            if order.remaining > 0 and order.order_id in self.orders:
+                return order
+            heapq.heappop(heap)
+        return None
+
+    @property
+    def best_bid(self) -> Optional[Order]:
+        return self.peek(self.bids)
+
+    @property
+    def best_ask(self) -> Optional[Order]:
+        return self.peek(self.asks)
+
+    # Matches order against the opposite side of the book for as long as their prices cross, then rests whatever is
+    # left of order in the book. Returns the fills, in the order they happened.
+    def add(self, order: Order) -> list[Fill]:
+        order.sequence = next(self.sequence)
+        fills = []
+        is_buy = order.side == BUY
+        opposite = self.asks if is_buy else self.bids
+        while order.remaining > 0:
+            resting = self.peek(opposite)
+            if resting is None or (resting.price > order.price if is_buy else resting.price < order.price):
+                break
+            quantity = min(order.remaining, resting.remaining)
+            order.remaining -= quantity
+            resting.remaining -= quantity
+            if is_buy:
+                fills.append(Fill(order, resting, resting.price, quantity))
+            else:
+                fills.append(Fill(resting, order, resting.price, quantity))
+            if resting.remaining == 0:
+                heapq.heappop(opposite)
+                del self.orders[resting.order_id]
+        if order.remaining > 0:
+            self.rest(order)
+        return fills
+
+    def rest(self, order: Order):
+        self.orders[order.order_id] = order
+        if order.side == BUY:
+            heapq.heappush(self.bids, (-order.price, order.sequence, order))
+        else:
+            heapq.heappush(self.asks, (order.price, order.sequence, order))
+
+    # Removes the order from the book, and returns it, if it is still open
+    def cancel(self, order_id: Hashable) -> Optional[Order]:
+        return self.orders.pop(order_id, None)
+
+    # Returns up to levels of (price, total quantity) for side, best price first
+    def depth(self, side: str, levels: int = 5) -> list[tuple[Decimal, int]]:
+        totals = {}
+        for order in self.orders.values():
+            if order.side == side:
+                totals[order.price] = totals.get(order.price, 0) + order.remaining
+        prices = sorted(totals, reverse=side == BUY)[:levels]
+        return [(price, totals[price]) for price in prices]
+
+
+# The order books of every item with open orders
+class OrderBooks:
+    def __init__(self):
+        self.books: dict[Hashable, OrderBook] = {}
+
+    # Returns the item's order book, creating an empty one if it doesn't have one yet
+    def get(self, item_id: Hashable) -> OrderBook:
+        book = self.books.get(item_id)
+        if book is None:
+            book = self.books[item_id] = OrderBook()
+        return book
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Order Book extension...")
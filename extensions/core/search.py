@@ -0,0 +1,79 @@
+from bisect import bisect_left, insort
+from typing import Hashable, Iterable
+
+from bot import AlisUnnamedBot
+
+# Discord allows at most 25 choices in an autocomplete response
+MAX_AUTOCOMPLETE_CHOICES: int = 25
+
+
+# Index of names, which can be searched by prefix
+# Names are kept in a sorted list, so a search is a binary search followed by a short scan
+class PrefixIndex:
+    def __init__(self):
+        self.names: list[tuple[str, Hashable]] = []  # Sorted list of (lowercase name, key)
+        self.keys: dict[Hashable, list[str]] = {}  # Maps keys to their names
+        self.labels: dict[Hashable, str] = {}  # Maps keys to the name that is shown to the user
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.keys
+
+    # Adds a key to the index, or updates its names if it is already in the index
+    # The first name is used as the key's label
+    def set(self, key: Hashable, names: Iterable[str]):
+        names = [name for name in names if name]
+        if not names:
+            return self.remove(key)
+        lowered = sorted(set(name.lower() for name in names))
+        if self.keys.get(key) == lowered:
+            self.labels[key] = names[0]
+            return
+        self.remove(key)
+        for name in lowered:
+            insort(self.names, (name, key), key=lambda entry: entry[0])
+        self.keys[key] = lowered
+        self.labels[key] = names[0]
+
+    def remove(self, key: Hashable):
+        for name in self.keys.pop(key, []):
+            i = bisect_left(self.names, name, key=lambda entry: entry[0])
+            while i < len(self.names) and self.names[i][0] == name:
+                if self.names[i][1] == key:
+                    del self.names[i]
+                    break
+                i += 1
+        self.labels.pop(key, None)
+
+    def clear(self):
+        self.names.clear()
+        self.keys.clear()
+        self.labels.clear()
+
+    # Returns the keys of up to limit entries with a name starting with prefix, ordered by name
+    def search(self, prefix: str, limit: int = MAX_AUTOCOMPLETE_CHOICES) -> list[Hashable]:
+        prefix = prefix.lower()
+        results = []
+        i = bisect_left(self.names, prefix, key=lambda entry: entry[0])
+        while i < len(self.names) and len(results) < limit:
+            name, key = self.names[i]
+            if not name.startswith(prefix):
+                break
+            if key not in results:
+                results.append(key)
+            i += 1
+        return results
+
+    # Returns the key of the entry with a name exactly matching name, if there is one
+    def find(self, name: str):
+        name = name.lower()
+        i = bisect_left(self.names, name, key=lambda entry: entry[0])
+        if i < len(self.names) and self.names[i][0] == name:
+            return self.names[i][1]
+        return None
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Search extension...")
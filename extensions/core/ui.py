@@ -1,7 +1,7 @@
-from typing import Callable
+from typing import Any, Callable, Optional
 
 from bson import ObjectId
-from nextcord import Interaction, Embed, Colour, ButtonStyle, SelectOption
+from nextcord import Interaction, Embed, Colour, ButtonStyle, SelectOption, User
 from nextcord.ui import View, Button, Select
 
 from bot import AlisUnnamedBot
@@ -10,6 +10,8 @@ from extensions.core.emojis import CROSS, ARROW_LEFT_ANIMATED, ARROW_RIGHT_ANIMA
 
 
 DEFAULT_MENU_COLOUR = 3092790
+MAX_SELECT_OPTIONS = 25  # Discord doesn't allow a dropdown to have more options than this
+MAX_SELECTED_NAMES = 15  # Most selected items to list by name in SelectUserItemsMenu
 
 
 class NotMenuOwnerEmbed(Embed):
@@ -37,15 +39,27 @@ class Menu(View):
         self.original_inter = original_inter
         self.title = title
         self.colour = colour
+        # Tracked by the menu, since the response to original_inter may be done without anything being sent, such as
+        # when it has been deferred by auto_defer
+        self.message_sent = False
+
+    # Returns whether the user of inter may use this menu's buttons and dropdowns
+    def can_use(self, inter: Interaction) -> bool:
+        return inter.user.id == self.original_inter.user.id
 
     async def send_or_update_menu(self):
         embed = Embed()
         embed.title = self.title if self.title else "Menu Title"
         embed.colour = self.colour
-        if self.original_inter.response.is_done():
-            await self.original_inter.edit_original_message(view=self, embed=embed)
+        await self.send_or_edit(view=self, embed=embed)
+
+    # Sends the menu's message the first time it is called, and edits it after that
+    async def send_or_edit(self, **kwargs):
+        if self.message_sent:
+            await self.original_inter.edit_original_message(**kwargs)
         else:
-            await self.original_inter.send(view=self, embed=embed)
+            await self.original_inter.send(**kwargs)
+            self.message_sent = True
 
     async def disable_buttons(self):
         for item in self.children:
@@ -91,6 +105,66 @@ class PreviousAndNextMenu(Menu):
         pass
 
 
+# Menu showing a list one page at a time, where each page is fetched when it is shown
+# fetch_page is given the position after which the page starts (None for the first page), such as an _id,
+# and must return the lines of the page, the position of the last item on the page, and whether there is a next page
+class PagedListMenu(PreviousAndNextMenu):
+    def __init__(self, fetch_page: Callable, empty_text: str, author_name: str, author_icon_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.fetch_page = fetch_page
+        self.empty_text = empty_text
+        self.author_name = author_name
+        self.author_icon_url = author_icon_url
+
+        # Where each visited page starts, such as the _id of the last item on the page before
+        self.page_starts: list[Optional[Any]] = [None]
+        self.page_index = 0
+        self.last_id: Optional[Any] = None
+        self.has_next = False
+
+        self.button_previous = ButtonPrevious(self)
+        self.add_item(self.button_previous)
+
+        self.button_next = ButtonNext(self)
+        self.add_item(self.button_next)
+
+    async def send_or_update_menu(self):
+        lines, self.last_id, self.has_next = await self.fetch_page(self.page_starts[self.page_index])
+
+        self.button_previous.disabled = self.page_index == 0
+        self.button_next.disabled = not self.has_next
+
+        embed = Embed()
+        embed.set_author(name=self.author_name, icon_url=self.author_icon_url)
+        embed.colour = self.colour
+        if lines:
+            embed.description = "- " + "\n- ".join(lines)
+        else:
+            embed.description = self.empty_text
+        if self.page_index > 0 or self.has_next:
+            embed.set_footer(text=f"Page {self.page_index + 1}")
+
+        if self.message_sent or self.has_next:
+            await self.send_or_edit(view=self, embed=embed)
+        else:
+            # Everything fits on one page, so there is no need for buttons
+            self.stop()
+            await self.send_or_edit(embed=embed)
+
+    async def on_previous(self):
+        if self.page_index > 0:
+            self.page_index -= 1
+            await self.send_or_update_menu()
+
+    async def on_next(self):
+        if not self.has_next:
+            return
+        self.page_index += 1
+        if self.page_index == len(self.page_starts):
+            self.page_starts.append(self.last_id)
+        await self.send_or_update_menu()
+
+
 class DropDownMenu(Menu):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -99,7 +173,7 @@ class DropDownMenu(Menu):
         pass
 
 
-class SelectUserItemsMenu(ConfirmAndCancelMenu, DropDownMenu, BotAccessMenu, DatabaseAccessMenu):
+class SelectUserItemsMenu(ConfirmAndCancelMenu, PreviousAndNextMenu, DropDownMenu, BotAccessMenu, DatabaseAccessMenu):
     def __init__(self, item_id: ObjectId, user_items: list[ObjectId], callback: Callable, **kwargs):
         super().__init__(**kwargs)
         self.item_id = item_id
@@ -109,6 +183,16 @@ class SelectUserItemsMenu(ConfirmAndCancelMenu, DropDownMenu, BotAccessMenu, Dat
         self.current_index = 0
         self.num_items = len(self.user_items)
         self.selected_items: list[ObjectId] = []
+        self.limit_checked = False
+
+        # The dropdown only shows one window of items at a time, since it can't hold more than MAX_SELECT_OPTIONS
+        # Names and properties are only loaded for windows that have been shown
+        self.window = 0
+        self.num_windows = (self.num_items + MAX_SELECT_OPTIONS - 1) // MAX_SELECT_OPTIONS
+        self.names: dict[ObjectId, str] = {}
+        self.properties: dict[ObjectId, tuple[list[str], dict[str, list[str]]]] = {}
+        self.single_name: Optional[str] = None
+        self.plural_name: Optional[str] = None
 
         self.button_select = ButtonSelect(self)
         self.add_item(self.button_select)
@@ -131,19 +215,20 @@ class SelectUserItemsMenu(ConfirmAndCancelMenu, DropDownMenu, BotAccessMenu, Dat
         self.button_cancel.row = 2
         self.add_item(self.button_cancel)
 
-    async def send_or_update_menu(self):
-        if not self.user_items:
-            return
-        # Current item info
-        cur_item_id = self.user_items[self.current_index]
-        cur_item_name = await self.database.get_user_item_name(cur_item_id)
-        cur_item_properties = await self.database.get_user_item_properties(cur_item_id)
-        selected = cur_item_id in self.selected_items
-
-        # Item Properties
+        # Buttons to move the dropdown to the previous or next window, if there is more than one
+        self.button_previous = ButtonPrevious(self, row=3)
+        self.button_next = ButtonNext(self, row=3)
+        if self.num_windows > 1:
+            self.add_item(self.button_previous)
+            self.add_item(self.button_next)
+
+    # Returns the properties as a list of property strings,
+    # and a dictionary mapping category names to lists of property strings
+    @staticmethod
+    def format_properties(item_properties: dict) -> tuple[list[str], dict[str, list[str]]]:
         properties = []
         categories = {}
-        for prop in cur_item_properties.values():
+        for prop in item_properties.values():
             if "category" in prop and "properties" in prop:
                 category_prop_list = []
                 category_properties = prop["properties"]
@@ -157,31 +242,68 @@ class SelectUserItemsMenu(ConfirmAndCancelMenu, DropDownMenu, BotAccessMenu, Dat
                 prop_name = prop["name"]
                 prop_value = prop["value"]
                 properties.append(f"{prop_name}: `{prop_value}`")
+        return properties, categories
+
+    # Shows the window of items in the dropdown, loading the names and properties of its items if needed
+    # All of a window's items are loaded in one go, so the menu can be redrawn without the database
+    async def load_window(self, window: int):
+        start = window * MAX_SELECT_OPTIONS
+        window_items = self.user_items[start:start + MAX_SELECT_OPTIONS]
+        missing = [user_item_id for user_item_id in window_items if user_item_id not in self.names]
+        if missing:
+            details = await self.database.get_user_items_details(missing)
+            for user_item_id in missing:
+                user_item = details.get(user_item_id, {})
+                self.names[user_item_id] = user_item.get("name") or str(user_item_id)
+                self.properties[user_item_id] = self.format_properties(user_item.get("properties", {}))
+
+        self.window = window
+        self.select_item.options = []
+        for i, user_item_id in enumerate(window_items, start):
+            self.select_item.append_option(SelectOption(label=self.names[user_item_id], value=str(i)))
+        self.button_previous.disabled = window == 0
+        self.button_next.disabled = window >= self.num_windows - 1
+
+    async def send_or_update_menu(self):
+        if not self.user_items:
+            return
+        if self.single_name is None:
+            self.single_name = await self.database.get_item_single_name(self.item_id)
+            self.plural_name = await self.database.get_item_plural_name(self.item_id)
+            self.select_item.placeholder = f"Select {self.single_name}"
+
+        # Check the limit before loading any items, on the first render only
+        # The interaction's response can't be used to tell, since it may have been deferred by auto_defer
+        if not self.limit_checked:
+            self.limit_checked = True
+            max_unique_items = self.bot.config.get("max_unique_items")
+            if self.num_items > max_unique_items:
+                self.stop()
+                return await self.original_inter.send(embed=MaximumUniqueItemsExceeded(max_unique_items,
+                                                                                       self.plural_name))
+
+        if not self.select_item.options:
+            await self.load_window(self.current_index // MAX_SELECT_OPTIONS)
+
+        # Current item info
+        cur_item_id = self.user_items[self.current_index]
+        cur_item_name = self.names[cur_item_id]
+        properties, categories = self.properties[cur_item_id]
+        selected = cur_item_id in self.selected_items
 
-        # Selected Items
-        selected_item_names = []
-        for selected_item_id in self.selected_items:
-            selected_item_names.append(f"{await self.database.get_user_item_name(selected_item_id)}")
+        # Selected Items, only naming the ones that have been loaded, and at most MAX_SELECTED_NAMES of them
+        selected_item_names = [self.names[selected_item_id] for selected_item_id in self.selected_items
+                               if selected_item_id in self.names][:MAX_SELECTED_NAMES]
+        if len(self.selected_items) > len(selected_item_names):
+            selected_item_names.append(f"*...and {len(self.selected_items) - len(selected_item_names)} more*")
 
         # Update select button
         self.button_select.label = f"Remove" if selected else f"Select"
         self.button_select.emoji = CROSS if selected else TICK
 
-        # Update dropdown menu
-        if not self.select_item.options:
-            for i in range(self.num_items):
-                user_item_id = self.user_items[i]
-                user_item_name = await self.database.get_user_item_name(user_item_id)
-                option = SelectOption(label=user_item_name, value=str(i))
-                self.select_item.append_option(option)
-            single_name = await self.database.get_item_single_name(self.item_id)
-            self.select_item.placeholder = f"Select {single_name}"
-
-        plural_name = await self.database.get_item_plural_name(self.item_id)
-
         # Create and send Embed
         embed = Embed()
-        embed.title = f"**Select {plural_name}**"
+        embed.title = f"**Select {self.plural_name}**"
         embed.colour = self.colour
         embed.add_field(name="Current Item", value=cur_item_name, inline=False)
         embed.add_field(name="Properties", value="\n".join(properties))
@@ -190,20 +312,25 @@ class SelectUserItemsMenu(ConfirmAndCancelMenu, DropDownMenu, BotAccessMenu, Dat
         if selected_item_names:
             embed.add_field(name="Selected Items", value="\n".join(selected_item_names), inline=False)
         embed.set_footer(text=f"Item {self.current_index + 1} of {self.num_items}")
-        if self.original_inter.response.is_done():
-            await self.original_inter.edit_original_message(view=self, embed=embed)
-        else:
-            max_unique_items = self.bot.config.get("max_unique_items")
-            if self.num_items > max_unique_items:
-                await self.original_inter.send(embed=MaximumUniqueItemsExceeded(max_unique_items, plural_name))
-            else:
-                await self.original_inter.send(view=self, embed=embed)
+        await self.send_or_edit(view=self, embed=embed)
 
     async def on_drop_down_list_updated(self):
         if self.select_item.values:
             self.current_index = int(self.select_item.values[0])
             await self.send_or_update_menu()
 
+    async def on_previous(self):
+        if self.window > 0:
+            await self.load_window(self.window - 1)
+            self.current_index = self.window * MAX_SELECT_OPTIONS
+            await self.send_or_update_menu()
+
+    async def on_next(self):
+        if self.window < self.num_windows - 1:
+            await self.load_window(self.window + 1)
+            self.current_index = self.window * MAX_SELECT_OPTIONS
+            await self.send_or_update_menu()
+
     async def on_select(self):
         user_item_id = self.user_items[self.current_index]
         if user_item_id in self.selected_items:
@@ -229,13 +356,58 @@ class SelectUserItemsMenu(ConfirmAndCancelMenu, DropDownMenu, BotAccessMenu, Dat
         await self.on_confirm()
 
 
+# Menu offering a trade to partner, who is the only one who can accept or decline it
+# callback is given the original interaction and whether the trade was accepted, and is only called once
+class TradeMenu(ConfirmAndCancelMenu):
+    def __init__(self, partner: User, description: str, callback: Callable, **kwargs):
+        super().__init__(**kwargs)
+        self.partner = partner
+        self.description = description
+        self.callback = callback
+        self.answered = False
+
+        self.button_confirm = ButtonConfirm(self)
+        self.button_confirm.label = "Accept"
+        self.add_item(self.button_confirm)
+
+        self.button_cancel = ButtonCancel(self)
+        self.button_cancel.label = "Decline"
+        self.add_item(self.button_cancel)
+
+    def can_use(self, inter: Interaction) -> bool:
+        return inter.user.id == self.partner.id
+
+    async def send_or_update_menu(self):
+        embed = Embed()
+        embed.title = self.title if self.title else "**Trade Offer**"
+        embed.colour = self.colour
+        embed.description = self.description
+        # Mention the partner, so they know they have been offered a trade, even if the command was auto deferred
+        await self.send_or_edit(content=self.partner.mention, view=self, embed=embed)
+
+    async def answer(self, accepted: bool):
+        # Both buttons could be pressed before the first press has been handled
+        if self.answered:
+            return
+        self.answered = True
+        self.stop()
+        await self.disable_buttons()
+        await self.callback(self.original_inter, accepted)
+
+    async def on_confirm(self):
+        await self.answer(True)
+
+    async def on_cancel(self):
+        await self.answer(False)
+
+
 class DropDownList(Select):
     def __init__(self, menu: DropDownMenu, **kwargs):
         super().__init__(**kwargs)
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_drop_down_list_updated()
 
@@ -246,7 +418,7 @@ class ButtonConfirm(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_confirm()
 
@@ -257,7 +429,7 @@ class ButtonCancel(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_cancel()
 
@@ -268,7 +440,7 @@ class ButtonPrevious(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_previous()
 
@@ -279,7 +451,7 @@ class ButtonNext(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_next()
 
@@ -290,7 +462,7 @@ class ButtonSelect(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_select()
 
@@ -301,7 +473,7 @@ class ButtonSelectAll(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_select_all()
 
@@ -312,7 +484,7 @@ class ButtonRemoveAll(Button):
         self.menu = menu
 
     async def callback(self, inter: Interaction):
-        if self.menu.original_inter.user.id != inter.user.id:
+        if not self.menu.can_use(inter):
             return await inter.send(embed=NotMenuOwnerEmbed(), ephemeral=True)
         await self.menu.on_remove_all()
 
@@ -1,15 +1,75 @@
+import asyncio
+import time
 from decimal import Decimal, DecimalException, ROUND_HALF_UP
 from typing import Optional
 
-from nextcord import Colour, Interaction, User, Embed, ApplicationCommandType, SlashApplicationCommand, SlashOption
+from bson import ObjectId
+from nextcord import Colour, Interaction, User, Embed, ApplicationCommandType, SlashApplicationCommand, SlashOption, \
+    HTTPException, InteractionResponded
 from nextcord.ext.commands import Cog
+from nextcord.utils import utcnow
 
 from bot import AlisUnnamedBot
-from extensions.core.database import DatabaseCog
+from extensions.core.cooldowns import CooldownsCog
+from extensions.core.database import DatabaseCog, command_deadline
 from extensions.core.emojis import WALLET, BANK, BACKPACK
 
 AMOUNT_DESCRIPTION = 'Any decimal, such as "1.20", a percentage, such as "50%", or "all" to specify all.'
 
+# Seconds Discord allows for the initial response to an interaction
+INTERACTION_RESPONSE_WINDOW: float = 3.0
+
+# Seconds an interaction can be responded to for, after it has been deferred
+INTERACTION_TOKEN_LIFETIME: float = 900.0
+
+# Most characters Discord allows in the value of an embed field
+EMBED_FIELD_VALUE_LIMIT: int = 1024
+
+# Maps the ids of interactions deferred by auto_defer to when they were deferred
+# Their responses count as done, even though the commands haven't sent anything yet
+auto_deferred: dict[int, float] = {}
+
+
+# Returns whether nothing has been sent in response to inter yet, other than auto_defer's "thinking" message
+async def awaiting_first_response(inter: Interaction) -> bool:
+    if not inter.response.is_done():
+        return True
+    if inter.id not in auto_deferred:
+        return False
+    try:
+        message = await inter.original_message()
+    except HTTPException:
+        return False
+    if message.flags.loading:
+        return True
+    auto_deferred.pop(inter.id, None)  # The command has replaced the "thinking" message with its response
+    return False
+
+
+# Sends a response to inter, which may be the command's first response even if auto_defer has already deferred it
+# Deferred responses are public, so for an ephemeral first response the "thinking" message is deleted, and the
+# response is sent as an ephemeral followup instead of replacing it
+async def send_response(inter: Interaction, **kwargs):
+    if kwargs.get("ephemeral") and inter.id in auto_deferred and await awaiting_first_response(inter):
+        auto_deferred.pop(inter.id, None)
+        await inter.delete_original_message()
+    return await inter.send(**kwargs)
+
+
+# Joins lines with newlines into as few values as possible that each fit in an embed field
+def split_field_lines(lines: list[str], limit: int = EMBED_FIELD_VALUE_LIMIT) -> list[str]:
+    values = []
+    value = ""
+    for line in lines:
+        line = line[:limit]
+        if value and len(value) + 1 + len(line) > limit:
+            values.append(value)
+            value = ""
+        value = f"{value}\n{line}" if value else line
+    if value:
+        values.append(value)
+    return values
+
 
 # Base class for certain cogs that need access to the Utils and Database cogs
 class AlisUnnamedBotCog(Cog):
@@ -17,6 +77,49 @@ class AlisUnnamedBotCog(Cog):
         self.bot = bot
         self.utils: Optional[UtilsCog] = None
         self.database: Optional[DatabaseCog] = None
+        self.cooldowns: Optional[CooldownsCog] = None
+        self.auto_defer_tasks: dict[int, asyncio.Task] = {}  # Maps interaction ids to their auto defer tasks
+
+    # Called by nextcord to check whether any of this cog's application commands can be used
+    # Rejects the command, before it touches the database, if the user is using it too often
+    async def cog_application_command_check(self, inter: Interaction) -> bool:
+        if self.cooldowns:
+            retry_after = self.cooldowns.try_use(inter)
+            if retry_after is not None:
+                raise OnCooldownError(inter.application_command.name, retry_after)
+        return True
+
+    # Called by nextcord before any of this cog's application commands are invoked
+    # Sets the deadline for the command's database queries, and schedules the response to be deferred
+    # if the command hasn't responded by the time Discord's response window has nearly passed
+    async def cog_application_command_before_invoke(self, inter: Interaction):
+        elapsed = max((utcnow() - inter.created_at).total_seconds(), 0)
+        command_deadline.set(time.monotonic() - elapsed + self.bot.config.get("command_timeout", 10))
+        defer_margin = self.bot.config.get("auto_defer_margin", 0.5)
+        self.auto_defer_tasks[inter.id] = asyncio.create_task(
+            self.auto_defer(inter, INTERACTION_RESPONSE_WINDOW - defer_margin - elapsed))
+
+    async def cog_application_command_after_invoke(self, inter: Interaction):
+        task = self.auto_defer_tasks.pop(inter.id, None)
+        if task:
+            task.cancel()
+
+    # Defers the response to the interaction after delay seconds, unless it has already been responded to
+    async def auto_defer(self, inter: Interaction, delay: float):
+        try:
+            await asyncio.sleep(max(delay, 0))
+            if not inter.response.is_done():
+                self.bot.logger.debug(f"Auto deferring /{inter.application_command.name}")
+                now = time.monotonic()
+                for interaction_id, deferred_at in list(auto_deferred.items()):
+                    if now - deferred_at > INTERACTION_TOKEN_LIFETIME:
+                        del auto_deferred[interaction_id]
+                auto_deferred[inter.id] = now
+                await inter.response.defer()
+        except (InteractionResponded, HTTPException):
+            pass  # The command responded at the same time
+        finally:
+            self.auto_defer_tasks.pop(inter.id, None)
 
 
 # Base class for errors that should be sent back to the user via a discord embed
@@ -35,10 +138,24 @@ class HiddenEmbedError(EmbedError):
         super().__init__(*args)
 
 
-# Class that extends SlashOption and sets the "name" attribute to be "item"
-# so that this SlashOption is picked up by "setup_item_slash_option_choices()" function in the database cog
+class OnCooldownError(HiddenEmbedError):
+    def __init__(self, command_name: str, retry_after: float):
+        super().__init__("**Slow Down!**",
+                         f"You can use `/{command_name}` again in `{retry_after:.1f}s`")
+
+
+class ItemDoesNotExistError(EmbedError):
+    def __init__(self, item: str):
+        super().__init__("**Invalid Argument**",
+                         f"`{item}` is not an item! Pick one of the suggested items instead...")
+
+
+# Class that extends SlashOption, sets the "name" attribute to be "item" and enables autocomplete
+# Commands using this option should autocomplete it with "search_items()" from the database cog,
+# and resolve the value with "get_item_id_from_option()"
 class ItemSlashOption(SlashOption):
     def __init__(self, **kwargs):
+        kwargs["autocomplete"] = True
         super().__init__(**kwargs)
         self.name = "item"
 
@@ -94,6 +211,16 @@ class UtilsCog(AlisUnnamedBotCog):
     def to_currency_str(self, value) -> str:
         return self.currency_symbol + "{:,}".format(self.to_currency_value(value))
 
+    # Returns the id of the item chosen in an ItemSlashOption
+    # The value is normally an item id picked from autocomplete, but may also be an item name typed by the user
+    async def get_item_id_from_option(self, value: str) -> ObjectId:
+        if ObjectId.is_valid(value) and await self.database.item_exists(ObjectId(value)):
+            return ObjectId(value)
+        item_id = self.database.find_item(value)
+        if item_id is None:
+            raise ItemDoesNotExistError(value)
+        return item_id
+
     # Adds a new user to the database and sends a welcome message as a response to the interaction
     async def add_and_welcome_new_user(self, inter: Interaction, user: User):
         wallet, bank_capacity = await self.database.add_user(user)
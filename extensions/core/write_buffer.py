@@ -0,0 +1,212 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Hashable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from bot import AlisUnnamedBot
+
+# Error code MongoDB gives when a document with the same _id already exists
+DUPLICATE_KEY_ERROR: int = 11000
+
+
+# Base class for buffers that collect writes to collection in memory, and write them in batches
+# Pending writes are flushed every flush_interval_ms, as soon as max_pending writes are pending, and when the buffer
+# is stopped. Subclasses decide how writes are collected and written.
+class BatchBuffer(ABC):
+    def __init__(self, bot: AlisUnnamedBot, collection: Optional[AsyncIOMotorCollection], name: str,
+                 flush_interval_ms: int = 1000, max_pending: int = 500):
+        self.bot = bot
+        self.collection = collection
+        self.name = name  # Used in metric names
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.flush_lock = asyncio.Lock()
+        self.flush_task: Optional[asyncio.Task] = None  # Flush started early because the buffer filled up
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    # Stops flushing periodically, and flushes anything still pending
+    async def stop(self):
+        if self.task:
+            # A flush in progress has already taken its batch, so cancelling it would lose the batch
+            # Holding the lock waits for it to finish, and leaves the task either sleeping or waiting for the lock
+            async with self.flush_lock:
+                self.task.cancel()
+                self.task = None
+        if self.flush_task:
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    @abstractmethod
+    def pending_count(self) -> int:
+        pass
+
+    # Removes and returns every pending write
+    @abstractmethod
+    def take(self) -> Any:
+        pass
+
+    # Writes batch, putting any writes that failed back into the buffer to be retried
+    # Returns the number of writes that succeeded
+    @abstractmethod
+    async def write(self, batch: Any) -> int:
+        pass
+
+    # Called by subclasses after adding a write
+    def on_added(self):
+        pending = self.pending_count()
+        self.bot.metrics.set_gauge(f"write_buffer.{self.name}.pending", pending)
+        if pending >= self.max_pending and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending_count():
+                return
+            batch = self.take()
+            start = time.perf_counter()
+            try:
+                written = await self.write(batch)
+                self.bot.metrics.increment(f"write_buffer.{self.name}.flushed", written)
+            finally:
+                self.bot.metrics.observe(f"write_buffer.{self.name}.flush", time.perf_counter() - start)
+                self.bot.metrics.set_gauge(f"write_buffer.{self.name}.pending", self.pending_count())
+
+    def on_error(self, message: str):
+        self.bot.metrics.increment(f"write_buffer.{self.name}.errors")
+        self.bot.logger.error(message)
+
+
+# Accumulates $inc deltas for documents in collection, and writes them in a single unordered bulk_write
+# Used for fields that are fine to be eventually consistent, such as activity counters, so that frequent events
+# don't each need their own write. max_pending is the number of documents with pending deltas.
+class WriteBehindBuffer(BatchBuffer):
+    def __init__(self, bot: AlisUnnamedBot, collection: AsyncIOMotorCollection, name: str,
+                 flush_interval_ms: int = 1000, max_pending: int = 500):
+        super().__init__(bot, collection, name, flush_interval_ms, max_pending)
+        self.pending: dict[Hashable, dict[str, int]] = {}  # Maps document ids to the deltas to $inc them by
+
+    # Adds deltas, such as {"exp": 1}, to the pending deltas of the document with _id key
+    def increment(self, key: Hashable, deltas: dict[str, int]):
+        pending = self.pending.setdefault(key, {})
+        for field, delta in deltas.items():
+            pending[field] = pending.get(field, 0) + delta
+        self.on_added()
+
+    # Puts deltas that failed to be written back into the buffer, so they are retried by the next flush
+    def restore(self, batch: dict[Hashable, dict[str, int]]):
+        for key, deltas in batch.items():
+            pending = self.pending.setdefault(key, {})
+            for field, delta in deltas.items():
+                pending[field] = pending.get(field, 0) + delta
+
+    def pending_count(self) -> int:
+        return len(self.pending)
+
+    def take(self) -> dict[Hashable, dict[str, int]]:
+        batch, self.pending = self.pending, {}
+        return batch
+
+    async def write(self, batch: dict[Hashable, dict[str, int]]) -> int:
+        keys = list(batch)
+        requests = [UpdateOne({"_id": key}, {"$inc": batch[key]}) for key in keys]
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as error:
+            # The other writes in an unordered bulk write still succeed, so only retry the ones that failed
+            failed = {keys[write_error["index"]] for write_error in error.details.get("writeErrors", [])}
+            self.restore({key: batch[key] for key in failed})
+            self.on_error(f"Failed to flush {len(failed)} of {len(keys)} buffered '{self.name}' writes")
+            return len(keys) - len(failed)
+        except PyMongoError as error:
+            self.restore(batch)
+            self.on_error(f"Failed to flush buffered '{self.name}' writes: {error}")
+            return 0
+        return len(keys)
+
+
+# Accumulates documents to insert into collection, and inserts them with a single unordered insert_many
+# Used for append-only records, such as the ledger, so inserting them isn't on the critical path of commands.
+# Documents should be given an _id when added, so that retrying an insert can't add the same document twice. This
+# relies on the unique _id index, which time series collections don't have, so collection must be an ordinary one.
+class InsertBuffer(BatchBuffer):
+    def __init__(self, bot: AlisUnnamedBot, collection: AsyncIOMotorCollection, name: str,
+                 flush_interval_ms: int = 1000, max_pending: int = 500):
+        super().__init__(bot, collection, name, flush_interval_ms, max_pending)
+        self.pending: list[dict] = []
+
+    def insert(self, document: dict):
+        self.pending.append(document)
+        self.on_added()
+
+    def pending_count(self) -> int:
+        return len(self.pending)
+
+    def take(self) -> list[dict]:
+        batch, self.pending = self.pending, []
+        return batch
+
+    async def write(self, batch: list[dict]) -> int:
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as error:
+            # Documents that already exist were inserted by an earlier attempt, so only retry the other failures
+            failed = [write_error["index"] for write_error in error.details.get("writeErrors", [])
+                      if write_error.get("code") != DUPLICATE_KEY_ERROR]
+            self.pending[:0] = [batch[index] for index in failed]
+            if failed:
+                self.on_error(f"Failed to flush {len(failed)} of {len(batch)} buffered '{self.name}' inserts")
+            return len(batch) - len(failed)
+        except PyMongoError as error:
+            self.pending[:0] = batch
+            self.on_error(f"Failed to flush buffered '{self.name}' inserts: {error}")
+            return 0
+        return len(batch)
+
+
+# Accumulates records, and writes each batch of them by awaiting write_batch, such as to write a batch to several
+# collections in a single transaction. A batch that fails isn't retried, since it may no longer make sense to write
+# it as it was. handle_failure is given it instead, so the owner can recover, such as by reloading from the database.
+class CallbackBuffer(BatchBuffer):
+    def __init__(self, bot: AlisUnnamedBot, name: str, write_batch: Callable, handle_failure: Callable,
+                 flush_interval_ms: int = 1000, max_pending: int = 500):
+        super().__init__(bot, None, name, flush_interval_ms, max_pending)
+        self.write_batch = write_batch
+        self.handle_failure = handle_failure
+        self.pending: list = []
+
+    def add(self, record: Any):
+        self.pending.append(record)
+        self.on_added()
+
+    def pending_count(self) -> int:
+        return len(self.pending)
+
+    def take(self) -> list:
+        batch, self.pending = self.pending, []
+        return batch
+
+    async def write(self, batch: list) -> int:
+        try:
+            await self.write_batch(batch)
+        except Exception as error:
+            self.on_error(f"Failed to write {len(batch)} buffered '{self.name}' records: {error}")
+            self.handle_failure(batch)
+            return 0
+        return len(batch)
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info("Loading Write Buffer extension...")
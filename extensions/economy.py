@@ -1,14 +1,32 @@
-from typing import Optional
+import asyncio
+import time
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal
+from typing import Optional, Callable
 
+from bson import ObjectId, Decimal128
 from nextcord import slash_command, Interaction, Embed, User, SlashOption, Colour
+from nextcord.ext.application_checks import is_owner
 
 from bot import AlisUnnamedBot
-from extensions.core.emojis import ARROW_RIGHT_ANIMATED, WALLET, BANK, MONEY_BAG
-from extensions.core.utils import AlisUnnamedBotCog, EmbedError, AMOUNT_DESCRIPTION
+from scheduler import CronTrigger, JobAlreadyRunningError
+from extensions.core.cache import LRUCache, MISSING
+from extensions.core.emojis import ARROW_RIGHT_ANIMATED, WALLET, BANK, MONEY_BAG, TICK
+from extensions.core.database import BalanceUpdateConflictError, PAYMENT, DEPOSIT, WITHDRAWAL, TRADE, \
+    MARKET
+from extensions.core.ui import PagedListMenu
+from extensions.core.utils import AlisUnnamedBotCog, EmbedError, HiddenEmbedError, AMOUNT_DESCRIPTION, send_response, \
+    split_field_lines
 from extensions.user import UserDoesNotExistError
 
 PLEASE_PAY_US = "**:money_with_wings: #PayTheRobots :money_with_wings:**"
 
+# Name of the bank interest job, used for its schedule and to save its progress
+BANK_INTEREST_JOB = "bank_interest"
+
+# Name of the job that rolls up each day's economy stats
+ECONOMY_ROLLUP_JOB = "economy_rollup"
+
 
 class BotsHaveNoBalanceError(EmbedError):
     def __init__(self, currency_name: str):
@@ -58,16 +76,188 @@ class InsufficientBankSpaceError(EmbedError):
                          f"There isn't space for `{required_funds}` in your `Bank`")
 
 
+class BalanceBusyError(HiddenEmbedError):
+    def __init__(self):
+        super().__init__("**Slow Down!**",
+                         f"Your balance is changing too quickly for me to keep up! Please try again in a moment...")
+
+
 class CannotPayYourselfError(EmbedError):
     def __init__(self):
         super().__init__("**Invalid Argument**",
                          f"You cannot pay yourself you melon!")
 
 
+class InterestAlreadyRunningError(HiddenEmbedError):
+    def __init__(self):
+        super().__init__("**Already Running**",
+                         f"Interest is already being paid, please wait for it to finish")
+
+
 class EconomyCog(AlisUnnamedBotCog):
     def __init__(self, bot: AlisUnnamedBot):
         super().__init__(bot)
         self.currency_name = bot.config.get("currency_name")
+        # Maps (user id, view, user version) to the rendered embed description for that view
+        self.render_cache = LRUCache(bot.config.get("render_cache_size", 1024))
+        schedule = bot.config.get("bank_interest", {}).get("schedule", "0 0 * * *")
+        bot.scheduler.register(BANK_INTEREST_JOB, CronTrigger(schedule), self.pay_bank_interest)
+        schedule = bot.config.get("economy_rollup", {}).get("schedule", "5 0 * * *")
+        bot.scheduler.register(ECONOMY_ROLLUP_JOB, CronTrigger(schedule), self.roll_up_economy)
+
+    def cog_unload(self):
+        self.bot.scheduler.unregister(BANK_INTEREST_JOB)
+        self.bot.scheduler.unregister(ECONOMY_ROLLUP_JOB)
+
+    # Updates the user's balance with DatabaseCog.update_user_balance, and returns the old and new balance
+    async def update_balance(self, user: User, update: Callable[[dict], tuple[Decimal, Decimal]]) -> tuple[dict, dict]:
+        try:
+            return await self.database.update_user_balance(user, update)
+        except BalanceUpdateConflictError:
+            raise BalanceBusyError
+
+    # Pays interest on every user's bank, "rate" in the "bank_interest" config, without going over their bank capacity
+    # Users are paid in chunks of "chunk_size" users, in _id order, with a pause of "chunk_delay_ms" between chunks
+    # so the database isn't overwhelmed. Progress is saved after each chunk, so if the bot stops part way through,
+    # the run is resumed rather than started again the next time the job runs.
+    # Run by the scheduler, so only one process pays interest at a time.
+    # Returns the number of users paid interest by this call, and how many seconds it took
+    async def pay_bank_interest(self) -> tuple[int, float]:
+        config = self.bot.config.get("bank_interest", {})
+        chunk_size = config.get("chunk_size", 5000)
+        chunk_delay = config.get("chunk_delay_ms", 100) / 1000
+
+        run = await self.database.get_job_run(BANK_INTEREST_JOB)
+        if run and not run.get("finished"):
+            run_id = run.get("runId")
+            rate = self.utils.to_decimal(run.get("rate"))
+            after_id = run.get("lastId")
+            previous_rows = run.get("rows", 0)
+            self.bot.logger.info(f"Resuming bank interest run {run_id} after user {after_id}")
+        else:
+            run_id = ObjectId()
+            rate = self.utils.to_decimal(config.get("rate", 0))
+            after_id = None
+            previous_rows = 0
+            await self.database.save_job_run(BANK_INTEREST_JOB, {
+                "runId": run_id,
+                "rate": str(rate),  # Kept, so a resumed run pays the same rate even if the config changes
+                "lastId": None,
+                "rows": 0,
+                "startedAt": datetime.now(timezone.utc),
+                "finished": False
+            })
+            self.bot.logger.info(f"Starting bank interest run {run_id} at a rate of {rate}")
+
+        rows = 0
+        start = time.perf_counter()
+        while True:
+            chunk_start = time.perf_counter()
+            until_id = await self.database.get_users_chunk_end(after_id, chunk_size)
+            chunk_rows = await self.database.apply_bank_interest(run_id, rate, after_id, until_id)
+            rows += chunk_rows
+            finished = until_id is None
+            await self.database.save_job_run(BANK_INTEREST_JOB, {
+                "lastId": until_id,
+                "rows": previous_rows + rows,
+                "finished": finished,
+                **({"finishedAt": datetime.now(timezone.utc)} if finished else {})
+            })
+
+            self.bot.metrics.observe("bank_interest.chunk", time.perf_counter() - chunk_start)
+            self.bot.metrics.increment("bank_interest.rows", chunk_rows)
+            elapsed = time.perf_counter() - start
+            self.bot.metrics.set_gauge("bank_interest.rows_per_second", rows / elapsed if elapsed else 0.0)
+            if finished:
+                break
+            after_id = until_id
+            await asyncio.sleep(chunk_delay)
+
+        elapsed = time.perf_counter() - start
+        self.bot.logger.info(f"Finished bank interest run {run_id}: paid {rows} users in {elapsed:.2f}s "
+                             f"({rows / elapsed if elapsed else 0:.0f} rows/s)")
+        return rows, elapsed
+
+    # Saves a rollup of the economy for the last full day (UTC), so stats can be viewed without scanning every user
+    # Wealth stats are a snapshot taken when the job runs, shortly after the day ends, and transfer stats come from
+    # that day's ledger entries
+    async def roll_up_economy(self):
+        percentiles = self.bot.config.get("economy_rollup", {}).get("percentiles", [0.5, 0.9, 0.99])
+        day_end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        day_start = day_end - timedelta(days=1)
+
+        wealth = await self.database.get_wealth_stats(percentiles)
+        summary = await self.database.get_ledger_summary(day_start, day_end)
+        await self.database.save_economy_rollup(day_start, {
+            "moneySupply": Decimal128(wealth.get("wallet") + wealth.get("bank")),
+            "wallet": Decimal128(wealth.get("wallet")),
+            "bank": Decimal128(wealth.get("bank")),
+            "users": wealth.get("users"),
+            "percentiles": [{"p": percentile, "value": Decimal128(value)}
+                            for percentile, value in zip(percentiles, wealth.get("percentiles"))],
+            "transferVolume": Decimal128(summary.get("transferVolume")),
+            "transfers": summary.get("transfers"),
+            "depositVolume": Decimal128(summary.get("depositVolume")),
+            "withdrawalVolume": Decimal128(summary.get("withdrawalVolume")),
+            "activeUsers": summary.get("activeUsers"),
+            "computedAt": datetime.now(timezone.utc)
+        })
+        self.bot.logger.info(f"Rolled up economy stats for {day_start:%Y-%m-%d}")
+
+    @is_owner()
+    @slash_command(description="View daily economy stats.")
+    async def economy(self, inter: Interaction,
+                      days: int = SlashOption(
+                          description="How many days of transfer stats to show.",
+                          min_value=1,
+                          max_value=30,
+                          default=7
+                      )):
+        rollups = await self.database.get_economy_rollups(days)
+        embed = Embed()
+        embed.title = "**Economy**"
+        embed.colour = self.bot.config.get("colour")
+        if not rollups:
+            embed.description = "*No stats have been rolled up yet*"
+            return await send_response(inter, embed=embed, ephemeral=True)
+
+        latest = rollups[0]
+        money_supply = self.utils.to_currency_str(latest.get("moneySupply"))
+        embed.description = f"{MONEY_BAG} **Money Supply: `{money_supply}`**\n" \
+                            f"{WALLET} **Wallets: `{self.utils.to_currency_str(latest.get('wallet'))}`**\n" \
+                            f"{BANK} **Banks: `{self.utils.to_currency_str(latest.get('bank'))}`**\n" \
+                            f"**Users: `{latest.get('users'):,}`**"
+        embed.add_field(name="Wealth Percentiles",
+                        value="\n".join(f"p{percentile.get('p') * 100:g}: "
+                                        f"`{self.utils.to_currency_str(percentile.get('value'))}`"
+                                        for percentile in latest.get("percentiles", [])) or "*None*",
+                        inline=False)
+        transfer_lines = [f"`{rollup.get('_id'):%Y-%m-%d}`: "
+                          f"`{self.utils.to_currency_str(rollup.get('transferVolume'))}` "
+                          f"in `{rollup.get('transfers'):,}` payments, "
+                          f"`{rollup.get('activeUsers'):,}` active users"
+                          for rollup in rollups]
+        # Many days don't fit in a single field, so they are split across as many as they need
+        for index, value in enumerate(split_field_lines(transfer_lines)):
+            embed.add_field(name="Daily Transfers" if index == 0 else "Daily Transfers (continued)", value=value,
+                            inline=False)
+        embed.set_footer(text=f"Wealth as of {latest.get('computedAt'):%Y-%m-%d %H:%M} UTC")
+        await send_response(inter, embed=embed, ephemeral=True)
+
+    @is_owner()
+    @slash_command(description="Pay interest on every user's bank now.")
+    async def interest(self, inter: Interaction):
+        await inter.response.defer()
+        try:
+            rows, elapsed = await self.bot.scheduler.run_now(BANK_INTEREST_JOB)
+        except JobAlreadyRunningError:
+            raise InterestAlreadyRunningError
+        embed = Embed()
+        embed.title = "**Bank Interest**"
+        embed.colour = Colour.green()
+        embed.description = f"{TICK} **Paid interest to `{rows:,}` users in `{elapsed:.2f}s`** " \
+                            f"(`{rows / elapsed if elapsed else 0:,.0f}` users/s)"
+        await inter.send(embed=embed)
 
     @slash_command(description="Check your, or another user's, balance.")
     async def balance(self, inter: Interaction,
@@ -80,20 +270,27 @@ class EconomyCog(AlisUnnamedBotCog):
             user = inter.user
         elif user.bot:
             raise BotsHaveNoBalanceError(self.currency_name)
-        elif not await self.database.user_exists(user):
+        versions = await self.database.get_user_versions(user)
+        if versions is None:
             raise UserDoesNotExistError(user)
-        balance = await self.database.get_user_balance(user)
-        wallet = balance.get("wallet")
-        bank = balance.get("bank")
-        bank_capacity = balance.get("bankCap")
+
+        cache_key = (user.id, "balance", versions.get("version"))
+        embed_desc = self.render_cache.get(cache_key)
+        if embed_desc is MISSING:
+            balance = await self.database.get_user_balance(user)
+            wallet = balance.get("wallet")
+            bank = balance.get("bank")
+            bank_capacity = balance.get("bankCap")
+            embed_desc = f"{WALLET} **Wallet: `{self.utils.to_currency_str(wallet)}`**\n" \
+                         f"{BANK} **Bank: `{self.utils.to_currency_str(bank)}` / " \
+                         f"`{self.utils.to_currency_str(bank_capacity)}`**\n" \
+                         f"{MONEY_BAG} **Total: `{self.utils.to_currency_str(wallet + bank)}`**"
+            self.render_cache.set(cache_key, embed_desc)
 
         embed = Embed()
         embed.set_author(name=f"{user.name}'s Balance", icon_url=user.avatar.url)
         embed.colour = self.bot.config.get("colour")
-        embed.description = f"{WALLET} **Wallet: `{self.utils.to_currency_str(wallet)}`**\n" \
-                            f"{BANK} **Bank: `{self.utils.to_currency_str(bank)}` / " \
-                            f"`{self.utils.to_currency_str(bank_capacity)}`**\n" \
-                            f"{MONEY_BAG} **Total: `{self.utils.to_currency_str(wallet + bank)}`**"
+        embed.description = embed_desc
         await inter.send(embed=embed)
 
     @slash_command(description=f"Transfer currency from your bank to your wallet.")
@@ -104,32 +301,34 @@ class EconomyCog(AlisUnnamedBotCog):
         user = inter.user
         if not await self.database.user_exists(user):
             return await self.utils.add_and_welcome_new_user(inter, user)
-        balance = await self.database.get_user_balance(user)
-        bank = balance.get("bank")
-        bank_capacity = balance.get("bankCap")
-
-        if amount.lower() == "all":
-            withdrew = bank
-        elif self.utils.is_decimal(amount):
-            withdrew = self.utils.to_currency_value(amount)
-        elif self.utils.is_percentage(amount):
-            multiplier = self.utils.to_decimal(amount.replace("%", "")) / 100
-            withdrew = self.utils.to_currency_value(bank * multiplier)
-        else:
-            raise InvalidCurrencyAmountError(amount)
-
-        if withdrew < 0:
-            raise InvalidCurrencyAmountError(amount)
-        if withdrew == 0:
-            raise CurrencyAmountTooLowError()
-        if withdrew > bank:
-            raise InsufficientBankFundsError(self.utils.to_currency_str(withdrew))
 
-        wallet = balance.get("wallet")
-        new_wallet = wallet + withdrew
-        new_bank = bank - withdrew
-        await self.database.set_user_wallet(user, new_wallet)
-        await self.database.set_user_bank(user, new_bank)
+        def withdraw_from_bank(balance: dict) -> tuple[Decimal, Decimal]:
+            bank = balance.get("bank")
+            if amount.lower() == "all":
+                withdrew = bank
+            elif self.utils.is_decimal(amount):
+                withdrew = self.utils.to_currency_value(amount)
+            elif self.utils.is_percentage(amount):
+                multiplier = self.utils.to_decimal(amount.replace("%", "")) / 100
+                withdrew = self.utils.to_currency_value(bank * multiplier)
+            else:
+                raise InvalidCurrencyAmountError(amount)
+
+            if withdrew < 0:
+                raise InvalidCurrencyAmountError(amount)
+            if withdrew == 0:
+                raise CurrencyAmountTooLowError()
+            if withdrew > bank:
+                raise InsufficientBankFundsError(self.utils.to_currency_str(withdrew))
+
+            return balance.get("wallet") + withdrew, bank - withdrew
+
+        old_balance, new_balance = await self.update_balance(user, withdraw_from_bank)
+        new_wallet = new_balance.get("wallet")
+        new_bank = new_balance.get("bank")
+        bank_capacity = new_balance.get("bankCap")
+        withdrew = new_wallet - old_balance.get("wallet")
+        self.database.record_transaction(user.id, WITHDRAWAL, withdrew)
 
         embed = Embed()
         embed.title = "**Bank Withdrawal**"
@@ -148,36 +347,40 @@ class EconomyCog(AlisUnnamedBotCog):
         user = inter.user
         if not await self.database.user_exists(user):
             return await self.utils.add_and_welcome_new_user(inter, user)
-        balance = await self.database.get_user_balance(user)
-        wallet = balance.get("wallet")
-        bank = balance.get("bank")
-        bank_capacity = balance.get("bankCap")
-        bank_space = bank_capacity - bank
-
-        if amount.lower() == "all":
-            deposited = min(wallet, bank_space)
-        elif self.utils.is_decimal(amount):
-            deposited = self.utils.to_currency_value(amount)
-        elif self.utils.is_percentage(amount):
-            multiplier = self.utils.to_decimal(amount.replace("%", "")) / 100
-            deposited = self.utils.to_currency_value(wallet * multiplier)
-        else:
-            raise InvalidCurrencyAmountError(amount)
 
-        if deposited < 0:
-            raise InvalidCurrencyAmountError(amount)
-        if deposited == 0:
-            raise CurrencyAmountTooLowError()
-        if deposited > wallet:
-            raise InsufficientWalletFundsError(self.utils.to_currency_str(deposited))
-
-        if deposited > bank_space:
-            raise InsufficientBankSpaceError(self.utils.to_currency_str(deposited))
-
-        new_wallet = wallet - deposited
-        new_bank = bank + deposited
-        await self.database.set_user_wallet(user, new_wallet)
-        await self.database.set_user_bank(user, new_bank)
+        def deposit_into_bank(balance: dict) -> tuple[Decimal, Decimal]:
+            wallet = balance.get("wallet")
+            bank = balance.get("bank")
+            bank_space = balance.get("bankCap") - bank
+
+            if amount.lower() == "all":
+                deposited = min(wallet, bank_space)
+            elif self.utils.is_decimal(amount):
+                deposited = self.utils.to_currency_value(amount)
+            elif self.utils.is_percentage(amount):
+                multiplier = self.utils.to_decimal(amount.replace("%", "")) / 100
+                deposited = self.utils.to_currency_value(wallet * multiplier)
+            else:
+                raise InvalidCurrencyAmountError(amount)
+
+            if deposited < 0:
+                raise InvalidCurrencyAmountError(amount)
+            if deposited == 0:
+                raise CurrencyAmountTooLowError()
+            if deposited > wallet:
+                raise InsufficientWalletFundsError(self.utils.to_currency_str(deposited))
+
+            if deposited > bank_space:
+                raise InsufficientBankSpaceError(self.utils.to_currency_str(deposited))
+
+            return wallet - deposited, bank + deposited
+
+        old_balance, new_balance = await self.update_balance(user, deposit_into_bank)
+        new_wallet = new_balance.get("wallet")
+        new_bank = new_balance.get("bank")
+        bank_capacity = new_balance.get("bankCap")
+        deposited = new_bank - old_balance.get("bank")
+        self.database.record_transaction(user.id, DEPOSIT, deposited)
 
         embed = Embed()
         embed.title = "**Bank Deposit**"
@@ -206,9 +409,8 @@ class EconomyCog(AlisUnnamedBotCog):
             raise CannotPayYourselfError
         elif not await self.database.user_exists(recipient):
             raise UserDoesNotExistError(recipient)
-        user_balance = await self.database.get_user_balance(user)
-        user_wallet = user_balance.get("wallet")
 
+        user_wallet = (await self.database.get_user_balance(user)).get("wallet")
         if amount.lower() == "all":
             transferred = user_wallet
         elif self.utils.is_decimal(amount):
@@ -226,12 +428,17 @@ class EconomyCog(AlisUnnamedBotCog):
         if transferred > user_wallet:
             raise InsufficientWalletFundsError(self.utils.to_currency_str(transferred))
 
-        recipient_balance = await self.database.get_user_balance(recipient)
-        recipient_wallet = recipient_balance.get("wallet")
-        new_recipient_wallet = recipient_wallet + transferred
-        new_user_wallet = user_wallet - transferred
-        await self.database.set_user_wallet(recipient, new_recipient_wallet)
-        await self.database.set_user_wallet(user, new_user_wallet)
+        # Take the money from the user and give it to the recipient in one transaction, so it can't be lost between
+        try:
+            wallets = await self.database.transfer_between_wallets(user, recipient, transferred)
+        except BalanceUpdateConflictError:
+            raise UserDoesNotExistError(recipient)
+        if wallets is None:
+            # Spent by something else since the balance was read
+            raise InsufficientWalletFundsError(self.utils.to_currency_str(transferred))
+        new_user_wallet, new_recipient_wallet = wallets
+        self.database.record_transaction(user.id, PAYMENT, -transferred, recipient.id)
+        self.database.record_transaction(recipient.id, PAYMENT, transferred, user.id)
 
         embed = Embed()
         embed.title = f"**Payment**"
@@ -242,6 +449,52 @@ class EconomyCog(AlisUnnamedBotCog):
                             f"**{recipient.mention}'s {WALLET} Wallet: `{self.utils.to_currency_str(new_recipient_wallet)}`**"
         await inter.send(embed=embed)
 
+    # Returns the rendered lines for a page of the user's transactions, the ts and _id of the last transaction on the
+    # page, and whether there is a next page
+    async def fetch_transactions_page(self, user: User, after: Optional[tuple[datetime, ObjectId]]
+                                      ) -> tuple[list[str], Optional[tuple[datetime, ObjectId]], bool]:
+        page_size = self.bot.config.get("inventory_page_size", 15)
+        entries, has_next = await self.database.get_user_transactions_page(user, after, page_size)
+        lines = []
+        for entry in entries:
+            # MongoDB returns naive datetimes, which are in UTC
+            timestamp = int(entry.get("ts").replace(tzinfo=timezone.utc).timestamp())
+            amount = entry.get("amount")
+            transaction_type = entry.get("type")
+            if transaction_type == DEPOSIT:
+                desc = f"{BANK} Deposited `{self.utils.to_currency_str(amount)}`"
+            elif transaction_type == WITHDRAWAL:
+                desc = f"{WALLET} Withdrew `{self.utils.to_currency_str(amount)}`"
+            elif transaction_type == TRADE:
+                direction = "to" if amount < 0 else "from"
+                desc = f"{MONEY_BAG} Traded `{self.utils.to_currency_str(abs(amount))}` {direction} " \
+                       f"<@{entry.get('counterpartyId')}>"
+            elif transaction_type == MARKET:
+                action = "Bought items from" if amount < 0 else "Sold items to"
+                desc = f"{MONEY_BAG} {action} <@{entry.get('counterpartyId')}> " \
+                       f"for `{self.utils.to_currency_str(abs(amount))}`"
+            elif amount < 0:
+                desc = f"{ARROW_RIGHT_ANIMATED} Paid `{self.utils.to_currency_str(-amount)}` " \
+                       f"to <@{entry.get('counterpartyId')}>"
+            else:
+                desc = f"{MONEY_BAG} Received `{self.utils.to_currency_str(amount)}` " \
+                       f"from <@{entry.get('counterpartyId')}>"
+            lines.append(f"<t:{timestamp}:f> {desc}")
+        last = (entries[-1].get("ts"), entries[-1].get("_id")) if entries else after
+        return lines, last, has_next
+
+    @slash_command(description="View your transaction history.")
+    async def transactions(self, inter: Interaction):
+        user = inter.user
+        if not await self.database.user_exists(user):
+            return await self.utils.add_and_welcome_new_user(inter, user)
+
+        menu = PagedListMenu(fetch_page=lambda after: self.fetch_transactions_page(user, after),
+                             empty_text="*You haven't made any transactions yet*",
+                             author_name=f"{user.name}'s Transactions", author_icon_url=user.avatar.url,
+                             original_inter=inter, colour=self.bot.config.get("colour"))
+        await menu.send_or_update_menu()
+
 
 def setup(bot: AlisUnnamedBot, **kwargs):
     bot.logger.info(f"Loading Economy extension...")
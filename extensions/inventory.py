@@ -2,16 +2,22 @@ from typing import Optional
 
 from bson import ObjectId
 from nextcord import slash_command, Interaction, User, SlashOption, Embed, Colour
+from nextcord.ext.application_checks import is_owner
 
 from bot import AlisUnnamedBot
+from extensions.core.cache import LRUCache, MISSING
 from extensions.core.database import BAG, HOME
 from extensions.core.emojis import BACKPACK
-from extensions.core.ui import SelectUserItemsMenu
+from extensions.core.search import MAX_AUTOCOMPLETE_CHOICES
+from extensions.core.ui import SelectUserItemsMenu, PagedListMenu
 from extensions.core.utils import AlisUnnamedBotCog, EmbedError, ItemSlashOption, AMOUNT_DESCRIPTION
 from extensions.user import UserDoesNotExistError
 
 IN_BAG = f"- ***In {BACKPACK} Bag***"
 
+# Most different items to list in the response to /loot, so that many rolls can't go over the description limit
+MAX_LISTED_LOOT = 20
+
 
 class BotsDoNotHaveInventoriesError(EmbedError):
     def __init__(self):
@@ -50,9 +56,46 @@ class ItemNotFoundInInventoryError(EmbedError):
                          f"*The {item_name} may be in your {BACKPACK} **Bag** instead...*")
 
 
+class LootTableDoesNotExistError(EmbedError):
+    def __init__(self, table_name: str):
+        super().__init__("**Invalid Argument**",
+                         f"There is no loot table called `{table_name}`")
+
+
 class InventoryCog(AlisUnnamedBotCog):
     def __init__(self, bot: AlisUnnamedBot):
         super().__init__(bot)
+        # Maps (user id, view, inventory version, page start) to the rendered page for that view
+        self.render_cache = LRUCache(bot.config.get("render_cache_size", 1024))
+
+    # Returns the rendered lines for a page of the user's items at location (or at any location if location is None),
+    # the _id of the last item on the page, and whether there is a next page
+    async def fetch_inventory_page(self, user: User, location: Optional[int],
+                                   after: Optional[ObjectId]) -> tuple[list[str], Optional[ObjectId], bool]:
+        versions = await self.database.get_user_versions(user)
+        view = "inventory" if location is None else "bag"
+        cache_key = (user.id, view, versions.get("inventoryVersion") if versions else None, after)
+        page = self.render_cache.get(cache_key)
+        if page is MISSING:
+            page_size = self.bot.config.get("inventory_page_size", 15)
+            user_items, has_next = await self.database.get_user_inventory_page(user, location, after, page_size)
+            item_list = []
+            for user_item in user_items:
+                user_item_id = user_item.get("_id")
+                item_id = user_item.get("itemId")
+                item_location = user_item.get("location", HOME)
+                quantity = 1 if await self.database.item_is_unique(item_id) else user_item.get("quantity", 0)
+                if quantity > 0:
+                    name = await self.database.get_user_item_name(user_item_id, quantity)
+                    item_desc = f"`{quantity}` **{name}**"
+                    # Only show which items are in the bag when viewing the whole inventory
+                    if location is None and item_location == BAG:
+                        item_desc += f" {IN_BAG}"
+                    item_list.append(item_desc)
+            last_id = user_items[-1].get("_id") if user_items else after
+            page = (item_list, last_id, has_next)
+            self.render_cache.set(cache_key, page)
+        return page
 
     @slash_command(description="View your own, or another user's, inventory.")
     async def inventory(self, inter: Interaction,
@@ -67,30 +110,13 @@ class InventoryCog(AlisUnnamedBotCog):
             raise BotsDoNotHaveInventoriesError
         elif not await self.database.user_exists(user):
             raise UserDoesNotExistError(user)
-        inventory = await self.database.get_user_inventory(user)
-
-        item_list = []
-        for user_item in inventory:
-            user_item_id = user_item.get("_id")
-            item_id = user_item.get("itemId")
-            location = user_item.get("location", HOME)
-            quantity = 1 if await self.database.item_is_unique(item_id) else user_item.get("quantity", 0)
-            if quantity > 0:
-                name = await self.database.get_user_item_name(user_item_id, quantity)
-                item_desc = f"`{quantity}` **{name}**"
-                item_list.append(item_desc + f" {IN_BAG}" if location == BAG else item_desc)
-
-        if item_list:
-            embed_desc = "- " + "\n- ".join(item_list)
-        else:
-            subject = "You don't" if user.id == inter.user.id else f"{user.mention} doesn't"
-            embed_desc = f"*{subject} own any items*"
 
-        embed = Embed()
-        embed.set_author(name=f"{user.name}'s Inventory", icon_url=user.avatar.url)
-        embed.colour = self.bot.config.get("colour")
-        embed.description = embed_desc
-        await inter.send(embed=embed)
+        subject = "You don't" if user.id == inter.user.id else f"{user.mention} doesn't"
+        menu = PagedListMenu(fetch_page=lambda after: self.fetch_inventory_page(user, None, after),
+                             empty_text=f"*{subject} own any items*",
+                             author_name=f"{user.name}'s Inventory", author_icon_url=user.avatar.url,
+                             original_inter=inter, colour=self.bot.config.get("colour"))
+        await menu.send_or_update_menu()
 
     @slash_command(description="View the contents of your own, or another user's, bag.")
     async def bag(self, inter: Interaction,
@@ -105,28 +131,13 @@ class InventoryCog(AlisUnnamedBotCog):
             raise BotsDoNotHaveInventoriesError
         elif not await self.database.user_exists(user):
             raise UserDoesNotExistError(user)
-        bag = await self.database.get_user_bag(user)
-
-        item_list = []
-        for user_item in bag:
-            user_item_id = user_item.get("_id")
-            item_id = user_item.get("itemId")
-            quantity = 1 if await self.database.item_is_unique(item_id) else user_item.get("quantity", 0)
-            if quantity > 0:
-                name = await self.database.get_user_item_name(user_item_id, quantity)
-                item_list.append(f"`{quantity}` **{name}**")
-
-        if item_list:
-            embed_desc = "- " + "\n- ".join(item_list)
-        else:
-            subject = "Your" if user.id == inter.user.id else f"{user.mention}'s"
-            embed_desc = f"*{subject} {BACKPACK} **Bag** is empty*"
 
-        embed = Embed()
-        embed.set_author(name=f"{user.name}'s Bag", icon_url=user.avatar.url)
-        embed.colour = self.bot.config.get("colour")
-        embed.description = embed_desc
-        await inter.send(embed=embed)
+        subject = "Your" if user.id == inter.user.id else f"{user.mention}'s"
+        menu = PagedListMenu(fetch_page=lambda after: self.fetch_inventory_page(user, BAG, after),
+                             empty_text=f"*{subject} {BACKPACK} **Bag** is empty*",
+                             author_name=f"{user.name}'s Bag", author_icon_url=user.avatar.url,
+                             original_inter=inter, colour=self.bot.config.get("colour"))
+        await menu.send_or_update_menu()
 
     @slash_command(description="Transfer items from your inventory to your bag.")
     async def bring(self, inter: Interaction,
@@ -141,7 +152,7 @@ class InventoryCog(AlisUnnamedBotCog):
         if not await self.database.user_exists(user):
             return await self.utils.add_and_welcome_new_user(inter, user)
 
-        item_id = ObjectId(item_id_string)
+        item_id = await self.utils.get_item_id_from_option(item_id_string)
 
         if await self.database.item_is_unique(item_id):
             item_plural_name = await self.database.get_item_plural_name(item_id)
@@ -189,6 +200,12 @@ class InventoryCog(AlisUnnamedBotCog):
                                 f"You left `{at_home}` **{item_name_at_home}** in your home inventory"
             await inter.send(embed=embed)
 
+    @bring.on_autocomplete("item_id_string")
+    async def bring_autocomplete(self, inter: Interaction, item_id_string: str):
+        # Only suggest items in the user's home inventory
+        choices = await self.database.search_user_items(inter.user, item_id_string, HOME)
+        await inter.response.send_autocomplete(choices)
+
     async def bring_selected_items(self, inter: Interaction, selected_items: list[ObjectId]):
         brought_items = selected_items
         if brought_items:
@@ -222,7 +239,7 @@ class InventoryCog(AlisUnnamedBotCog):
         if not await self.database.user_exists(user):
             return await self.utils.add_and_welcome_new_user(inter, user)
 
-        item_id = ObjectId(item_id_string)
+        item_id = await self.utils.get_item_id_from_option(item_id_string)
 
         if await self.database.item_is_unique(item_id):
             item_plural_name = await self.database.get_item_plural_name(item_id)
@@ -271,6 +288,12 @@ class InventoryCog(AlisUnnamedBotCog):
 
             await inter.send(embed=embed)
 
+    @leave.on_autocomplete("item_id_string")
+    async def leave_autocomplete(self, inter: Interaction, item_id_string: str):
+        # Only suggest items in the user's bag
+        choices = await self.database.search_user_items(inter.user, item_id_string, BAG)
+        await inter.response.send_autocomplete(choices)
+
     async def leave_selected_items(self, inter: Interaction, selected_items: list[ObjectId]):
         left_items = selected_items
         if left_items:
@@ -291,6 +314,58 @@ class InventoryCog(AlisUnnamedBotCog):
             embed.description = f"*No changes were made to your inventory...*"
             await inter.send(embed=embed)
 
+    @is_owner()
+    @slash_command(description="Give a user items drawn from a loot table.")
+    async def loot(self, inter: Interaction,
+                   table: str = SlashOption(
+                       description="The loot table to draw items from."
+                   ),
+                   rolls: int = SlashOption(
+                       description="How many items to draw.",
+                       min_value=1,
+                       max_value=10000,
+                       default=1
+                   ),
+                   user: Optional[User] = SlashOption(
+                       description="The user to give the items to. Defaults to you."
+                   )):
+        user = user or inter.user
+        if user.bot:
+            raise BotsDoNotHaveInventoriesError
+        elif not await self.database.user_exists(user):
+            raise UserDoesNotExistError(user)
+        loot_table = await self.database.get_loot_table(table)
+        if loot_table is None:
+            raise LootTableDoesNotExistError(table)
+
+        drops = loot_table.draw_many(rolls)
+        granted = await self.database.grant_user_items(user, drops)
+
+        item_list = []
+        ordered = sorted(granted.items(), key=lambda drop: drop[1], reverse=True)
+        for item_id, amount in ordered[:MAX_LISTED_LOOT]:
+            name = await self.database.get_item_name(item_id, amount)
+            item_list.append(f"`{amount}` **{name}**")
+        if len(ordered) > MAX_LISTED_LOOT:
+            item_list.append(f"*...and {len(ordered) - MAX_LISTED_LOOT} more*")
+        embed = Embed()
+        embed.title = "**Loot**"
+        embed.colour = Colour.gold()
+        if item_list:
+            embed.description = f"{user.mention} received from `{table}`:\n- " + "\n- ".join(item_list)
+        else:
+            embed.description = f"{user.mention} can't hold any more of what was drawn from `{table}`"
+        not_granted = rolls - sum(granted.values())
+        if not_granted:
+            embed.set_footer(text=f"{not_granted} unique items were over the limit, so weren't given")
+        await inter.send(embed=embed)
+
+    @loot.on_autocomplete("table")
+    async def loot_autocomplete(self, inter: Interaction, table: str):
+        await self.database.get_loot_table(table)  # Makes sure the loot tables are up to date
+        names = [name for name in self.database.loot_tables.names if name.lower().startswith(table.lower())]
+        await inter.response.send_autocomplete(names[:MAX_AUTOCOMPLETE_CHOICES])
+
 
 def setup(bot: AlisUnnamedBot, **kwargs):
     bot.logger.info(f"Loading Inventory extension...")
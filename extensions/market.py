@@ -0,0 +1,253 @@
+from decimal import Decimal
+from typing import Optional
+
+from bson import ObjectId
+from nextcord import slash_command, Interaction, User, SlashOption, Embed, Colour
+
+from bot import AlisUnnamedBot
+from extensions.core.database import HOME, OrderEscrowError, OrderBookConflictError
+from extensions.core.emojis import WALLET
+from extensions.core.order_book import BUY, SELL, Fill
+from extensions.core.ui import PagedListMenu
+from extensions.core.utils import AlisUnnamedBotCog, EmbedError, HiddenEmbedError, ItemSlashOption
+from extensions.economy import InvalidCurrencyAmountError, CurrencyAmountTooLowError, InsufficientWalletFundsError
+from extensions.inventory import InsufficientBelongingsError
+
+PRICE_DESCRIPTION = 'The price of each item, such as "1.20".'
+
+# Most fills to list in the response to an order
+MAX_LISTED_FILLS = 10
+
+# Most price levels to show on each side of an order book
+ORDER_BOOK_LEVELS = 10
+
+
+class UniqueItemsCannotBeTradedError(EmbedError):
+    def __init__(self, item_name: str):
+        super().__init__("**Invalid Argument**",
+                         f"**{item_name}** are unique, so they can't be bought or sold on the market")
+
+
+class OrderDoesNotExistError(EmbedError):
+    def __init__(self, order: str):
+        super().__init__("**Invalid Argument**",
+                         f"You don't have an open order `{order}`! Pick one of the suggested orders instead...")
+
+
+class OrderBusyError(HiddenEmbedError):
+    def __init__(self):
+        super().__init__("**Slow Down!**",
+                         f"That order has just changed! Please try again in a moment...")
+
+
+class MarketCog(AlisUnnamedBotCog):
+    def __init__(self, bot: AlisUnnamedBot):
+        super().__init__(bot)
+
+    def parse_price(self, price: str) -> Decimal:
+        if not self.utils.is_decimal(price):
+            raise InvalidCurrencyAmountError(price)
+        value = self.utils.to_currency_value(price)
+        if value < 0:
+            raise InvalidCurrencyAmountError(price)
+        if value == 0:
+            raise CurrencyAmountTooLowError()
+        return value
+
+    # Places an order for the user of inter to buy or sell quantity of an item at price each, after checking they have
+    # what the order needs to hold in escrow, and responds with any fills
+    async def place_order(self, inter: Interaction, side: str, item_id_string: str, quantity: int, price: str):
+        user = inter.user
+        if not await self.database.user_exists(user):
+            return await self.utils.add_and_welcome_new_user(inter, user)
+
+        item_id = await self.utils.get_item_id_from_option(item_id_string)
+        if await self.database.item_is_unique(item_id):
+            raise UniqueItemsCannotBeTradedError(await self.database.get_item_plural_name(item_id))
+        price = self.parse_price(price)
+        item_name = await self.database.get_item_name(item_id, quantity)
+
+        if side == BUY:
+            balance = await self.database.get_user_balance(user)
+            if balance.get("wallet") < price * quantity:
+                raise InsufficientWalletFundsError(self.utils.to_currency_str(price * quantity))
+        elif await self.database.get_user_item_quantity(user, item_id, HOME) < quantity:
+            raise InsufficientBelongingsError(item_name, quantity)
+
+        try:
+            order, fills = await self.database.place_order(user, item_id, side, price, quantity)
+        except OrderEscrowError as error:
+            if error.reason == OrderEscrowError.WALLET:
+                raise InsufficientWalletFundsError(self.utils.to_currency_str(price * quantity))
+            raise InsufficientBelongingsError(item_name, quantity)
+
+        action = "buy" if side == BUY else "sell"
+        embed = Embed()
+        embed.title = f"**{action.title()} Order Placed**"
+        embed.colour = Colour.green() if fills else self.bot.config.get("colour")
+        embed.description = f"You placed an order to {action} `{quantity}` **{item_name}** " \
+                            f"at `{self.utils.to_currency_str(price)}` each"
+        if fills:
+            embed.add_field(name="Filled", value=await self.describe_fills(fills), inline=False)
+        if order.remaining:
+            escrow = f"{WALLET} `{self.utils.to_currency_str(price * order.remaining)}`" if side == BUY else \
+                f"`{order.remaining}` **{await self.database.get_item_name(item_id, order.remaining)}**"
+            embed.add_field(name="Waiting In The Market",
+                            value=f"`{order.remaining}` left to {action}, with {escrow} held until the order is "
+                                  f"filled or cancelled", inline=False)
+        if not self.database.owns_market:
+            embed.set_footer(text="Orders are matched by another bot process, so check /orders for fills shortly")
+        await inter.send(embed=embed)
+
+    async def describe_fills(self, fills: list[Fill]) -> str:
+        lines = []
+        for fill in fills[:MAX_LISTED_FILLS]:
+            lines.append(f"`{fill.quantity}` at `{self.utils.to_currency_str(fill.price)}`")
+        if len(fills) > MAX_LISTED_FILLS:
+            lines.append(f"*...and {len(fills) - MAX_LISTED_FILLS} more*")
+        total_quantity = sum(fill.quantity for fill in fills)
+        total_cost = sum(fill.price * fill.quantity for fill in fills)
+        lines.append(f"**Total: `{total_quantity}` for `{self.utils.to_currency_str(total_cost)}`**")
+        return "- " + "\n- ".join(lines)
+
+    @slash_command(description="Place an order to buy items from other users on the market.")
+    async def buy(self, inter: Interaction,
+                  item_id_string: str = ItemSlashOption(
+                      description="The item you wish to buy."
+                  ),
+                  quantity: int = SlashOption(
+                      description="How many of the item to buy.",
+                      min_value=1
+                  ),
+                  price: str = SlashOption(
+                      description=PRICE_DESCRIPTION
+                  )):
+        await self.place_order(inter, BUY, item_id_string, quantity, price)
+
+    @buy.on_autocomplete("item_id_string")
+    async def buy_autocomplete(self, inter: Interaction, item_id_string: str):
+        await inter.response.send_autocomplete(self.database.search_items(item_id_string))
+
+    @slash_command(description="Place an order to sell items from your inventory to other users on the market.")
+    async def sell(self, inter: Interaction,
+                   item_id_string: str = ItemSlashOption(
+                       description="The item you wish to sell."
+                   ),
+                   quantity: int = SlashOption(
+                       description="How many of the item to sell.",
+                       min_value=1
+                   ),
+                   price: str = SlashOption(
+                       description=PRICE_DESCRIPTION
+                   )):
+        await self.place_order(inter, SELL, item_id_string, quantity, price)
+
+    @sell.on_autocomplete("item_id_string")
+    async def sell_autocomplete(self, inter: Interaction, item_id_string: str):
+        # Only suggest items in the user's home inventory
+        choices = await self.database.search_user_items(inter.user, item_id_string, HOME)
+        await inter.response.send_autocomplete(choices)
+
+    @slash_command(description="Cancel one of your market orders.")
+    async def cancel(self, inter: Interaction,
+                     order: str = SlashOption(
+                         description="The order you wish to cancel.",
+                         autocomplete=True
+                     )):
+        user = inter.user
+        if not await self.database.user_exists(user):
+            return await self.utils.add_and_welcome_new_user(inter, user)
+        if not ObjectId.is_valid(order):
+            raise OrderDoesNotExistError(order)
+
+        try:
+            cancelled = await self.database.cancel_order(user, ObjectId(order))
+        except OrderBookConflictError:
+            raise OrderBusyError
+        if cancelled is None:
+            raise OrderDoesNotExistError(order)
+
+        if not self.database.owns_market:
+            # Cancelled by the process that owns the market, which may fill more of the order first
+            embed = Embed()
+            embed.title = "**Cancelling Order**"
+            embed.colour = Colour.dark_red()
+            embed.description = f"Your order to {cancelled.side} `{cancelled.quantity}` " \
+                                f"**{await self.database.get_item_name(cancelled.item_id, cancelled.quantity)}** " \
+                                f"at `{self.utils.to_currency_str(cancelled.price)}` each will be cancelled in a " \
+                                f"moment, and whatever hasn't been filled by then will be returned to you"
+            return await inter.send(embed=embed)
+
+        item_name = await self.database.get_item_name(cancelled.item_id, cancelled.remaining)
+        if cancelled.side == BUY:
+            returned = f"{WALLET} `{self.utils.to_currency_str(cancelled.price * cancelled.remaining)}` was " \
+                       f"returned to your wallet"
+        else:
+            returned = f"`{cancelled.remaining}` **{item_name}** were returned to your home inventory"
+        embed = Embed()
+        embed.title = "**Order Cancelled**"
+        embed.colour = Colour.dark_red()
+        embed.description = f"You cancelled your order to {cancelled.side} `{cancelled.quantity}` " \
+                            f"**{await self.database.get_item_name(cancelled.item_id, cancelled.quantity)}** " \
+                            f"at `{self.utils.to_currency_str(cancelled.price)}` each\n\n{returned}"
+        await inter.send(embed=embed)
+
+    @cancel.on_autocomplete("order")
+    async def cancel_autocomplete(self, inter: Interaction, order: str):
+        await inter.response.send_autocomplete(await self.database.search_user_open_orders(inter.user, order))
+
+    # Returns the rendered lines for a page of the user's open orders, the _id of the last order on the page, and
+    # whether there is a next page
+    async def fetch_orders_page(self, user: User, after: Optional[ObjectId]
+                                ) -> tuple[list[str], Optional[ObjectId], bool]:
+        page_size = self.bot.config.get("inventory_page_size", 15)
+        orders, has_next = await self.database.get_user_open_orders_page(user, after, page_size)
+        lines = []
+        for order in orders:
+            name = await self.database.get_item_name(order.get("itemId"), order.get("quantity"))
+            lines.append(f"{order.get('side').title()} `{order.get('remaining')}`/`{order.get('quantity')}` "
+                         f"**{name}** at `{self.utils.to_currency_str(order.get('price'))}` each")
+        last_id = orders[-1].get("_id") if orders else after
+        return lines, last_id, has_next
+
+    @slash_command(description="View your open market orders.")
+    async def orders(self, inter: Interaction):
+        user = inter.user
+        if not await self.database.user_exists(user):
+            return await self.utils.add_and_welcome_new_user(inter, user)
+
+        menu = PagedListMenu(fetch_page=lambda after: self.fetch_orders_page(user, after),
+                             empty_text="*You don't have any open orders*",
+                             author_name=f"{user.name}'s Orders", author_icon_url=user.avatar.url,
+                             original_inter=inter, colour=self.bot.config.get("colour"))
+        await menu.send_or_update_menu()
+
+    @slash_command(description="View the prices an item is being bought and sold for on the market.")
+    async def market(self, inter: Interaction,
+                     item_id_string: str = ItemSlashOption(
+                         description="The item you wish to view."
+                     )):
+        item_id = await self.utils.get_item_id_from_option(item_id_string)
+        book = await self.database.get_order_book(item_id)
+
+        def describe_levels(side: str) -> str:
+            levels = book.depth(side, ORDER_BOOK_LEVELS)
+            if not levels:
+                return "*No orders*"
+            return "\n".join(f"`{quantity}` at `{self.utils.to_currency_str(price)}`" for price, quantity in levels)
+
+        embed = Embed()
+        embed.title = f"**{await self.database.get_item_plural_name(item_id)} Market**"
+        embed.colour = self.bot.config.get("colour")
+        embed.add_field(name="Selling", value=describe_levels(SELL))
+        embed.add_field(name="Buying", value=describe_levels(BUY))
+        await inter.send(embed=embed)
+
+    @market.on_autocomplete("item_id_string")
+    async def market_autocomplete(self, inter: Interaction, item_id_string: str):
+        await inter.response.send_autocomplete(self.database.search_items(item_id_string))
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info(f"Loading Market extension...")
+    bot.add_cog(MarketCog(bot))
@@ -1,9 +1,9 @@
-from nextcord import slash_command, Interaction, Embed, Colour
+from nextcord import slash_command, Interaction, Embed, Colour, SlashOption
 from nextcord.ext.application_checks import is_owner
 
 from bot import AlisUnnamedBot
 from extensions.core.emojis import TICK, WARNING, LOADING
-from extensions.core.utils import AlisUnnamedBotCog
+from extensions.core.utils import AlisUnnamedBotCog, send_response
 
 
 class MiscCog(AlisUnnamedBotCog):
@@ -20,7 +20,15 @@ class MiscCog(AlisUnnamedBotCog):
 
     @is_owner()
     @slash_command(description="Reload the bot.")
-    async def reload(self, inter: Interaction):
+    async def reload(self, inter: Interaction,
+                     full: bool = SlashOption(
+                         description="Reload every extension, not just the ones that have changed.",
+                         default=False
+                     ),
+                     force_sync: bool = SlashOption(
+                         description="Sync application commands, even if they haven't changed.",
+                         default=False
+                     )):
         # Defer response
         await inter.response.defer()
 
@@ -46,7 +54,7 @@ class MiscCog(AlisUnnamedBotCog):
         await inter.edit_original_message(embed=embed)
 
         # Reload extensions
-        failed_extensions = await self.bot.reload_extensions()
+        failed_extensions = await self.bot.reload_extensions(full)
         loaded_extensions = list(self.bot.extensions)
 
         # Embed: Extensions result + Syncing commands...
@@ -58,16 +66,19 @@ class MiscCog(AlisUnnamedBotCog):
         embed.description = separator.join([config_text, extensions_text, app_commands_text])
         await inter.edit_original_message(embed=embed)
 
-        # Sync application commands
+        # Sync application commands, if they have changed
+        commands_changed = True
         try:
-            await self.bot.sync_application_commands()
+            commands_changed = await self.bot.sync_application_commands_if_changed(force_sync)
             commands_synced = True
         except Exception as error:
             self.bot.logger.error(error)
             commands_synced = False
 
         # Embed: Syncing commands result
-        if commands_synced:
+        if commands_synced and not commands_changed:
+            app_commands_text = f"{TICK} Application commands unchanged, skipped sync!"
+        elif commands_synced:
             app_commands_text = f"{TICK} Application commands synced!"
         else:
             app_commands_text = f"{WARNING} Failed to sync application commands!"
@@ -90,6 +101,31 @@ class MiscCog(AlisUnnamedBotCog):
 
         await inter.edit_original_message(embed=embed)
 
+    @is_owner()
+    @slash_command(description="View the bot's metrics.")
+    async def metrics(self, inter: Interaction):
+        metrics = self.bot.metrics
+        embed = Embed()
+        embed.title = "**Metrics**"
+        embed.colour = self.bot.config.get("colour")
+        if metrics.counters:
+            embed.add_field(name="Counters",
+                            value="\n".join(f"{name}: `{value}`" for name, value in sorted(metrics.counters.items())),
+                            inline=False)
+        if metrics.gauges:
+            embed.add_field(name="Gauges",
+                            value="\n".join(f"{name}: `{value:g}`" for name, value in sorted(metrics.gauges.items())),
+                            inline=False)
+        if metrics.timings:
+            timings = []
+            for name, timing in sorted(metrics.timings.items()):
+                timings.append(f"{name}: `{timing.count}` in `{timing.mean * 1000:.2f}ms` avg, "
+                               f"`{timing.max * 1000:.2f}ms` max")
+            embed.add_field(name="Timings", value="\n".join(timings), inline=False)
+        if not embed.fields:
+            embed.description = "*Nothing has been recorded yet*"
+        await send_response(inter, embed=embed, ephemeral=True)
+
     @slash_command(description="Shows useful information about each feature of the bot.")
     async def help(self, inter: Interaction):
 
@@ -0,0 +1,198 @@
+from decimal import Decimal
+from typing import Optional
+
+from nextcord import slash_command, Interaction, User, SlashOption, Embed, Colour
+
+from bot import AlisUnnamedBot
+from extensions.core.database import HOME, TradeSide, TradeConflictError
+from extensions.core.emojis import CROSS, TICK, WALLET
+from extensions.core.ui import TradeMenu
+from extensions.core.utils import AlisUnnamedBotCog, EmbedError
+from extensions.economy import InvalidCurrencyAmountError, InsufficientWalletFundsError
+from extensions.inventory import InsufficientBelongingsError
+from extensions.user import UserDoesNotExistError
+
+
+class CannotTradeWithBotError(EmbedError):
+    def __init__(self):
+        super().__init__("**Invalid Argument**",
+                         f"Bots don't have anything to trade")
+
+
+class CannotTradeWithYourselfError(EmbedError):
+    def __init__(self):
+        super().__init__("**Invalid Argument**",
+                         f"You cannot trade with yourself!")
+
+
+class EmptyTradeError(EmbedError):
+    def __init__(self):
+        super().__init__("**Invalid Argument**",
+                         f"A trade needs at least one side to give some items or currency")
+
+
+class PartnerInsufficientFundsError(EmbedError):
+    def __init__(self, partner: User, required_funds: str):
+        super().__init__("**Insufficient Funds**",
+                         f"{partner.mention} doesn't have `{required_funds}` in their `Wallet`")
+
+
+class PartnerInsufficientBelongingsError(EmbedError):
+    def __init__(self, partner: User, item_name: str, amount: int):
+        super().__init__("**Insufficient Belongings**",
+                         f"{partner.mention} doesn't have `{amount}` **{item_name}** in their home inventory")
+
+
+class TradeCog(AlisUnnamedBotCog):
+    def __init__(self, bot: AlisUnnamedBot):
+        super().__init__(bot)
+
+    def parse_money(self, amount: str) -> Decimal:
+        if not self.utils.is_decimal(amount):
+            raise InvalidCurrencyAmountError(amount)
+        value = self.utils.to_currency_value(amount)
+        if value < 0:
+            raise InvalidCurrencyAmountError(amount)
+        return value
+
+    # Returns what user gives in a trade offered by the user of inter, after checking they have it
+    # Items are taken from the user's home inventory, and unique items are taken oldest first
+    async def prepare_side(self, inter: Interaction, user: User, item_id_string: Optional[str], amount: int,
+                           money: str) -> TradeSide:
+        offered_by_user = user.id == inter.user.id
+        side = TradeSide(user.id, self.parse_money(money))
+        if side.money > 0:
+            balance = await self.database.get_user_balance(user)
+            if balance.get("wallet") < side.money:
+                required_funds = self.utils.to_currency_str(side.money)
+                if offered_by_user:
+                    raise InsufficientWalletFundsError(required_funds)
+                raise PartnerInsufficientFundsError(user, required_funds)
+
+        if item_id_string:
+            side.item_id = await self.utils.get_item_id_from_option(item_id_string)
+            side.amount = amount
+            if await self.database.item_is_unique(side.item_id):
+                home_items = await self.database.get_specific_user_items(user, side.item_id, HOME)
+                owned = len(home_items)
+                side.user_item_ids = home_items[:amount]
+            else:
+                owned = await self.database.get_user_item_quantity(user, side.item_id, HOME)
+            if owned < amount:
+                item_name = await self.database.get_item_name(side.item_id, amount)
+                if offered_by_user:
+                    raise InsufficientBelongingsError(item_name, amount)
+                raise PartnerInsufficientBelongingsError(user, item_name, amount)
+        return side
+
+    async def describe_side(self, side: TradeSide) -> str:
+        lines = []
+        if side.money > 0:
+            lines.append(f"{WALLET} `{self.utils.to_currency_str(side.money)}`")
+        if side.item_id is not None and side.amount > 0:
+            item_name = await self.database.get_item_name(side.item_id, side.amount)
+            lines.append(f"`{side.amount}` **{item_name}**")
+        return "- " + "\n- ".join(lines) if lines else "*Nothing*"
+
+    @slash_command(description="Offer another user a trade of items and currency.")
+    async def trade(self, inter: Interaction,
+                    partner: User = SlashOption(
+                        name="user",
+                        description="The user to offer the trade to."
+                    ),
+                    offer_item: Optional[str] = SlashOption(
+                        description="An item from your home inventory to give.",
+                        autocomplete=True
+                    ),
+                    offer_amount: int = SlashOption(
+                        description="How many of the item to give.",
+                        min_value=1,
+                        default=1
+                    ),
+                    offer_money: str = SlashOption(
+                        description="How much currency to give from your wallet.",
+                        default="0"
+                    ),
+                    request_item: Optional[str] = SlashOption(
+                        description="An item from their home inventory to ask for.",
+                        autocomplete=True
+                    ),
+                    request_amount: int = SlashOption(
+                        description="How many of the item to ask for.",
+                        min_value=1,
+                        default=1
+                    ),
+                    request_money: str = SlashOption(
+                        description="How much currency to ask for from their wallet.",
+                        default="0"
+                    )):
+        user = inter.user
+        if not await self.database.user_exists(user):
+            return await self.utils.add_and_welcome_new_user(inter, user)
+        elif partner.bot:
+            raise CannotTradeWithBotError
+        elif partner.id == user.id:
+            raise CannotTradeWithYourselfError
+        elif not await self.database.user_exists(partner):
+            raise UserDoesNotExistError(partner)
+
+        offered = await self.prepare_side(inter, user, offer_item, offer_amount, offer_money)
+        requested = await self.prepare_side(inter, partner, request_item, request_amount, request_money)
+        if offered.is_empty() and requested.is_empty():
+            raise EmptyTradeError
+
+        description = f"{user.mention} offers {partner.mention} a trade\n\n" \
+                      f"**{user.name} gives:**\n{await self.describe_side(offered)}\n\n" \
+                      f"**{partner.name} gives:**\n{await self.describe_side(requested)}"
+
+        async def on_answer(original_inter: Interaction, accepted: bool):
+            await self.complete_trade(original_inter, partner, accepted, offered, requested)
+
+        menu = TradeMenu(partner=partner, description=description, callback=on_answer,
+                         original_inter=inter, title="**Trade Offer**", colour=self.bot.config.get("colour"))
+        await menu.send_or_update_menu()
+
+    @trade.on_autocomplete("offer_item")
+    async def offer_item_autocomplete(self, inter: Interaction, offer_item: str):
+        # Only suggest items in the user's home inventory
+        choices = await self.database.search_user_items(inter.user, offer_item, HOME)
+        await inter.response.send_autocomplete(choices)
+
+    @trade.on_autocomplete("request_item")
+    async def request_item_autocomplete(self, inter: Interaction, request_item: str):
+        await inter.response.send_autocomplete(self.database.search_items(request_item))
+
+    # Makes the trade if partner accepted it
+    # Called from the trade menu, after the command has finished, so errors are sent here rather than raised
+    async def complete_trade(self, inter: Interaction, partner: User, accepted: bool, offered: TradeSide,
+                             requested: TradeSide):
+        embed = Embed()
+        embed.title = "**Trade**"
+        if not accepted:
+            embed.colour = Colour.red()
+            embed.description = f"{CROSS} {partner.mention} declined the trade"
+            return await inter.send(embed=embed)
+
+        try:
+            await self.database.execute_trade(offered, requested)
+        except TradeConflictError as error:
+            if error.reason == TradeConflictError.MAX_UNIQUE_ITEMS:
+                reason = f"<@{error.user_id}> would have more than " \
+                         f"`{self.bot.config.get('max_unique_items')}` of a unique item"
+            else:
+                reason = f"<@{error.user_id}> no longer has everything they offered"
+            embed.title = "**Trade Cancelled**"
+            embed.colour = Colour.red()
+            embed.description = f"{CROSS} {reason}, so nothing was traded"
+            return await inter.send(embed=embed)
+
+        embed.colour = Colour.green()
+        embed.description = f"{TICK} {partner.mention} accepted the trade\n\n" \
+                            f"**{inter.user.name} gave:**\n{await self.describe_side(offered)}\n\n" \
+                            f"**{partner.name} gave:**\n{await self.describe_side(requested)}"
+        await inter.send(embed=embed)
+
+
+def setup(bot: AlisUnnamedBot, **kwargs):
+    bot.logger.info(f"Loading Trade extension...")
+    bot.add_cog(TradeCog(bot))
@@ -1,10 +1,13 @@
 from typing import Optional
 
-from nextcord import slash_command, Interaction, User, SlashOption, Embed
+from nextcord import slash_command, Interaction, User, SlashOption, Embed, Message, Colour
+from nextcord.ext.commands import Cog
 
 from bot import AlisUnnamedBot
+from extensions.core.cache import LRUCache, TTLCache, MISSING
 from extensions.core.emojis import MONEY_BAG, LEVEL
-from extensions.core.utils import AlisUnnamedBotCog, EmbedError
+from extensions.core.levels import LevelTable
+from extensions.core.utils import AlisUnnamedBotCog, EmbedError, send_response
 
 
 class BotsDoNotHaveProfilesError(EmbedError):
@@ -23,6 +26,62 @@ class UserDoesNotExistError(EmbedError):
 class UserCog(AlisUnnamedBotCog):
     def __init__(self, bot: AlisUnnamedBot):
         super().__init__(bot)
+        # Maps (user id, view, user version) to the rendered embed description for that view
+        self.render_cache = LRUCache(bot.config.get("render_cache_size", 1024))
+
+        exp_curve = bot.config.get("exp_curve", {})
+        self.level_table = LevelTable(exp_curve.get("base", 100), exp_curve.get("exponent", 1.5),
+                                      exp_curve.get("max_level", 1000))
+        # Users who have been awarded exp recently, and can't be awarded more until their entry expires
+        # Commands and messages have separate cooldowns, so chatting doesn't stop commands levelling users up
+        self.exp_cooldowns = TTLCache(bot.config.get("exp_cooldown", 30))
+        self.message_exp_cooldowns = TTLCache(bot.config.get("exp_cooldown", 30))
+
+    # Awards exp to the user, unless they were awarded exp too recently, then levels them up if their exp has reached
+    # a new level. Exp from messages is only counted towards levels here, so levels are checked even on cooldown.
+    # Returns the user's old and new level if they levelled up, which may be by more than one level
+    async def award_exp(self, user: User, amount: int) -> Optional[tuple[int, int]]:
+        if user.bot or amount <= 0 or not self.database:
+            return None
+        if self.exp_cooldowns.get(user.id) is not MISSING:
+            result = await self.database.get_user_level_data(user)
+        else:
+            self.exp_cooldowns.set(user.id, True)
+            result = await self.database.add_user_exp(user, amount)
+        if result is None:
+            return None  # Users are only added to the database by using a command
+        level = result.get("level", 1)
+        new_level = self.level_table.get_level(result.get("exp", 0))
+        if new_level <= level:
+            return None
+        await self.database.raise_user_level(user, new_level)
+        return level, new_level
+
+    @Cog.listener()
+    async def on_application_command_completion(self, inter: Interaction):
+        if self.database and not inter.user.bot:
+            self.database.increment_user_counters(inter.user.id, {"commandsUsed": 1})
+        level_up = await self.award_exp(inter.user, self.bot.config.get("exp_per_command", 0))
+        if level_up:
+            old_level, new_level = level_up
+            embed = Embed()
+            embed.title = "**Level Up!**"
+            embed.colour = Colour.gold()
+            embed.description = f"{LEVEL} You went from level `{old_level}` to level `{new_level}`!"
+            await send_response(inter, embed=embed, ephemeral=True)
+
+    @Cog.listener()
+    async def on_message(self, message: Message):
+        # Only received when the bot has the guild messages intent, so not in lean gateway mode
+        if message.guild is None or message.author.bot or not self.database:
+            return
+        deltas = {"messagesSent": 1}
+        # Messages are too frequent to write exp for each one, so it is buffered, and levels catch up with it the
+        # next time the user uses a command
+        if self.message_exp_cooldowns.get(message.author.id) is MISSING:
+            self.message_exp_cooldowns.set(message.author.id, True)
+            deltas["exp"] = self.bot.config.get("exp_per_message", 0)
+        self.database.increment_user_counters(message.author.id, deltas)
 
     @slash_command(description="View your own, or another user's, profile.")
     async def profile(self, inter: Interaction,
@@ -35,19 +94,26 @@ class UserCog(AlisUnnamedBotCog):
             user = inter.user
         elif user.bot:
             raise BotsDoNotHaveProfilesError
-        elif not await self.database.user_exists(user):
+        versions = await self.database.get_user_versions(user)
+        if versions is None:
             raise UserDoesNotExistError(user)
-        profile = await self.database.get_user_profile(user)
-        level = profile.get("level")
-        wallet = profile.get("wallet")
-        bank = profile.get("bank")
+
+        cache_key = (user.id, "profile", versions.get("version"))
+        embed_desc = self.render_cache.get(cache_key)
+        if embed_desc is MISSING:
+            profile = await self.database.get_user_profile(user)
+            level = profile.get("level")
+            wallet = profile.get("wallet")
+            bank = profile.get("bank")
+            embed_desc = f"{LEVEL} **Level: `{level}`**\n\n" \
+                         f"{MONEY_BAG} **Balance: `{self.utils.to_currency_str(wallet + bank)}`**"
+            self.render_cache.set(cache_key, embed_desc)
 
         embed = Embed()
         embed.set_author(name=f"{user.name}'s Profile", icon_url=user.avatar.url)
         embed.colour = self.bot.config.get("colour")
         embed.set_thumbnail(user.avatar.url)
-        embed.description = f"{LEVEL} **Level: `{level}`**\n\n" \
-                            f"{MONEY_BAG} **Balance: `{self.utils.to_currency_str(wallet + bank)}`**"
+        embed.description = embed_desc
         await inter.send(embed=embed)
 
     @slash_command(description="View your own, or another user's, level.")
@@ -70,7 +136,11 @@ class UserCog(AlisUnnamedBotCog):
         embed = Embed()
         embed.set_author(name=f"{user.name}'s Level", icon_url=user.avatar.url)
         embed.colour = self.bot.config.get("colour")
-        embed.description = f"**Level: `{level}`**\n**Exp: `{exp}`**"
+        if level < self.level_table.max_level:
+            embed.description = f"**Level: `{level}`**\n" \
+                                f"**Exp: `{exp}` / `{self.level_table.get_level_exp(level + 1)}`**"
+        else:
+            embed.description = f"**Level: `{level}`**\n**Exp: `{exp}`**"
         await inter.send(embed=embed)
 
 
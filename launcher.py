@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import time
+from multiprocessing import Process, Queue
+from os import environ
+from queue import Empty
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from bot import ColourFormatter, ShardedAlisUnnamedBot, get_client_options
+
+# Seconds to wait before restarting a crashed worker, doubled for each crash in a row, up to MAX_RESTART_DELAY
+RESTART_DELAY: float = 1.0
+MAX_RESTART_DELAY: float = 60.0
+
+# A worker that stays up this many seconds is considered healthy again, resetting its restart delay
+HEALTHY_UPTIME: float = 60.0
+
+
+# Returns the shard ids each worker should run, splitting shard_count shards into contiguous ranges
+def split_shards(shard_count: int, workers: int) -> list[list[int]]:
+    ranges = []
+    start = 0
+    for i in range(workers):
+        size = shard_count // workers + (1 if i < shard_count % workers else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return [shard_ids for shard_ids in ranges if shard_ids]
+
+
+# Runs in each worker process: starts a ShardedAlisUnnamedBot over shard_ids, and reports its shard stats
+def run_worker(worker_id: int, shard_ids: list[int], shard_count: int, stats_queue: Queue,
+               report_interval: float, fake_gateway: bool, fake_crash_rate: float):
+    load_dotenv()
+
+    if fake_gateway:
+        return asyncio.run(run_fake_worker(worker_id, shard_ids, shard_count, stats_queue, report_interval,
+                                           fake_crash_rate))
+
+    log_file_path = f"logs/bot.worker{worker_id}.log"
+    config_path = environ["CONFIG_PATH"]
+    bot = ShardedAlisUnnamedBot(config_path=config_path, log_file_path=log_file_path, shard_ids=shard_ids,
+                                shard_count=shard_count, **get_client_options(config_path))
+
+    async def report_stats():
+        await bot.wait_until_ready()
+        while not bot.is_closed():
+            stats_queue.put({"worker": worker_id, "pid": os.getpid(), "shards": bot.get_shard_stats()})
+            await asyncio.sleep(report_interval)
+
+    bot.loop.create_task(report_stats())
+    bot.run(environ["TOKEN"])
+
+
+# Stands in for a worker connected to Discord, so the supervisor can be run locally without a token
+# The worker builds a real ShardedAlisUnnamedBot over its shard range, and checks it was given the right shards,
+# but doesn't connect it to the gateway, so each shard reports a made up latency and guild count instead.
+# The worker crashes at random if fake_crash_rate is set, to exercise restarts.
+async def run_fake_worker(worker_id: int, shard_ids: list[int], shard_count: int, stats_queue: Queue,
+                          report_interval: float, fake_crash_rate: float):
+    config_path = environ.get("CONFIG_PATH", "config.json")
+    bot = ShardedAlisUnnamedBot(config_path=config_path, log_file_path=f"logs/bot.worker{worker_id}.log",
+                                shard_ids=shard_ids, shard_count=shard_count, **get_client_options(config_path))
+    if list(bot.shard_ids) != shard_ids or bot.shard_count != shard_count:
+        raise RuntimeError(f"Worker {worker_id} was built with shards {bot.shard_ids} of {bot.shard_count}, "
+                           f"expected {shard_ids} of {shard_count}")
+
+    while True:
+        shards = {}
+        for shard_id in shard_ids:
+            shards[shard_id] = {
+                "latency": random.uniform(0.03, 0.15),
+                "guilds": random.Random(shard_id).randint(800, 1200)
+            }
+        stats_queue.put({"worker": worker_id, "pid": os.getpid(), "shards": shards})
+        if random.random() < fake_crash_rate:
+            os._exit(1)
+        await asyncio.sleep(report_interval)
+
+
+class Worker:
+    def __init__(self, worker_id: int, shard_ids: list[int]):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.process: Optional[Process] = None
+        self.started = 0.0
+        self.crashes = 0  # Crashes in a row, used to back off restarts
+        self.restart_at: Optional[float] = None
+
+
+# Starts the worker processes, restarts any that crash, and logs the combined stats of every shard
+class Supervisor:
+    def __init__(self, workers: int, shard_count: int, report_interval: float = 30.0,
+                 fake_gateway: bool = False, fake_crash_rate: float = 0.0):
+        self.shard_count = shard_count
+        self.report_interval = report_interval
+        self.fake_gateway = fake_gateway
+        self.fake_crash_rate = fake_crash_rate
+        self.workers = [Worker(i, shard_ids) for i, shard_ids in enumerate(split_shards(shard_count, workers))]
+        self.stats_queue: Queue = Queue()
+        self.shard_stats: dict[int, dict] = {}  # Maps shard ids to the latest stats reported for the shard
+        self.restarts = 0
+        self.running = False
+
+        self.logger = logging.getLogger("alis_unnamed_bot.launcher")
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(ColourFormatter())
+            self.logger.addHandler(stream_handler)
+
+    def start_worker(self, worker: Worker):
+        worker.process = Process(target=run_worker, name=f"worker{worker.worker_id}",
+                                 args=(worker.worker_id, worker.shard_ids, self.shard_count, self.stats_queue,
+                                       self.report_interval, self.fake_gateway, self.fake_crash_rate))
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        self.logger.info(f"Started worker {worker.worker_id} (pid {worker.process.pid}) "
+                         f"for shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}")
+
+    # Restarts workers that have exited, waiting longer between restarts for workers that keep crashing
+    def check_workers(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process.is_alive():
+                if worker.crashes and now - worker.started > HEALTHY_UPTIME:
+                    worker.crashes = 0
+                continue
+            if worker.restart_at is None:
+                worker.crashes += 1
+                delay = min(RESTART_DELAY * 2 ** (worker.crashes - 1), MAX_RESTART_DELAY)
+                worker.restart_at = now + delay
+                for shard_id in worker.shard_ids:
+                    self.shard_stats.pop(shard_id, None)
+                self.logger.warning(f"Worker {worker.worker_id} exited with code {worker.process.exitcode}, "
+                                    f"restarting in {delay:.0f}s")
+            elif now >= worker.restart_at:
+                self.restarts += 1
+                self.start_worker(worker)
+
+    def drain_stats(self):
+        while True:
+            try:
+                report = self.stats_queue.get_nowait()
+            except Empty:
+                return
+            for shard_id, stats in report.get("shards", {}).items():
+                self.shard_stats[int(shard_id)] = stats
+
+    # Returns the combined stats of every shard that has reported
+    def get_stats(self) -> dict:
+        latencies = [stats.get("latency", 0) for stats in self.shard_stats.values()]
+        return {
+            "workers_alive": sum(1 for worker in self.workers if worker.process and worker.process.is_alive()),
+            "workers": len(self.workers),
+            "shards_reporting": len(self.shard_stats),
+            "shards": self.shard_count,
+            "guilds": sum(stats.get("guilds", 0) for stats in self.shard_stats.values()),
+            "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max_latency": max(latencies, default=0.0),
+            "restarts": self.restarts
+        }
+
+    def log_stats(self):
+        stats = self.get_stats()
+        self.logger.info(f"{stats['workers_alive']}/{stats['workers']} workers alive, "
+                         f"{stats['shards_reporting']}/{stats['shards']} shards reporting, "
+                         f"{stats['guilds']} guilds, "
+                         f"latency {stats['mean_latency'] * 1000:.0f}ms mean / {stats['max_latency'] * 1000:.0f}ms max, "
+                         f"{stats['restarts']} restarts")
+
+    # Runs until stop() is called or, if duration is given, for duration seconds
+    def run(self, duration: float = None):
+        self.running = True
+        for worker in self.workers:
+            self.start_worker(worker)
+        started = time.monotonic()
+        last_report = started
+        try:
+            while self.running and (duration is None or time.monotonic() - started < duration):
+                time.sleep(0.5)
+                self.drain_stats()
+                self.check_workers()
+                if time.monotonic() - last_report >= self.report_interval:
+                    self.log_stats()
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self.running = False
+
+    def shutdown(self):
+        self.logger.info("Stopping workers...")
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(timeout=10)
+        self.drain_stats()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Run AlisUnnamedBot as several sharded worker processes.")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes to run.")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="Total number of shards, split between the workers. Defaults to one per worker.")
+    parser.add_argument("--report-interval", type=float, default=30.0,
+                        help="Seconds between shard stats reports.")
+    parser.add_argument("--fake-gateway", action="store_true",
+                        help="Run workers that build the sharded bot without connecting it to Discord, and "
+                             "report made up shard stats.")
+    parser.add_argument("--fake-crash-rate", type=float, default=0.0,
+                        help="Chance of a fake worker crashing each time it reports, to test restarts.")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Stop after this many seconds, rather than running until interrupted.")
+    args = parser.parse_args()
+
+    supervisor = Supervisor(workers=args.workers, shard_count=args.shards or args.workers,
+                            report_interval=args.report_interval, fake_gateway=args.fake_gateway,
+                            fake_crash_rate=args.fake_crash_rate)
+    supervisor.run(duration=args.duration)
@@ -0,0 +1,148 @@
+import argparse
+import logging
+import time
+from datetime import datetime, timezone
+from os import environ
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from bot import ColourFormatter
+from migrations import Migration, load_migrations
+
+# Seconds between progress reports
+REPORT_INTERVAL: float = 5.0
+
+# States of a migration in the migrations collection
+RUNNING = "running"
+APPLIED = "applied"
+
+
+def get_logger() -> logging.Logger:
+    logger = logging.getLogger("alis_unnamed_bot.migrate")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(ColourFormatter())
+        logger.addHandler(stream_handler)
+    return logger
+
+
+# Applies migrations that haven't been applied yet, recording each one in the migrations collection
+# Documents are migrated in small _id ordered batches, with unordered bulk writes and a pause between batches, so the
+# bot's own queries aren't starved while a migration runs. The last _id of each batch is saved as a checkpoint, so
+# an interrupted migration carries on from where it stopped when the runner is started again.
+class MigrationRunner:
+    def __init__(self, db: Database, logger: logging.Logger, batch_size: int = 500, sleep_ms: int = 100,
+                 max_docs_per_second: float = None):
+        self.db = db
+        self.logger = logger
+        self.batch_size = batch_size
+        self.sleep = sleep_ms / 1000
+        self.max_docs_per_second = max_docs_per_second
+
+    def get_pending(self, migrations: list[Migration]) -> list[Migration]:
+        applied = {record["_id"] for record in self.db.migrations.find({"state": APPLIED}, {"_id": 1})}
+        return [migration for migration in migrations if migration.version not in applied]
+
+    # Logs how many documents each pending migration would change, without changing anything
+    def dry_run(self, migrations: list[Migration]):
+        for migration in self.get_pending(migrations):
+            if migration.collection:
+                count = self.db[migration.collection].count_documents(migration.query)
+                self.logger.info(f"Migration {migration.version} ({migration.description}) "
+                                 f"would migrate {count} '{migration.collection}' documents")
+            else:
+                self.logger.info(f"Migration {migration.version} ({migration.description}) doesn't migrate documents")
+
+    def run(self, migrations: list[Migration], target: int = None):
+        for migration in self.get_pending(migrations):
+            if target is not None and migration.version > target:
+                break
+            self.apply(migration)
+
+    def apply(self, migration: Migration):
+        record = self.db.migrations.find_one({"_id": migration.version}) or {}
+        last_id = record.get("lastId")
+        processed = record.get("processed", 0)
+        if record.get("state") == RUNNING:
+            self.logger.info(f"Resuming migration {migration.version} ({migration.description}) "
+                             f"after {processed} documents")
+        else:
+            self.logger.info(f"Applying migration {migration.version} ({migration.description})")
+            self.db.migrations.update_one(
+                {"_id": migration.version},
+                {"$set": {"description": migration.description, "state": RUNNING, "lastId": None, "processed": 0,
+                          "startedAt": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+
+        migration.prepare(self.db)
+
+        if migration.collection:
+            collection = self.db[migration.collection]
+            start = time.perf_counter()
+            last_report = start
+            processed_now = 0
+            while True:
+                query = dict(migration.query)
+                if last_id is not None:
+                    query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+                documents = list(collection.find(query).sort("_id", 1).limit(self.batch_size))
+                if not documents:
+                    break
+
+                writes = migration.migrate_batch(documents)
+                if writes:
+                    collection.bulk_write(writes, ordered=False)
+                last_id = documents[-1]["_id"]
+                processed += len(documents)
+                processed_now += len(documents)
+                self.db.migrations.update_one({"_id": migration.version},
+                                              {"$set": {"lastId": last_id, "processed": processed}})
+
+                elapsed = time.perf_counter() - start
+                if time.perf_counter() - last_report >= REPORT_INTERVAL:
+                    last_report = time.perf_counter()
+                    self.logger.info(f"Migration {migration.version}: {processed} documents migrated "
+                                     f"({processed_now / elapsed:.0f} docs/s)")
+                self.throttle(processed_now, elapsed)
+
+        self.db.migrations.update_one({"_id": migration.version},
+                                      {"$set": {"state": APPLIED, "appliedAt": datetime.now(timezone.utc)}})
+        self.logger.info(f"Applied migration {migration.version}, migrating {processed} documents")
+
+    # Sleeps between batches, and for longer if needed to keep under max_docs_per_second
+    def throttle(self, processed: int, elapsed: float):
+        delay = self.sleep
+        if self.max_docs_per_second:
+            delay = max(delay, processed / self.max_docs_per_second - elapsed)
+        if delay > 0:
+            time.sleep(delay)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Apply pending migrations to AlisUnnamedBot's database.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Count the documents each pending migration would change, without changing them.")
+    parser.add_argument("--target", type=int, default=None,
+                        help="Only apply migrations up to and including this version.")
+    parser.add_argument("--batch-size", type=int, default=500, help="Documents migrated per batch.")
+    parser.add_argument("--sleep-ms", type=int, default=100, help="Milliseconds to pause between batches.")
+    parser.add_argument("--max-docs-per-second", type=float, default=None,
+                        help="Pause for longer between batches if needed to migrate no faster than this.")
+    args = parser.parse_args()
+
+    client = MongoClient(environ["DB_HOST"], int(environ["DB_PORT"]))
+    runner = MigrationRunner(client[environ["DB_DATABASE"]], get_logger(), args.batch_size, args.sleep_ms,
+                             args.max_docs_per_second)
+    try:
+        if args.dry_run:
+            runner.dry_run(load_migrations())
+        else:
+            runner.run(load_migrations(), args.target)
+    finally:
+        client.close()
@@ -0,0 +1,39 @@
+import importlib
+import pkgutil
+
+from pymongo.database import Database
+
+
+# Base class for migrations, which are found in the modules of this package and applied in order of version
+#
+# A migration may change documents, by setting collection and query (which should only match documents that still
+# need migrating), and returning the writes for each batch of matching documents from migrate_batch(). Writes that
+# change users must increment their version, so compare-and-swap updates and caches notice the change.
+# A migration may also do one-off work in prepare(), such as building indexes, which must be safe to run again.
+class Migration:
+    version: int = 0
+    description: str = ""
+    collection: str = None
+    query: dict = {}
+
+    def prepare(self, db: Database):
+        pass
+
+    # Returns the writes (pymongo bulk write operations) that migrate documents
+    def migrate_batch(self, documents: list[dict]) -> list:
+        return []
+
+
+# Returns every migration in this package, ordered by version
+def load_migrations() -> list[Migration]:
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        migration = getattr(module, "migration", None)
+        if isinstance(migration, Migration):
+            migrations.append(migration)
+    migrations.sort(key=lambda migration: migration.version)
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Migration versions must be unique, got {versions}")
+    return migrations
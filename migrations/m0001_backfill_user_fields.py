@@ -0,0 +1,29 @@
+from pymongo import UpdateOne
+
+from migrations import Migration
+
+
+# Users created before versions and activity counters were added don't have them, so give them their starting values
+class BackfillUserFields(Migration):
+    version = 1
+    description = "Backfill user versions and activity counters"
+    collection = "users"
+    query = {
+        "$or": [
+            {"version": {"$exists": False}},
+            {"inventoryVersion": {"$exists": False}},
+            {"commandsUsed": {"$exists": False}},
+            {"messagesSent": {"$exists": False}}
+        ]
+    }
+
+    def migrate_batch(self, documents: list[dict]) -> list:
+        # Commands may increment these fields between the batch being read and written, so rather than setting
+        # them from the documents read, an update pipeline only fills in the ones still missing when it's applied
+        fill_missing = {field: {"$ifNull": [f"${field}", 0]}
+                        for field in ("inventoryVersion", "commandsUsed", "messagesSent")}
+        update = [{"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}, **fill_missing}}]
+        return [UpdateOne({"_id": document["_id"]}, update) for document in documents]
+
+
+migration = BackfillUserFields()
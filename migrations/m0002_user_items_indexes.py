@@ -0,0 +1,19 @@
+from pymongo import ASCENDING
+from pymongo.database import Database
+
+from migrations import Migration
+
+
+# Indexes for DatabaseCog's most frequent userItems queries: pages of a user's inventory at a location in _id order,
+# and a user's items of a particular item
+class UserItemsIndexes(Migration):
+    version = 2
+    description = "Add userItems indexes for inventory pages and item lookups"
+
+    def prepare(self, db: Database):
+        # Index builds don't block reads and writes for their whole duration since MongoDB 4.2
+        db.userItems.create_index([("userId", ASCENDING), ("location", ASCENDING), ("_id", ASCENDING)])
+        db.userItems.create_index([("userId", ASCENDING), ("itemId", ASCENDING)])
+
+
+migration = UserItemsIndexes()
@@ -0,0 +1,320 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+# Ranges of the fields of a cron expression: minute, hour, day of month, month, and day of week (0 is Sunday)
+CRON_FIELDS: list[tuple[int, int]] = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+# Cron expressions that never match, such as "0 0 30 2 *", are given up on after searching this far ahead
+MAX_CRON_SEARCH = timedelta(days=366 * 5)
+
+
+# Raised when a job is run on demand, but is already running as many times as it is allowed to at once
+class JobAlreadyRunningError(Exception):
+    def __init__(self, name: str):
+        super().__init__(f"Job '{name}' is already running")
+        self.name = name
+
+
+# Trigger that fires every seconds seconds, counted from when the job last started
+class IntervalTrigger:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def __str__(self):
+        return f"every {self.seconds:g}s"
+
+    def next_after(self, after: datetime) -> datetime:
+        return after + timedelta(seconds=self.seconds)
+
+
+# Trigger that fires at the times matching a five field cron expression, such as "30 3 * * 1" (03:30 UTC every
+# Monday). Each field may be "*", a number, a range "a-b", a step "*/n" or "a-b/n", or a comma separated list of them.
+class CronTrigger:
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"Cron expression '{expression}' must have {len(CRON_FIELDS)} fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+        # As in cron, if both days of the month and days of the week are restricted, a day matching either matches
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def __str__(self):
+        return f"cron '{self.expression}'"
+
+    # Returns the set of values that field matches
+    @staticmethod
+    def parse_field(field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = (int(value) for value in value_range.split("-", 1))
+            else:
+                start = end = int(value_range)
+                if step:
+                    end = high
+            # 7 is also Sunday in the day of week field
+            if high == 6 and start == 7:
+                # Nothing comes after 7, so this is only ever Sunday, even with a step
+                start = end = 0
+            step_size = int(step) if step else 1
+            if step_size < 1:
+                raise ValueError(f"Cron field '{field}' has a step below 1")
+            if high == 6 and end == 7 and start <= 7:
+                if (7 - start) % step_size == 0:
+                    values.add(0)  # Only if the step lands on 7
+                end = 6
+            if start < low or end > high or start > end:
+                raise ValueError(f"Cron field '{field}' is out of range {low}-{high}")
+            values.update(range(start, end + 1, step_size))
+        return values
+
+    def day_matches(self, time_: datetime) -> bool:
+        day = time_.day in self.days
+        weekday = (time_.weekday() + 1) % 7 in self.weekdays  # datetime counts from Monday, cron from Sunday
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, after: datetime) -> datetime:
+        time_ = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + MAX_CRON_SEARCH
+        # Skip whole months, days and hours that can't match, rather than checking every minute
+        while time_ < limit:
+            if time_.month not in self.months:
+                year, month = divmod(time_.month, 12)
+                time_ = time_.replace(year=time_.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self.day_matches(time_):
+                time_ = (time_ + timedelta(days=1)).replace(hour=0, minute=0)
+            elif time_.hour not in self.hours:
+                time_ = (time_ + timedelta(hours=1)).replace(minute=0)
+            elif time_.minute not in self.minutes:
+                time_ += timedelta(minutes=1)
+            else:
+                return time_
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+class Job:
+    def __init__(self, name: str, trigger, func: Callable[[], Awaitable[Any]], max_concurrency: int,
+                 running: set[asyncio.Task]):
+        self.name = name
+        self.trigger = trigger
+        self.func = func
+        self.max_concurrency = max_concurrency  # How many runs of the job may run at once, across every process
+        self.next_run_at: Optional[datetime] = None  # Only used when there is no job store
+        self.running = running  # Runs of the job in this process
+
+
+# Runs registered jobs when their triggers fire
+# Owned by the bot rather than an extension, so it keeps running, with no duplicate tasks, when extensions are
+# reloaded. Extensions register their jobs by name when they are loaded, replacing the registration from before the
+# reload, and unregister them when they are unloaded.
+#
+# When given a job store (a MongoDB collection), the next run time of each job is kept there, and a process has to
+# claim each run by advancing it, so each run happens in only one process when the bot is sharded. The claiming
+# process takes a lease on the job while it runs, renewed until the run finishes, and a job can't be claimed while
+# max_concurrency unexpired leases are held. A process that crashes stops renewing its leases, so they expire.
+class Scheduler:
+    def __init__(self, logger: logging.Logger, metrics, tick_seconds: float = 5.0, lease_seconds: float = 60.0):
+        self.logger = logger
+        self.metrics = metrics
+        self.tick_seconds = tick_seconds
+        self.lease_seconds = lease_seconds
+        self.jobs: dict[str, Job] = {}
+        # Maps job names to their runs in this process, kept when a job is unregistered, so runs from before a
+        # reload still count towards max_concurrency
+        self.running: dict[str, set[asyncio.Task]] = {}
+        self.store: Optional[AsyncIOMotorCollection] = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{ObjectId()}"  # Identifies this process's leases
+        self.task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, trigger, func: Callable[[], Awaitable[Any]], max_concurrency: int = 1):
+        old_job = self.jobs.get(name)
+        job = self.jobs[name] = Job(name, trigger, func, max_concurrency, self.running.setdefault(name, set()))
+        if old_job and str(old_job.trigger) == str(trigger):
+            job.next_run_at = old_job.next_run_at
+        self.logger.debug(f"Registered job '{name}' to run {trigger}")
+
+    def unregister(self, name: str):
+        self.jobs.pop(name, None)
+
+    def set_store(self, store: Optional[AsyncIOMotorCollection]):
+        self.store = store
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for running in self.running.values():
+            for task in list(running):
+                task.cancel()
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_due_jobs()
+            except PyMongoError as error:
+                self.logger.error(f"Scheduler failed to check for due jobs: {error}")
+            except Exception as error:
+                self.logger.error(f"Scheduler failed: {error}")
+            await asyncio.sleep(self.tick_seconds)
+
+    async def run_due_jobs(self):
+        now = datetime.now(timezone.utc)
+        if self.store is None:
+            for job in list(self.jobs.values()):
+                if job.next_run_at is None:
+                    job.next_run_at = job.trigger.next_after(now)
+                elif job.next_run_at <= now and len(job.running) < job.max_concurrency:
+                    scheduled_at = job.next_run_at
+                    job.next_run_at = job.trigger.next_after(now)
+                    self.start_run(job, scheduled_at, None)
+            return
+
+        jobs = {name: job for name, job in self.jobs.items() if len(job.running) < job.max_concurrency}
+        if not jobs:
+            return
+        documents = {}
+        async for document in self.store.find({"_id": {"$in": list(jobs)}}):
+            documents[document["_id"]] = document
+        for name, job in jobs.items():
+            document = documents.get(name)
+            if document is None or document.get("trigger") != str(job.trigger):
+                # New job, or its trigger has changed, so schedule its next run from now
+                await self.store.update_one(
+                    {"_id": name},
+                    {"$set": {"trigger": str(job.trigger), "nextRunAt": job.trigger.next_after(now)}},
+                    upsert=True
+                )
+                continue
+            # MongoDB returns naive datetimes, which are in UTC
+            scheduled_at = document["nextRunAt"].replace(tzinfo=timezone.utc)
+            if scheduled_at > now:
+                continue
+            run_id = await self.claim(job, now, scheduled_at, job.trigger.next_after(now))
+            if run_id:
+                self.start_run(job, scheduled_at, run_id)
+
+    # Takes a lease on the job, and moves its next run to next_run_at, if no other process has claimed this run and
+    # fewer than max_concurrency leases are held. Returns the id of the run, or None if it couldn't be claimed.
+    # If scheduled_at is None, the job is claimed regardless of when it is scheduled, and its next run isn't moved.
+    async def claim(self, job: Job, now: datetime, scheduled_at: Optional[datetime],
+                    next_run_at: Optional[datetime]) -> Optional[ObjectId]:
+        run_id = ObjectId()
+        active_leases = {
+            "$filter": {
+                "input": {"$ifNull": ["$leases", []]},
+                "cond": {"$gt": ["$$this.expiresAt", now]}
+            }
+        }
+        query = {
+            "_id": job.name,
+            "$expr": {"$lt": [{"$size": active_leases}, job.max_concurrency]}
+        }
+        update = {
+            # Expired leases are dropped while claiming, since the processes holding them have stopped
+            "leases": {
+                "$concatArrays": [
+                    active_leases,
+                    [{"runId": run_id, "owner": self.owner, "expiresAt": now + timedelta(seconds=self.lease_seconds)}]
+                ]
+            }
+        }
+        if scheduled_at is not None:
+            query["nextRunAt"] = scheduled_at
+            update["nextRunAt"] = next_run_at
+        result = await self.store.find_one_and_update(query, [{"$set": update}], projection={"_id": 1},
+                                                      return_document=ReturnDocument.AFTER)
+        return run_id if result else None
+
+    async def renew_lease(self, job: Job, run_id: ObjectId):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+                await self.store.update_one({"_id": job.name, "leases.runId": run_id},
+                                            {"$set": {"leases.$.expiresAt": expires_at}})
+            except PyMongoError as error:
+                self.logger.error(f"Failed to renew lease on job '{job.name}': {error}")
+
+    async def release_lease(self, job: Job, run_id: ObjectId, finished_at: datetime, duration: float):
+        await self.store.update_one(
+            {"_id": job.name},
+            {
+                "$pull": {"leases": {"runId": run_id}},
+                "$set": {"lastRunAt": finished_at, "lastDuration": duration}
+            }
+        )
+
+    def start_run(self, job: Job, scheduled_at: Optional[datetime], run_id: Optional[ObjectId]) -> asyncio.Task:
+        task = asyncio.create_task(self.run_job(job, scheduled_at, run_id))
+        job.running.add(task)
+        task.add_done_callback(lambda done: self.on_run_done(job, done))
+        return task
+
+    @staticmethod
+    def on_run_done(job: Job, task: asyncio.Task):
+        job.running.discard(task)
+        if not task.cancelled():
+            task.exception()  # Already logged by run_job, so just mark it as retrieved
+
+    async def run_job(self, job: Job, scheduled_at: Optional[datetime], run_id: Optional[ObjectId]) -> Any:
+        if scheduled_at is not None:
+            lag = (datetime.now(timezone.utc) - scheduled_at).total_seconds()
+            self.metrics.observe(f"scheduler.{job.name}.lag", max(lag, 0.0))
+        self.metrics.set_gauge(f"scheduler.{job.name}.running", len(job.running))
+        renew_task = asyncio.create_task(self.renew_lease(job, run_id)) if run_id else None
+        start = time.perf_counter()
+        try:
+            return await job.func()
+        except Exception as error:
+            self.metrics.increment(f"scheduler.{job.name}.failures")
+            self.logger.error(f"Job '{job.name}' failed: {error}")
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.metrics.observe(f"scheduler.{job.name}.duration", duration)
+            self.metrics.set_gauge(f"scheduler.{job.name}.running", len(job.running) - 1)
+            if renew_task:
+                renew_task.cancel()
+                try:
+                    await self.release_lease(job, run_id, datetime.now(timezone.utc), duration)
+                except PyMongoError as error:
+                    self.logger.error(f"Failed to release lease on job '{job.name}': {error}")
+
+    # Runs the job now, outside its schedule, and returns its result
+    # Raises JobAlreadyRunningError if the job is already running max_concurrency times
+    async def run_now(self, name: str) -> Any:
+        job = self.jobs[name]
+        if len(job.running) >= job.max_concurrency:
+            raise JobAlreadyRunningError(name)
+        run_id = None
+        if self.store is not None:
+            now = datetime.now(timezone.utc)
+            await self.store.update_one({"_id": name}, {"$setOnInsert": {"trigger": str(job.trigger),
+                                                                         "nextRunAt": job.trigger.next_after(now)}},
+                                        upsert=True)
+            run_id = await self.claim(job, now, None, None)
+            if run_id is None:
+                raise JobAlreadyRunningError(name)
+        return await self.start_run(job, None, run_id)